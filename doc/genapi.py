@@ -56,7 +56,7 @@ def genfiles(package, package_name, modules, dir='api'):
 
 modules = [
     ('__init__', 'Sasmodels package'),
-    #('alignment', 'GPU data alignment [unused]'),
+    ('alignment', 'GPU data alignment'),
     ('bumps_model', 'Bumps interface'),
     ('compare_many', 'Batch compare models on different compute engines'),
     ('compare', 'Compare models on different compute engines'),
@@ -12,9 +12,10 @@ correct alignment.
 
 Set alignment to :func:`gpu.environment()` attribute *boundary*.
 
-Note:  This code is unused. So far, tests have not demonstrated any
-improvement from forcing correct alignment.  The tests should
-be repeated with arrays forced away from the target boundaries
+Note:  :class:`details.KernelArgsCache` uses :func:`align_empty` for the
+value buffer it reuses between kernel calls.  So far, tests have not
+demonstrated any improvement from forcing correct alignment.  The tests
+should be repeated with arrays forced away from the target boundaries
 to decide whether it is really required.
 """
 import numpy as np  # type: ignore
@@ -29,7 +30,7 @@ def align_empty(shape, dtype, alignment=128):
     extra = alignment//dtype.itemsize - 1
     result = np.empty(size+extra, dtype)
     # build a view into allocated array which starts on a boundary
-    offset = (result.ctypes.data%alignment)//dtype.itemsize
+    offset = (-result.ctypes.data%alignment)//dtype.itemsize
     view = np.reshape(result[offset:offset+size], shape)
     return view
 
@@ -7,7 +7,9 @@ arguments to set the initial value for each parameter.
 
 :class:`Experiment` combines the *Model* function with a data file loaded by
 the sasview data loader.  *Experiment* takes a *cutoff* parameter controlling
-how far the polydispersity integral extends.
+how far the polydispersity integral extends, and a *solve_linear* parameter
+for computing scale and background directly from the data rather than
+fitting them.
 
 """
 from __future__ import print_function
@@ -129,14 +131,30 @@ class Experiment(DataMixin):
     *cutoff* is the integration cutoff, which avoids computing the
     the SAS model where the polydispersity weight is low.
 
+    The theory is recalculated after every parameter update, but when only
+    *scale* and *background* have changed the kernel result from the
+    previous update is reused.
+
+    *solve_linear* is True if *scale* and *background* should be computed
+    by weighted linear least squares for each set of the remaining model
+    parameters (variable projection).  The residuals are linear in *scale*
+    and *background*, so they can be solved in closed form rather than
+    adding two dimensions to the fit.  The solution is restricted to the
+    limits of the parameters in the model definition and stored in
+    *model.scale* and *model.background*, which should be fixed in the fit.
+    Note that this means :meth:`theory` (and so :meth:`residuals` and
+    :meth:`nllf`) sets the values of these two fit parameters as a side
+    effect.
+
     The resulting model can be used directly in a Bumps FitProblem call.
     """
     _cache = None # type: Dict[str, np.ndarray]
-    def __init__(self, data, model, cutoff=1e-5):
-        # type: (Data, Model, float) -> None
+    def __init__(self, data, model, cutoff=1e-5, solve_linear=False):
+        # type: (Data, Model, float, bool) -> None
         # remember inputs so we can inspect from outside
         self.model = model
         self.cutoff = cutoff
+        self.solve_linear = solve_linear
         self._interpret_data(data, model.sasmodel)
         self._cache = {}
 
@@ -169,12 +187,39 @@ class Experiment(DataMixin):
 
         This method uses lazy evaluation, and requires model.update() to be
         called when the parameters have changed.
+
+        If *solve_linear* is True, this sets *model.scale.value* and
+        *model.background.value* to the solution for the current values
+        of the remaining parameters.
         """
         if 'theory' not in self._cache:
             pars = self.model.state()
+            if getattr(self, 'solve_linear', False) and self.Iq is not None:
+                self._solve_linear(pars)
             self._cache['theory'] = self._calc_theory(pars, cutoff=self.cutoff)
         return self._cache['theory']
 
+    def _solve_linear(self, pars):
+        # type: (Dict[str, Union[float, str]]) -> None
+        """
+        Set scale and background in *pars* and in the model to the values
+        which best fit the data given the remaining parameters.
+        """
+        scale, background = self.model.sasmodel.info.parameters.call_parameters[:2]
+        # The kernel result is cached, so the model is only evaluated once
+        # for the two basis vectors.
+        basis = []
+        for coeffs in ((1., 0.), (0., 1.)):
+            basis_pars = pars.copy()
+            basis_pars.update(zip((scale.name, background.name), coeffs))
+            basis.append(self._calc_theory(basis_pars, cutoff=self.cutoff))
+        values = solve_scale_background(
+            basis[0], basis[1], self.Iq, self.dIq,
+            scale_limits=scale.limits, background_limits=background.limits)
+        for par, value in zip((scale, background), values):
+            pars[par.name] = value
+            getattr(self.model, par.name).value = value
+
     def residuals(self):
         # type: () -> np.ndarray
         """
@@ -235,3 +280,92 @@ class Experiment(DataMixin):
         # pylint: disable=attribute-defined-outside-init
         self.__dict__ = state
 
+
+def solve_scale_background(theory, offset, Iq, dIq,
+                           scale_limits=(-np.inf, np.inf),
+                           background_limits=(-np.inf, np.inf)):
+    # type: (np.ndarray, np.ndarray, np.ndarray, np.ndarray, Tuple[float, float], Tuple[float, float]) -> Tuple[float, float]
+    r"""
+    Return the *scale* and *background* which minimize the weighted sum
+    of squares $\sum ((s\,T + b\,B - I)/\Delta I)^2$ within the limits.
+
+    *theory* is the theory T with scale=1 and background=0, and *offset*
+    is the theory B with scale=0 and background=1, which is one everywhere
+    unless the resolution function or the SESANS transform change it.
+    *Iq* and *dIq* are the data and uncertainty.
+    """
+    A = np.vstack((theory/dIq, offset/dIq)).T
+    y = Iq/dIq
+    def chisq(p):
+        return np.sum((np.dot(A, p) - y)**2)
+    def best(column, fixed, value, limits):
+        # Solve for one coefficient with the other held at its limit.
+        p = [0., 0.]
+        p[fixed] = value
+        residual = y - A[:, fixed]*value
+        norm = np.sum(A[:, column]**2)
+        p[column] = np.clip(np.sum(A[:, column]*residual)/norm if norm else 0.,
+                            *limits)
+        return p
+
+    p = np.linalg.lstsq(A, y, rcond=-1)[0]
+    if (scale_limits[0] <= p[0] <= scale_limits[1]
+            and background_limits[0] <= p[1] <= background_limits[1]):
+        return float(p[0]), float(p[1])
+
+    # The constrained minimum is on the boundary of the box, so try each
+    # edge and keep the best.
+    candidates = [best(1, 0, v, background_limits)
+                  for v in scale_limits if np.isfinite(v)]
+    candidates += [best(0, 1, v, scale_limits)
+                   for v in background_limits if np.isfinite(v)]
+    p = min(candidates, key=chisq)
+    return float(p[0]), float(p[1])
+
+
+def test_solve_scale_background():
+    # type: () -> None
+    """
+    Check the linear solution for scale and background.
+    """
+    x = np.linspace(0.1, 1., 20)
+    theory, offset = x**-2, np.ones_like(x)
+    dIq = 0.1*np.ones_like(x)
+    Iq = 3.*theory + 0.5
+    scale, background = solve_scale_background(theory, offset, Iq, dIq)
+    assert np.allclose([scale, background], [3., 0.5])
+    # With a negative scale restricted to zero the background is the mean.
+    scale, background = solve_scale_background(
+        theory, offset, -theory + 0.5, dIq, scale_limits=(0, np.inf))
+    assert scale == 0. and np.allclose(background, np.mean(-theory + 0.5))
+
+def test_solve_linear():
+    # type: () -> None
+    """
+    Check that an experiment with *solve_linear* recovers the scale and
+    background of synthetic data.
+    """
+    try:
+        import bumps  # type: ignore
+    except ImportError:
+        return
+    from .core import load_model
+    from .data import Data1D, empty_data1D
+
+    model = load_model('sphere', dtype='double', platform='dll')
+    q = np.logspace(-3, -1, 50)
+    pars = dict(radius=200, sld=3., sld_solvent=1.)
+    target = Experiment(empty_data1D(q), Model(model, scale=3., background=0.5,
+                                               **pars)).theory()
+    data = Data1D(q, target, dy=0.01*target)
+
+    fit = Model(model, scale=1., background=0., **pars)
+    experiment = Experiment(data, fit, solve_linear=True)
+    actual = experiment.theory()
+    for name, value in (('scale', 3.), ('background', 0.5)):
+        par = getattr(fit, name)
+        assert np.allclose(par.value, value, rtol=1e-8), \
+            "%s: expected %s but got %s"%(name, value, par.value)
+    assert np.allclose(actual, target, rtol=1e-8), \
+        "theory: expected %s but got %s"%(target, actual)
+    assert experiment.nllf() < 1e-10
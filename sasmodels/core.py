@@ -5,11 +5,12 @@ from __future__ import print_function
 
 __all__ = [
     "list_models", "load_model", "load_model_info",
-    "build_model", "precompile_dlls",
+    "build_model", "precompile_dlls", "precompile_dlls_parallel",
     ]
 
 import os
 import re
+import time
 from os.path import basename, dirname, join as joinpath
 from glob import glob
 
@@ -40,7 +41,7 @@ if CUSTOM_MODEL_PATH == "":
     CUSTOM_MODEL_PATH = path
 
 try:
-    from typing import List, Union, Optional, Any
+    from typing import List, Union, Optional, Any, Dict, Tuple
     from .kernel import KernelModel
     from .modelinfo import ModelInfo
 except ImportError:
@@ -246,24 +247,116 @@ def precompile_dlls(path, dtype="double"):
 
     This can be used when build the windows distribution of sasmodels
     which may be missing the OpenCL driver and the dll compiler.
+
+    See :func:`precompile_dlls_parallel` to compile the models using
+    multiple processes.
     """
-    numpy_dtype = np.dtype(dtype)
     if not os.path.exists(path):
         os.makedirs(path)
     compiled_dlls = []
     for model_name in list_models():
-        model_info = load_model_info(model_name)
-        if not callable(model_info.Iq):
-            source = generate.make_source(model_info)['dll']
-            old_path = kerneldll.DLL_PATH
-            try:
-                kerneldll.DLL_PATH = path
-                dll = kerneldll.make_dll(source, model_info, dtype=numpy_dtype)
-            finally:
-                kerneldll.DLL_PATH = old_path
-            compiled_dlls.append(dll)
+        entry = _precompile_dll((model_name, dtype, path))
+        if entry is not None:
+            compiled_dlls.append(entry['path'])
     return compiled_dlls
 
+def precompile_dlls_parallel(path, dtypes=("single", "double"), workers=None):
+    # type: (str, List[str], int) -> List[Dict[str, Any]]
+    """
+    Precompile the dlls for all builtin models using a pool of processes,
+    returning a manifest of the compiled models.
+
+    *path* is the directory in which to save the dlls.  It will be created if
+    it does not already exist.
+
+    *dtypes* is the list of precisions to compile.  Single precision dlls are
+    not produced for models which require double precision, nor for any
+    model if *kerneldll.ALLOW_SINGLE_PRECISION_DLLS* is False; the double
+    precision dll is compiled instead, once.
+
+    *workers* is the number of processes to use, which defaults to the
+    number of cpus.  Use *workers=1* to compile in the current process.
+
+    The manifest has one entry for each dll, with keys *model*, *dtype*,
+    *path*, *compiled* (False if the dll was already in *path*) and *time*
+    (the seconds spent compiling).
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+    jobs = _precompile_jobs(path, dtypes)
+    if workers == 1:
+        manifest = [_precompile_dll(job) for job in jobs]
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(workers)
+        try:
+            manifest = pool.map(_precompile_dll, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    return [entry for entry in manifest if entry is not None]
+
+def _precompile_jobs(path, dtypes):
+    # type: (str, List[str]) -> List[Tuple[str, str, str]]
+    """
+    Return the *(model_name, dtype, path)* jobs for compiling the builtin
+    models in each of *dtypes*.
+
+    Single precision is skipped for models which require double precision,
+    and is replaced by double precision if single precision dlls are not
+    allowed, so each dll appears once.
+    """
+    jobs = []  # type: List[Tuple[str, str, str]]
+    for model_name in list_models():
+        model_info = load_model_info(model_name)
+        if callable(model_info.Iq):
+            continue
+        for dtype in dtypes:
+            numpy_dtype = np.dtype(dtype)
+            if numpy_dtype == generate.F32:
+                if not model_info.single:
+                    continue
+                if not kerneldll.ALLOW_SINGLE_PRECISION_DLLS:
+                    numpy_dtype = generate.F64
+            job = (model_name, numpy_dtype.name, path)
+            if job not in jobs:
+                jobs.append(job)
+    return jobs
+
+def _precompile_dll(job):
+    # type: (Tuple[str, str, str]) -> Optional[Dict[str, Any]]
+    """
+    Compile the dll for *(model_name, dtype, path)*, returning its manifest
+    entry, or None if the model is a pure python model.
+    """
+    model_name, dtype, path = job
+    model_info = load_model_info(model_name)
+    numpy_dtype = np.dtype(dtype)
+    if callable(model_info.Iq):
+        return None
+    if numpy_dtype == generate.F32 and not kerneldll.ALLOW_SINGLE_PRECISION_DLLS:
+        numpy_dtype = generate.F64
+    source = generate.make_source(model_info)['dll']
+    old_path, old_size = kerneldll.DLL_PATH, kerneldll.DLL_CACHE_SIZE
+    try:
+        # Don't remove dlls from the target directory to make room.
+        kerneldll.DLL_PATH, kerneldll.DLL_CACHE_SIZE = path, 0
+        converted = generate.convert_type(source, numpy_dtype)
+        target = kerneldll.dll_path(model_info, numpy_dtype, converted)
+        compiled = not os.path.exists(target)
+        start = time.time()
+        dll = kerneldll.make_dll(source, model_info, dtype=numpy_dtype)
+        elapsed = time.time() - start if compiled else 0.
+    finally:
+        kerneldll.DLL_PATH, kerneldll.DLL_CACHE_SIZE = old_path, old_size
+    return {
+        'model': model_name,
+        'dtype': numpy_dtype.name,
+        'path': dll,
+        'compiled': compiled,
+        'time': elapsed,
+    }
+
 def parse_dtype(model_info, dtype=None, platform=None):
     # type: (ModelInfo, str, str) -> (np.dtype, bool, str)
     """
@@ -315,14 +408,57 @@ def parse_dtype(model_info, dtype=None, platform=None):
 
     # Make sure that the type is supported by opencl, otherwise use dll
     if platform == "ocl":
-        env = kernelcl.environment()
-        if not env.has_type(numpy_dtype):
+        try:
+            env = kernelcl.environment()
+        except RuntimeError:
+            env = None
+        if env is None or not env.has_type(numpy_dtype):
             platform = "dll"
             if dtype is None:
                 numpy_dtype = generate.F64
 
     return numpy_dtype, fast, platform
 
+def test_precompile_dlls():
+    # type: () -> None
+    """
+    Check the precompile job list and the names of the compiled dlls.
+    """
+    import shutil
+    import tempfile
+
+    saved = kerneldll.ALLOW_SINGLE_PRECISION_DLLS
+    try:
+        kerneldll.ALLOW_SINGLE_PRECISION_DLLS = True
+        jobs = _precompile_jobs('dlls', ('single', 'double'))
+        kerneldll.ALLOW_SINGLE_PRECISION_DLLS = False
+        forced = _precompile_jobs('dlls', ('single', 'double'))
+    finally:
+        kerneldll.ALLOW_SINGLE_PRECISION_DLLS = saved
+    assert len(set(jobs)) == len(jobs)
+    assert ('cylinder', 'float32', 'dlls') in jobs
+    assert ('cylinder', 'float64', 'dlls') in jobs
+    assert ('bcc_paracrystal', 'float32', 'dlls') not in jobs
+    assert ('bcc_paracrystal', 'float64', 'dlls') in jobs
+    # Without single precision dlls, each model is compiled once in double.
+    assert forced == [job for job in jobs if job[1] == 'float64']
+
+    path = tempfile.mkdtemp()
+    try:
+        model_info = load_model_info('cylinder')
+        source = generate.make_source(model_info)['dll']
+        source = generate.convert_type(source, generate.F64)
+        target = joinpath(path, kerneldll.dll_name(model_info, generate.F64,
+                                                   source))
+        entry = _precompile_dll(('cylinder', 'float64', path))
+        assert entry['path'] == target and os.path.exists(target)
+        assert entry['model'] == 'cylinder' and entry['dtype'] == 'float64'
+        assert entry['compiled']
+        entry = _precompile_dll(('cylinder', 'float64', path))
+        assert entry['path'] == target and not entry['compiled']
+    finally:
+        shutil.rmtree(path)
+
 def list_models_main():
     # type: () -> None
     """
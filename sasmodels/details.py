@@ -16,6 +16,8 @@ from __future__ import print_function
 import numpy as np  # type: ignore
 from numpy import pi, cos, sin
 
+from .alignment import align_empty
+
 try:
     np.meshgrid([])
     meshgrid = np.meshgrid
@@ -28,7 +30,7 @@ except Exception:
             return [np.asarray(v) for v in args]
 
 try:
-    from typing import List
+    from typing import List, Tuple, Dict, Sequence
 except ImportError:
     pass
 else:
@@ -58,10 +60,19 @@ class CallDetails(object):
     vector is the latitude parameter, or -1 if there is no latitude
     parameter in the model.  In practice, the normalization term cancels
     if the latitude is not a polydisperse parameter.
+
+    Rather than visiting every point in the mesh, the kernel can visit a
+    list of *points*, given as positions in the mesh, n, in increasing order.
+    This is used to skip the points whose weight is below the cutoff (see
+    :func:`prune_details`).  If *sparse* is set then *num_eval* is the
+    length of the list and the list of *num_points* follows the details
+    in the call buffer.
     """
     parts = None  # type: List["CallDetails"]
-    def __init__(self, model_info):
-        # type: (ModelInfo) -> None
+    #: number of mesh points which were removed from the list of points
+    num_pruned = 0
+    def __init__(self, model_info, num_points=0):
+        # type: (ModelInfo, int) -> None
         parameters = model_info.parameters
         max_pd = parameters.max_pd
 
@@ -74,16 +85,21 @@ class CallDetails(object):
         #   num_weights        total length of the weight vector
         #   num_active         number of pd params
         #   theta_par          parameter number for theta parameter
-        self.buffer = np.empty(4*max_pd + 4, 'i4')
+        #   sparse             true if the list of points follows
+        #   points[num_points] positions in the pd mesh if sparse
+        self.buffer = np.empty(4*max_pd + 5 + num_points, 'i4')
 
         # generate views on different parts of the array
         self._pd_par = self.buffer[0 * max_pd:1 * max_pd]
         self._pd_length = self.buffer[1 * max_pd:2 * max_pd]
         self._pd_offset = self.buffer[2 * max_pd:3 * max_pd]
         self._pd_stride = self.buffer[3 * max_pd:4 * max_pd]
+        self._scalars = self.buffer[4 * max_pd:4 * max_pd + 5]
+        self._points = self.buffer[4 * max_pd + 5:]
 
         # theta_par is fixed
         self.theta_par = parameters.theta_offset
+        self.sparse = num_points > 0
 
         # offset and length are for all parameters, not just pd parameters
         # They are not sent to the kernel function, though they could be.
@@ -118,49 +134,86 @@ class CallDetails(object):
 
     @property
     def num_eval(self):
-        """Total size of the pd mesh"""
-        return self.buffer[-4]
+        """Total size of the pd mesh, or the number of points if sparse"""
+        return self._scalars[0]
 
     @num_eval.setter
     def num_eval(self, v):
-        """Total size of the pd mesh"""
-        self.buffer[-4] = v
+        """Total size of the pd mesh, or the number of points if sparse"""
+        self._scalars[0] = v
 
     @property
     def num_weights(self):
         """Total length of all the weight vectors"""
-        return self.buffer[-3]
+        return self._scalars[1]
 
     @num_weights.setter
     def num_weights(self, v):
         """Total length of all the weight vectors"""
-        self.buffer[-3] = v
+        self._scalars[1] = v
 
     @property
     def num_active(self):
         """Number of active polydispersity loops"""
-        return self.buffer[-2]
+        return self._scalars[2]
 
     @num_active.setter
     def num_active(self, v):
         """Number of active polydispersity loops"""
-        self.buffer[-2] = v
+        self._scalars[2] = v
 
     @property
     def theta_par(self):
         """Location of the theta parameter in the parameter vector"""
-        return self.buffer[-1]
+        return self._scalars[3]
 
     @theta_par.setter
     def theta_par(self, v):
         """Location of the theta parameter in the parameter vector"""
-        self.buffer[-1] = v
+        self._scalars[3] = v
+
+    @property
+    def sparse(self):
+        """True if the kernel visits the list of points"""
+        return self._scalars[4] != 0
+
+    @sparse.setter
+    def sparse(self, v):
+        """True if the kernel visits the list of points"""
+        self._scalars[4] = 1 if v else 0
+
+    @property
+    def loop_key(self):
+        """
+        Key *(num_active, theta_loop)* for the kernel specialized for these
+        polydispersity loops (see :func:`generate.specialize`), where
+        *theta_loop* is 0 if theta is not an active loop, 1 if it is the
+        inner loop or 2 if it is an outer loop.
+        """
+        num_active = int(self.num_active)
+        active = list(self.pd_par[:num_active])
+        theta_par = self.theta_par
+        if theta_par < 0 or theta_par not in active:
+            theta_loop = 0
+        elif active[0] == theta_par:
+            theta_loop = 1
+        else:
+            theta_loop = 2
+        return num_active, theta_loop
+
+    @property
+    def points(self):
+        """Positions in the pd mesh of the points to visit if sparse"""
+        return self._points
 
     def show(self, values=None):
         """Print the polydispersity call details to the console"""
         print("===== %s details ===="%self.info.name)
         print("num_active:%d  num_eval:%d  num_weights:%d  theta=%d"
               % (self.num_active, self.num_eval, self.num_weights, self.theta_par))
+        if self.sparse:
+            print("sparse: %d points, %d pruned"
+                  % (self.num_eval, self.num_pruned))
         if self.pd_par.size:
             print("pd_par", self.pd_par)
             print("pd_length", self.pd_length)
@@ -216,9 +269,122 @@ def make_details(model_info, length, offset, num_weights):
     return call_details
 
 
+#: Fraction of the polydispersity mesh which must be removed by the cutoff
+#: before :func:`prune_details` returns a list of points.
+SPARSE_FRACTION = 0.5
+#: Smallest polydispersity mesh for which :func:`prune_details` builds a
+#: list of points.  Smaller meshes are walked by the kernel in less time.
+SPARSE_MIN_POINTS = 1000
+
+def prune_details(call_details, values, cutoff):
+    # type: (CallDetails, np.ndarray, float) -> CallDetails
+    """
+    Return call details which visit only the points in the polydispersity
+    mesh whose weight product is greater than *cutoff*.
+
+    The weights are taken from the kernel *values* vector, and the products
+    are formed in the same order and precision as the kernel, so the kernel
+    sees the same points as it would if it walked the entire mesh.  Points
+    are removed level by level, from the outermost loop inward, using the
+    largest weights in the remaining loops to bound the final product.
+
+    The returned details has *sparse* set and *num_pruned* gives the number
+    of points removed.  If the cutoff removes less than *SPARSE_FRACTION*
+    of the mesh, or removes every point, or the mesh has fewer than
+    *SPARSE_MIN_POINTS* points, then *call_details* is returned unchanged.
+    Before each level is expanded, the number of points which will survive
+    it is counted without forming them, so the search stops as soon as it
+    is clear that too few points will be removed, and the lists it builds
+    are never longer than the list it would return.
+    """
+    num_eval = call_details.num_eval
+    if (call_details.num_active == 0 or num_eval < SPARSE_MIN_POINTS
+            or call_details.sparse):
+        return call_details
+
+    nvalues = call_details.info.parameters.nvalues
+    num_weights = call_details.num_weights
+    pd_weight = values[nvalues + num_weights:nvalues + 2*num_weights]
+    weights = [pd_weight[offset:offset + length] for offset, length
+               in zip(call_details.pd_offset, call_details.pd_length)]
+    max_weight = [w.max() for w in weights]
+    limit = (1. - SPARSE_FRACTION)*num_eval
+
+    points = np.zeros(1, 'i4')
+    partial = np.ones(1, values.dtype)
+    for level in reversed(range(len(weights))):
+        # Kernel loops compute weight[k] = w[k][i] * weight[k+1].
+        w = weights[level]
+        stride = call_details.pd_stride[level]
+        # Each point which survives this level leads to at least one point
+        # in the final list, the one using the largest inner weights, so
+        # give up if too many survive.  The count is only used for this
+        # test, so it can ignore rounding differences in the products.
+        inner_max = np.prod(max_weight[:level])
+        with np.errstate(divide='ignore'):
+            threshold = cutoff/(inner_max*partial)
+        surviving = len(w)*len(partial) - np.sum(
+            np.searchsorted(np.sort(w), threshold, side='right'))
+        if surviving > limit:
+            return call_details
+        partial = (w[None, :] * partial[:, None]).flatten()
+        points = (points[:, None] + stride*np.arange(len(w), dtype='i4')).flatten()
+        bound = partial
+        for inner in reversed(range(level)):
+            bound = max_weight[inner] * bound
+        keep = bound > cutoff
+        partial, points = partial[keep], points[keep]
+        if len(points) > limit:
+            return call_details
+    if len(points) == 0:
+        return call_details
+
+    sparse_details = CallDetails(call_details.info, num_points=len(points))
+    sparse_details.buffer[:-len(points)] = call_details.buffer
+    sparse_details.points[:] = points
+    sparse_details.num_eval = len(points)
+    sparse_details.sparse = True
+    sparse_details.num_pruned = num_eval - len(points)
+    sparse_details.length = call_details.length
+    sparse_details.offset = call_details.offset
+    return sparse_details
+
+
+def count_skipped(call_details, values, cutoff):
+    # type: (CallDetails, np.ndarray, float) -> int
+    """
+    Return the number of points visited by the kernel whose weight product
+    is not greater than *cutoff*, and so are skipped by the kernel.
+
+    This walks the entire mesh in blocks, so it is only used for gathering
+    statistics (see :func:`kernel.enable_stats`).
+    """
+    if call_details.num_active == 0:
+        return 0
+    nvalues = call_details.info.parameters.nvalues
+    num_weights = call_details.num_weights
+    pd_weight = values[nvalues + num_weights:nvalues + 2*num_weights]
+    levels = list(zip(call_details.pd_offset, call_details.pd_length,
+                      call_details.pd_stride))
+    num_eval = call_details.num_eval
+    skipped, block = 0, 1 << 20
+    for start in range(0, num_eval, block):
+        stop = min(start + block, num_eval)
+        if call_details.sparse:
+            index = call_details.points[start:stop]
+        else:
+            index = np.arange(start, stop)
+        # Kernel loops compute weight[k] = w[k][i] * weight[k+1].
+        partial = np.ones(len(index), values.dtype)
+        for offset, length, stride in reversed(levels):
+            partial = pd_weight[offset + (index//stride)%length] * partial
+        skipped += int(np.sum(~(partial > cutoff)))
+    return skipped
+
+
 ZEROS = tuple([0.]*31)
-def make_kernel_args(kernel, pairs):
-    # type: (Kernel, Tuple[List[np.ndarray], List[np.ndarray]]) -> Tuple[CallDetails, np.ndarray, bool]
+def make_kernel_args(kernel, pairs, cutoff=None, reuse=False):
+    # type: (Kernel, Tuple[List[np.ndarray], List[np.ndarray]], float, bool) -> Tuple[CallDetails, np.ndarray, bool]
     """
     Converts (value, weight) pairs into parameters for the kernel call.
 
@@ -226,24 +392,227 @@ def make_kernel_args(kernel, pairs):
     containing the different values, and the magnetic flag indicating whether
     any magnetic magnitudes are non-zero. Magnetic vectors (M0, phi, theta) are
     converted to rectangular coordinates (mx, my, mz).
+
+    If *cutoff* is greater than zero and the kernel can visit a list of
+    points, then the points in the polydispersity mesh with weight below
+    the cutoff are removed before the call (see :func:`prune_details`).
+
+    If *reuse* is True, the values are written into an aligned buffer owned
+    by the kernel, and the call details are reused from a previous call with
+    the same polydispersity lengths (see :class:`KernelArgsCache`).  The
+    returned data is then overwritten by the next call with *reuse*, so the
+    kernel call must complete before the arguments for the next call are
+    built.  Use the default when holding arguments for several calls, such
+    as in :func:`direct_model.call_kernel_batch` or :meth:`Kernel.submit`.
     """
     npars = kernel.info.parameters.npars
     nvalues = kernel.info.parameters.nvalues
     scalars = [(v[0] if len(v) else np.NaN) for v, w in pairs]
     values, weights = zip(*pairs[2:npars+2]) if npars else ((),())
     length = np.array([len(w) for w in weights])
-    offset = np.cumsum(np.hstack((0, length)))
-    call_details = make_details(kernel.info, length, offset[:-1], offset[-1])
     # Pad value array to a 32 value boundaryd
     data_len = nvalues + 2*sum(len(v) for v in values)
     extra = (32 - data_len%32)%32
-    data = np.hstack((scalars,) + values + weights + ZEROS[:extra])
-    data = data.astype(kernel.dtype)
+    if reuse:
+        cache = KernelArgsCache.get(kernel)
+        call_details = cache.details(length)
+        data = cache.values(scalars, values, weights, data_len + extra)
+    else:
+        offset = np.cumsum(np.hstack((0, length)))
+        call_details = make_details(kernel.info, length, offset[:-1],
+                                    offset[-1])
+        data = np.hstack((scalars,) + values + weights + ZEROS[:extra])
+        data = data.astype(kernel.dtype)
     is_magnetic = convert_magnetism(kernel.info.parameters, data)
+    if cutoff and cutoff > 0. and getattr(kernel, 'sparse', False):
+        call_details = prune_details(call_details, data, cutoff)
     #call_details.show()
     return call_details, data, is_magnetic
 
 
+class KernelArgsCache(object):
+    """
+    Value buffer and call details kept by a kernel between calls to
+    :func:`make_kernel_args` with *reuse=True*.
+
+    The value buffer is aligned with :func:`alignment.align_empty` and grows
+    by doubling when a call needs more room, so repeated calls do not
+    allocate.  The call details are keyed by the polydispersity lengths,
+    which determine the offsets and the loop order, so they are rebuilt
+    only when the lengths change.  Use :meth:`get` to retrieve the cache
+    for a kernel, creating it on first use.
+    """
+    #: Maximum number of polydispersity signatures to keep.
+    max_details = 16
+
+    def __init__(self, kernel):
+        # type: (Kernel) -> None
+        self.info = kernel.info
+        self.dtype = np.dtype(kernel.dtype)
+        self._buffer = align_empty(0, self.dtype)
+        self._details = {}  # type: Dict[Tuple[int, ...], CallDetails]
+
+    @classmethod
+    def get(cls, kernel):
+        # type: (Kernel) -> "KernelArgsCache"
+        """
+        Return the cache attached to *kernel*, creating it if needed.
+        """
+        cache = getattr(kernel, '_args_cache', None)
+        if cache is None or cache.dtype != np.dtype(kernel.dtype):
+            cache = cls(kernel)
+            kernel._args_cache = cache
+        return cache
+
+    def details(self, length):
+        # type: (np.ndarray) -> CallDetails
+        """
+        Return call details for polydispersity *length*, reusing the
+        details from a previous call with the same lengths.
+        """
+        key = tuple(length.tolist())
+        call_details = self._details.get(key, None)
+        if call_details is None:
+            offset = np.cumsum(np.hstack((0, length)))
+            call_details = make_details(self.info, length, offset[:-1],
+                                        offset[-1])
+            if len(self._details) >= self.max_details:
+                self._details.clear()
+            self._details[key] = call_details
+        return call_details
+
+    def values(self, scalars, values, weights, size):
+        # type: (List[float], Sequence[np.ndarray], Sequence[np.ndarray], int) -> np.ndarray
+        """
+        Write *scalars*, the pd *values* and the pd *weights* into the
+        buffer, zero fill up to *size*, and return the buffer view.
+        """
+        if self._buffer.size < size:
+            self._buffer = align_empty(max(size, 2*self._buffer.size),
+                                       self.dtype)
+        data = self._buffer[:size]
+        end = len(scalars)
+        data[:end] = scalars
+        for part in values + weights:
+            start, end = end, end + len(part)
+            data[start:end] = part
+        data[end:] = 0.
+        return data
+
+
+class PackedLayout(object):
+    """
+    Precomputed layout for calling *kernel* without polydispersity from a
+    packed vector of parameter values.
+
+    *names* lists the parameters in the packed vector, in order.  It
+    defaults to every parameter in the kernel value vector, starting with
+    scale and background, which is also available as *layout.names*.
+    Parameters not in *names* take their values from *pars*, or from the
+    parameter default if they are not in *pars* either.
+
+    :meth:`kernel_args` takes the packed values as a flat float64 vector or
+    as a structured array record with a field for each name.  It writes
+    them into a value buffer which is allocated once, and returns the same
+    call details each time, so the call does not look up parameter names
+    or allocate arrays.  Use this in place of :func:`make_kernel_args` in
+    interactive updates and fit loops when nothing is polydisperse.  Since
+    the buffer is reused, each kernel call must complete before the next
+    call to :meth:`kernel_args`.
+    """
+    def __init__(self, kernel, names=None, pars=None):
+        # type: (Kernel, Sequence[str], Dict[str, float]) -> None
+        parameters = kernel.info.parameters
+        call_parameters = parameters.call_parameters
+        pars = {} if pars is None else pars
+        position = dict((p.name, k) for k, p in enumerate(call_parameters))
+        if names is None:
+            names = [p.name for p in call_parameters]
+        unknown = [name for name in names if name not in position]
+        if unknown:
+            raise ValueError("unknown parameters %s for %s"
+                             % (", ".join(unknown), kernel.info.name))
+        self.names = tuple(names)
+        self.index = np.array([position[name] for name in names], 'i')
+
+        npars = parameters.npars
+        nvalues = parameters.nvalues
+        self._npars = npars
+        self._nvalues = nvalues
+        self._parameters = parameters
+        # Value vector: fixed values, one pd value and one weight of 1.0
+        # for each parameter, padded to a 32 value boundary.
+        data_len = nvalues + 2*npars
+        self.values = np.zeros(data_len + (32 - data_len%32)%32, kernel.dtype)
+        self.values[nvalues+npars:nvalues+2*npars] = 1.0
+        self._template = np.array([pars.get(p.name, p.default)
+                                   for p in call_parameters], kernel.dtype)
+        # Magnetic values are converted in place, so reset them each call.
+        self._reset = parameters.nmagnetic > 0 or len(names) < nvalues
+        self.values[:nvalues] = self._template
+        self.call_details = make_details(kernel.info, np.ones(npars, 'i'),
+                                         np.arange(npars), npars)
+        self._packed = np.empty(len(names), 'd')
+        self._field_index = {}  # type: Dict[np.dtype, np.ndarray]
+
+    def pack(self, pars):
+        # type: (Dict[str, float]) -> np.ndarray
+        """
+        Return the packed vector for the parameter values in *pars*, using
+        the values given to the layout for the parameters not in *pars*.
+        """
+        template = self._template
+        return np.array([pars.get(name, template[k])
+                         for name, k in zip(self.names, self.index)], 'd')
+
+    def kernel_args(self, packed):
+        # type: (np.ndarray) -> Tuple[CallDetails, np.ndarray, bool]
+        """
+        Returns the call details, the value vector and the magnetic flag
+        for the kernel call with the *packed* parameter values.
+        """
+        packed = np.asarray(packed)
+        if packed.dtype.names is not None:
+            packed = self._unpack_record(packed)
+        values = self.values
+        if self._reset:
+            values[:self._nvalues] = self._template
+        values[self.index] = packed
+        npars, nvalues = self._npars, self._nvalues
+        values[nvalues:nvalues+npars] = values[2:npars+2]
+        is_magnetic = (self._parameters.nmagnetic > 0
+                       and convert_magnetism(self._parameters, values))
+        return self.call_details, values, is_magnetic
+
+    def _unpack_record(self, record):
+        # type: (np.ndarray) -> np.ndarray
+        """
+        Copy the fields of the structured array *record* into a vector in
+        the order of *names*.
+        """
+        index = self._field_index.get(record.dtype, None)
+        if index is None:
+            fields = record.dtype.fields
+            missing = [name for name in self.names if name not in fields]
+            if missing:
+                raise ValueError("record is missing %s" % ", ".join(missing))
+            if (all(fields[name][0] == np.float64
+                    and fields[name][1]%8 == 0 for name in self.names)
+                    and record.dtype.itemsize%8 == 0):
+                index = np.array([fields[name][1]//8 for name in self.names])
+            else:
+                index = False
+            self._field_index[record.dtype] = index
+        if index is False:
+            # Fields are not all aligned float64 values, so copy each one.
+            for k, name in enumerate(self.names):
+                self._packed[k] = record[name]
+        else:
+            flat = np.ascontiguousarray(record).reshape(1).view(np.float64)
+            np.take(flat, index, out=self._packed)
+        return self._packed
+
+
 def convert_magnetism(parameters, values):
     """
     Convert magnetism values from polar to rectangular coordinates.
@@ -289,3 +658,89 @@ def dispersion_mesh(model_info, pars):
             offset += n
         value = pars
     return value, weight
+
+
+def test_prune_details():
+    # type: () -> None
+    """
+    Check that pruning the polydispersity mesh does not change the result,
+    and that meshes which cannot be pruned enough are left alone.
+    """
+    from .direct_model import _test_kernel, _kernel_args
+
+    _, kernel = _test_kernel(is_2d=True)
+    pars = dict(radius=30, radius_pd=0.2, radius_pd_n=15,
+                length=100, length_pd=0.3, length_pd_n=15,
+                theta=20, theta_pd=10, theta_pd_n=15,
+                phi=30, phi_pd=10, phi_pd_n=15)
+    cutoff = 1e-5
+    call_details, values, magnetic = _kernel_args(kernel, pars, False)
+    target = kernel(call_details, values, cutoff, magnetic)
+    sparse_details = prune_details(call_details, values, cutoff)
+    assert sparse_details.sparse
+    assert (sparse_details.num_pruned
+            == count_skipped(call_details, values, cutoff) > 0)
+    actual = kernel(sparse_details, values, cutoff, magnetic)
+    assert np.allclose(actual, target, rtol=1e-12), \
+        "sparse: expected %s but got %s"%(target, actual)
+
+    # Too few points are removed by a tiny cutoff.
+    assert prune_details(call_details, values, 1e-30) is call_details
+    # Small meshes are not pruned.
+    pars = dict(radius_pd=0.2, radius_pd_n=15, length_pd=0.3, length_pd_n=15)
+    call_details, values, _ = _kernel_args(kernel, pars, False)
+    assert call_details.num_eval < SPARSE_MIN_POINTS
+    assert prune_details(call_details, values, cutoff) is call_details
+
+def test_packed_layout():
+    # type: () -> None
+    """
+    Check that the packed parameter fast path matches call_kernel.
+    """
+    from .direct_model import _test_kernel, call_kernel, call_kernel_packed
+
+    _, kernel = _test_kernel()
+    layout = PackedLayout(kernel, names=['radius', 'length', 'scale'],
+                          pars=dict(background=0.5))
+    for radius, length in [(20., 400.), (30., 100.), (40., 40.)]:
+        pars = dict(radius=radius, length=length, scale=2., background=0.5)
+        target = call_kernel(kernel, pars, mono=True)
+        actual = call_kernel_packed(kernel, layout, [radius, length, 2.])
+        assert np.allclose(actual, target, rtol=1e-12), \
+            "packed: expected %s but got %s"%(target, actual)
+    record = np.array((2., 30., 100.), dtype=[
+        ('scale', 'd'), ('radius', 'd'), ('length', 'd')])
+    actual = call_kernel_packed(kernel, layout, record)
+    target = call_kernel(kernel, dict(radius=30., length=100., scale=2.,
+                                      background=0.5), mono=True)
+    assert np.allclose(actual, target, rtol=1e-12), \
+        "record: expected %s but got %s"%(target, actual)
+
+def test_kernel_args_cache():
+    # type: () -> None
+    """
+    Check that reusing the kernel value buffer and call details matches
+    freshly built arguments.
+    """
+    from .direct_model import _test_kernel, _kernel_args
+
+    _, kernel = _test_kernel()
+    pars = dict(radius=30, radius_pd=0.1, radius_pd_n=35,
+                length=100, length_pd=0.1, length_pd_n=25)
+    _, values, _ = _kernel_args(kernel, pars, False, reuse=True)
+    pars.update(length_pd_n=15)
+    details, _, _ = _kernel_args(kernel, pars, False, reuse=True)
+    for radius, length_pd_n in [(20., 15), (40., 25), (30., 15)]:
+        pars.update(radius=radius, length_pd_n=length_pd_n)
+        target = _kernel_args(kernel, pars, False)
+        actual = _kernel_args(kernel, pars, False, reuse=True)
+        assert np.array_equal(actual[1], target[1])
+        assert np.array_equal(actual[0].buffer, target[0].buffer)
+        assert (actual[0] is details) == (length_pd_n == 15)
+        # The buffer was sized by the first call, so it is not reallocated.
+        assert actual[1].base is values.base
+        assert actual[1].ctypes.data % 128 == 0
+        Iq_target = kernel(target[0], target[1], cutoff=0., magnetic=False)
+        Iq_actual = kernel(actual[0], actual[1], cutoff=0., magnetic=False)
+        assert np.allclose(Iq_actual, Iq_target, rtol=1e-12), \
+            "reuse: expected %s but got %s"%(Iq_target, Iq_actual)
@@ -32,11 +32,12 @@ from . import resolution2d
 from .details import make_kernel_args, dispersion_mesh
 
 try:
-    from typing import Optional, Dict, Tuple
+    from typing import Optional, Dict, Tuple, List, Any
 except ImportError:
     pass
 else:
     from .data import Data
+    from .details import CallDetails, PackedLayout
     from .kernel import Kernel, KernelModel
     from .modelinfo import Parameter, ParameterSet
 
@@ -54,6 +55,60 @@ def call_kernel(calculator, pars, cutoff=0., mono=False):
 
     *mono* is True if polydispersity should be set to none on all parameters.
     """
+    call_details, values, is_magnetic = _kernel_args(calculator, pars, mono,
+                                                     cutoff=cutoff)
+    #print("values:", values)
+    return calculator(call_details, values, cutoff, is_magnetic)
+
+
+def call_kernel_packed(calculator, layout, packed, cutoff=0.):
+    # type: (Kernel, PackedLayout, np.ndarray, float) -> np.ndarray
+    """
+    Call *kernel* without polydispersity for the parameter values in the
+    vector *packed*, whose order is given by *layout*.
+
+    *layout* is a :class:`details.PackedLayout` built once for the kernel,
+    so that repeated calls do not need to look up the parameters by name
+    or allocate a new value vector.  *packed* may also be a structured
+    array record with the parameter names as fields.  This gives the same
+    result as :func:`call_kernel` with *mono=True*.
+    """
+    call_details, values, is_magnetic = layout.kernel_args(packed)
+    return calculator(call_details, values, cutoff, is_magnetic)
+
+
+def call_kernel_batch(calculator, pars_list, cutoff=0., mono=False):
+    # type: (Kernel, List[ParameterSet], float, bool) -> np.ndarray
+    """
+    Call *kernel* for each parameter set in *pars_list*.
+
+    Returns an array of shape (len(pars_list), nq).  This is equivalent to
+    calling :func:`call_kernel` for each parameter set, but the whole batch
+    is evaluated in a single kernel call where the kernel supports it.
+    Population based fitters and finite difference derivatives can use this
+    to evaluate many parameter sets at the same q values.
+
+    See :func:`call_kernel` for a description of *cutoff* and *mono*.
+    """
+    args = [_kernel_args(calculator, pars, mono) for pars in pars_list]
+    call_details, values, is_magnetic = zip(*args)
+    if any(is_magnetic) and not all(is_magnetic):
+        # Magnetic and non-magnetic parameter sets use different kernels.
+        return np.vstack([calculator(details, block, cutoff, magnetic)
+                          for details, block, magnetic in args])
+    return calculator.call_batch(call_details, values, cutoff,
+                                 is_magnetic[0])
+
+
+def _kernel_args(calculator, pars, mono, cutoff=None, reuse=False):
+    # type: (Kernel, ParameterSet, bool, float, bool) -> Tuple[CallDetails, np.ndarray, bool]
+    """
+    Convert *pars* into the call details, value vector and magnetic flag
+    needed to call *calculator*.  If *cutoff* is given, the points in the
+    polydispersity mesh below the cutoff are pruned from the call details.
+    If *reuse* is True, the value buffer and call details held by the
+    kernel are reused (see :func:`details.make_kernel_args`).
+    """
     parameters = calculator.info.parameters
     if mono:
         active = lambda name: False
@@ -69,9 +124,7 @@ def call_kernel(calculator, pars, cutoff=0., mono=False):
                  else ([pars.get(p.name, p.default)], [1.0]))
                 for p in parameters.call_parameters]
 
-    call_details, values, is_magnetic = make_kernel_args(calculator, vw_pairs)
-    #print("values:", values)
-    return calculator(call_details, values, cutoff, is_magnetic)
+    return make_kernel_args(calculator, vw_pairs, cutoff=cutoff, reuse=reuse)
 
 
 def call_ER(model_info, pars):
@@ -178,6 +231,9 @@ class DataMixin(object):
     such as *data_type* and *resolution*.
 
     :meth:`_calc_theory` evaluates the model at the given control values.
+    The normalized theory before scale and background are applied is kept
+    for the most recent set of the remaining parameters, so changes to
+    only scale and background do not need to evaluate the kernel.
 
     :meth:`_set_data` sets the intensity data in the data object,
     possibly with random noise added.  This is useful for simulating a
@@ -280,6 +336,7 @@ class DataMixin(object):
         self._kernel_inputs = q_vectors
         self._kernel_mono_inputs = q_mono
         self._kernel = None
+        self._unscaled = {}  # type: Dict[bool, Tuple[Any, np.ndarray]]
         self.Iq, self.dIq, self.index = Iq, dIq, index
         self.resolution = res
 
@@ -320,14 +377,17 @@ class DataMixin(object):
                 self._model.make_kernel(self._kernel_mono_inputs)
                 if self._kernel_mono_inputs else None)
 
-        Iq_calc = call_kernel(self._kernel, pars, cutoff=cutoff)
+        scale, background = [
+            float(pars.get(p.name, p.default))
+            for p in self._model.info.parameters.call_parameters[:2]]
+        Iq_calc = scale*self._unscaled_theory(pars, cutoff, False) + background
         # Storing the calculated Iq values so that they can be plotted.
         # Only applies to oriented USANS data for now.
         # TODO: extend plotting of calculate Iq to other measurement types
         # TODO: refactor so we don't store the result in the model
         self.Iq_calc = Iq_calc
         if self.data_type == 'sesans':
-            Iq_mono = (call_kernel(self._kernel_mono, pars, mono=True)
+            Iq_mono = (scale*self._unscaled_theory(pars, 0., True) + background
                        if self._kernel_mono_inputs else None)
             result = sesans.transform(self._data,
                                       self._kernel_inputs[0], Iq_calc,
@@ -341,6 +401,27 @@ class DataMixin(object):
                 )
         return result
 
+    def _unscaled_theory(self, pars, cutoff, mono):
+        # type: (ParameterSet, float, bool) -> np.ndarray
+        """
+        Return the theory with scale=1 and background=0, reusing the
+        previous value if only scale and background have changed.
+        """
+        # pylint: disable=attribute-defined-outside-init
+        linear = [p.name for p in self._model.info.parameters.call_parameters[:2]]
+        key = (cutoff, sorted((k, v) for k, v in pars.items()
+                              if k not in linear))
+        # CRUFT: objects pickled before the cache was added
+        cache = self.__dict__.setdefault('_unscaled', {})
+        if mono not in cache or cache[mono][0] != key:
+            kernel = self._kernel_mono if mono else self._kernel
+            call_details, values, is_magnetic = _kernel_args(
+                kernel, pars, mono, cutoff=cutoff, reuse=True)
+            total, pd_norm = kernel.call_parts(
+                call_details, values, cutoff, is_magnetic)
+            cache[mono] = (key, total/(pd_norm if pd_norm != 0.0 else 1.0))
+        return cache[mono][1]
+
 
 class DirectModel(DataMixin):
     """
@@ -378,6 +459,41 @@ class DirectModel(DataMixin):
         """
         return call_profile(self.model.info, **pars)
 
+def _test_kernel(model_name='cylinder', nq=20, is_2d=False):
+    # type: (str, int, bool) -> Tuple[KernelModel, Kernel]
+    """
+    Return the dll model for *model_name* and a kernel for *nq* points in q,
+    for use in the unit tests.  With *is_2d*, the kernel is evaluated along
+    the line qy = qx/2.
+    """
+    from .core import load_model_info, build_model
+
+    model = build_model(load_model_info(model_name), platform='dll')
+    q = np.linspace(0.001, 0.5, nq)
+    kernel = model.make_kernel([q, 0.5*q] if is_2d else [q])
+    return model, kernel
+
+def test_unscaled_theory():
+    # type: () -> None
+    """
+    Check that changing scale and background reuses the kernel result.
+    """
+    from .data import empty_data1D
+
+    model, kernel = _test_kernel()
+    calculator = DirectModel(empty_data1D(kernel.q_input.q), model)
+    pars = dict(radius=30, radius_pd=0.1, radius_pd_n=35)
+    calculator(**pars)
+    unscaled = calculator._unscaled[False][1]
+    pars.update(scale=3., background=0.5)
+    actual = calculator(**pars)
+    assert calculator._unscaled[False][1] is unscaled
+    target = call_kernel(calculator._kernel, pars, cutoff=calculator.cutoff)
+    assert np.allclose(actual, target, rtol=1e-12), \
+        "scaled: expected %s but got %s"%(target, actual)
+    calculator(**dict(pars, radius=40))
+    assert calculator._unscaled[False][1] is not unscaled
+
 def main():
     # type: () -> None
     """
@@ -16,6 +16,23 @@ Small angle scattering models are defined by a set of kernel functions:
     *form_volume(p1, p2, ...)* returns the volume of the form with particular
     dimension, or 1.0 if no volume normalization is required.
 
+    *setup(scratch, p1, p2, ...)* optionally fills *scratch* with values
+    which depend on the parameters but not on q.  If it is defined, it is
+    called once for each point in the polydispersity loop before the loop
+    over q, and *scratch* is passed to *Iq* and *Iqxy* after the q values,
+    as in *Iq(q, scratch, p1, p2, ...)*.  *scratch* holds *SCRATCH_SIZE*
+    values.  In the magnetic kernel, where the slds vary with q, *setup*
+    is called before each call to *Iqxy*.
+
+    *Iqxy(qx, qy, rotation, p1, p2, ...)* may instead take a pointer to a
+    *QACRotation* after the q values.  The kernel then computes the rotation
+    for the orientation parameters *theta*, *phi* and *psi* once for each
+    point in the polydispersity loop, and the model uses *QAC_SYMMETRIC* or
+    *QAC_ASYMMETRIC* in place of *ORIENT_SYMMETRIC* or *ORIENT_ASYMMETRIC*
+    to project q into the particle frame without recomputing the sines and
+    cosines of the angles for each q.  The rotation is passed before the
+    scratch block if the model also defines *setup*.
+
     *ER(p1, p2, ...)* returns the effective radius of the form with
     particular dimensions.
 
@@ -115,6 +132,10 @@ The kernel module must set variables defining the kernel meta data:
     kernel is passed the entire *q* vector at once, otherwise it is
     passed values one *q* at a time.  The performance improvement of
     this step is significant.
+    If they are also marked as *Iq.pd_vectorized = True* then the
+    parameters may be passed as columns, with one row for each point
+    in the polydispersity mesh, and the kernel returns one row of I(q)
+    for each point.  *form_volume* must also accept columns in this case.
 
     *demo* is a dictionary of parameter=value defining a set of
     parameters to use by default when *compare* is called.  Any
@@ -369,6 +390,10 @@ def tag_source(source):
     Return a unique tag for the source code.
     """
     # Note: need 0xffffffff&val to force an unsigned 32-bit number
+    try:
+        source = source.encode('utf8')
+    except AttributeError: # bytes has no encode attribute in python 3
+        pass
     return "%08X"%(0xffffffff&crc32(source))
 
 def convert_type(source, dtype):
@@ -562,11 +587,33 @@ def kernel_name(model_info, variant):
     """
     Name of the exported kernel symbol.
 
-    *variant* is "Iq", "Iqxy" or "Imagnetic".
+    *variant* is "Iq", "Iqxy" or "Imagnetic", or one of these with a
+    "_batch" suffix for the kernel which evaluates many parameter sets
+    in a single call.
     """
     return model_info.name + "_" + variant
 
 
+def specialize(source, key):
+    # type: (str, Tuple[int, int]) -> str
+    """
+    Return kernel *source* specialized for the calls whose polydispersity
+    loops match *key*, as returned by :attr:`details.CallDetails.loop_key`.
+
+    The key is *(num_loops, theta_loop)*, where *num_loops* is the number
+    of active polydispersity loops and *theta_loop* is 0 if theta is not
+    one of them, 1 if it is the inner loop or 2 if it is an outer loop.
+    The specialized kernel only walks *num_loops* loops, and with no loops
+    it evaluates the single parameter set without the loop bookkeeping.
+    """
+    num_loops, theta_loop = key
+    return "\n".join((
+        "#define PD_LOOPS %d" % num_loops,
+        "#define PD_THETA %d" % theta_loop,
+        source,
+        ))
+
+
 def indent(s, depth):
     # type: (str, int) -> str
     """
@@ -625,6 +672,30 @@ def _call_pars(prefix, pars):
     return [p.as_call_reference(prefix) for p in pars]
 
 
+#: Number of values in the scratch block filled by the model setup function.
+SCRATCH_SIZE = 32
+
+_SETUP_PATTERN = re.compile("^((inline|static) )? *void +setup *([(]|$)",
+                            flags=re.MULTILINE)
+def _have_setup(sources):
+    # type: (List[str]) -> bool
+    """
+    Return true if any file defines setup.
+
+    This is subject to the same limitations as :func:`_have_Iqxy`.
+    """
+    return any(_SETUP_PATTERN.search(code) for path, code in sources)
+
+_ROTATION_PATTERN = re.compile(
+    r"\bIqxy\s*\(\s*double\s+qx\s*,\s*double\s+qy\s*,\s*const\s+QACRotation\b")
+def _have_rotation(sources):
+    # type: (List[str]) -> bool
+    """
+    Return true if any file defines Iqxy taking the orientation as a
+    precomputed *QACRotation*.
+    """
+    return any(_ROTATION_PATTERN.search(code) for path, code in sources)
+
 # type in IQXY pattern could be single, float, double, long double, ...
 _IQXY_PATTERN = re.compile("^((inline|static) )? *([a-z ]+ )? *Iqxy *([(]|$)",
                            flags=re.MULTILINE)
@@ -729,18 +800,39 @@ def make_source(model_info):
         call_volume = "#define CALL_VOLUME(v) 1.0"
     source.append(call_volume)
 
-    refs = ["_q[_i]"] + _call_pars("_v.", partable.iq_parameters)
-    call_iq = "#define CALL_IQ(_q,_i,_v) Iq(%s)" % (",".join(refs))
-    if _have_Iqxy(user_code) or isinstance(model_info.Iqxy, str):
+    # Models with a setup function receive the scratch block after q.
+    if _have_setup(user_code):
+        scratch = ["_s"]
+        refs = scratch + _call_pars("_v.", partable.iq_parameters)
+        source.append("#define SCRATCH_SIZE %d" % SCRATCH_SIZE)
+        source.append("#define CALL_SETUP(_s,_v) setup(%s)" % (",".join(refs)))
+    else:
+        scratch = []
+
+    refs = ["_q[_i]"] + scratch + _call_pars("_v.", partable.iq_parameters)
+    call_iq = "#define CALL_IQ(_q,_i,_v,_s,_r) Iq(%s)" % (",".join(refs))
+    if _have_rotation(user_code):
+        # Call 2D model with the rotation computed once per orientation
+        names = set(p.name for p in partable.kernel_parameters)
+        angles = [("_v."+name if name in names else "0.0")
+                  for name in ("theta", "phi", "psi")]
+        refs = (["_q[2*_i]", "_q[2*_i+1]", "&_r"] + scratch
+                + _call_pars("_v.", partable.iqxy_parameters))
+        call_iqxy = "\n".join((
+            "#define CALL_IQ(_q,_i,_v,_s,_r) Iqxy(%s)" % (",".join(refs)),
+            "#define CALL_ROTATION(_r,_v) qac_rotation(&_r,%s)" % (",".join(angles)),
+            ))
+    elif _have_Iqxy(user_code) or isinstance(model_info.Iqxy, str):
         # Call 2D model
-        refs = ["_q[2*_i]", "_q[2*_i+1]"] + _call_pars("_v.", partable.iqxy_parameters)
-        call_iqxy = "#define CALL_IQ(_q,_i,_v) Iqxy(%s)" % (",".join(refs))
+        refs = (["_q[2*_i]", "_q[2*_i+1]"] + scratch
+                + _call_pars("_v.", partable.iqxy_parameters))
+        call_iqxy = "#define CALL_IQ(_q,_i,_v,_s,_r) Iqxy(%s)" % (",".join(refs))
     else:
         # Call 1D model with sqrt(qx^2 + qy^2)
         #warnings.warn("Creating Iqxy = Iq(sqrt(qx^2 + qy^2))")
         # still defined:: refs = ["q[i]"] + _call_pars("v", iq_parameters)
         pars_sqrt = ["sqrt(_q[2*_i]*_q[2*_i]+_q[2*_i+1]*_q[2*_i+1])"] + refs[1:]
-        call_iqxy = "#define CALL_IQ(_q,_i,_v) Iq(%s)" % (",".join(pars_sqrt))
+        call_iqxy = "#define CALL_IQ(_q,_i,_v,_s,_r) Iq(%s)" % (",".join(pars_sqrt))
 
     magpars = [k-2 for k, p in enumerate(partable.call_parameters)
                if p.type == 'sld']
@@ -773,32 +865,40 @@ def kernels(kernel, call_iq, call_iqxy, name):
     iq = [
         # define the Iq kernel
         "#define KERNEL_NAME %s_Iq" % name,
+        "#define BATCH_KERNEL_NAME %s_Iq_batch" % name,
         call_iq,
         '#line 1 "%s Iq"' % path,
         code,
         "#undef CALL_IQ",
+        "#undef BATCH_KERNEL_NAME",
         "#undef KERNEL_NAME",
         ]
 
     iqxy = [
         # define the Iqxy kernel from the same source with different #defines
         "#define KERNEL_NAME %s_Iqxy" % name,
+        "#define BATCH_KERNEL_NAME %s_Iqxy_batch" % name,
         call_iqxy,
         '#line 1 "%s Iqxy"' % path,
         code,
         "#undef CALL_IQ",
+        "#undef CALL_ROTATION",
+        "#undef BATCH_KERNEL_NAME",
         "#undef KERNEL_NAME",
     ]
 
     imagnetic = [
         # define the Imagnetic kernel
         "#define KERNEL_NAME %s_Imagnetic" % name,
+        "#define BATCH_KERNEL_NAME %s_Imagnetic_batch" % name,
         "#define MAGNETIC 1",
         call_iqxy,
         '#line 1 "%s Imagnetic"' % path,
         code,
         "#undef MAGNETIC",
         "#undef CALL_IQ",
+        "#undef CALL_ROTATION",
+        "#undef BATCH_KERNEL_NAME",
         "#undef KERNEL_NAME",
     ]
 
@@ -949,6 +1049,44 @@ def demo_time():
     print("time: %g"%toc)
 
 
+def test_rotation():
+    # type: () -> None
+    """
+    Check that models computing the rotation once per orientation match
+    the values from the per-q rotation, including orientation dispersity.
+    """
+    import numpy as np
+    from .core import load_model
+    from .direct_model import call_kernel
+
+    qx = np.array([0.01, -0.05, 0.1, 0.2])
+    qy = np.array([0.02, 0.03, -0.07, 0.15])
+    cases = [
+        ('cylinder',
+         dict(theta=60., phi=30., theta_pd=10., theta_pd_n=5,
+              phi_pd=10., phi_pd_n=5),
+         [13.27627858, 16.85379987, 0.9499006149, 0.01935752572]),
+        ('parallelepiped',
+         dict(theta=60., phi=30., psi=20., psi_pd=10., psi_pd_n=5,
+              theta_pd=10., theta_pd_n=5),
+         [12.88677676, 7.521548415, 0.2415102596, 0.03575494988]),
+        ('triaxial_ellipsoid',
+         dict(theta=45., phi=120., psi=-30., phi_pd=15., phi_pd_n=5),
+         [32.05435167, 0.4776114131, 0.4078098753, 0.001052254934]),
+        ('core_shell_bicelle_elliptical',
+         dict(theta=20., phi=80., psi=40.),
+         [208.3289315, 9.81591667, 2.40024726, 0.1623182381]),
+        ('bcc_paracrystal',
+         dict(theta=30., phi=50., psi=70.),
+         [0.001896248217, 0.002845112088, 0.02940591921, 0.005456981314]),
+    ]
+    for name, pars, target in cases:
+        model = load_model(name, dtype='double', platform='dll')
+        actual = call_kernel(model.make_kernel([qx, qy]), pars)
+        assert np.allclose(actual, target, rtol=1e-8, atol=0), \
+            "%s: expected %s but got %s"%(name, target, actual)
+
+
 def main():
     # type: () -> None
     """
@@ -7,14 +7,44 @@ In particular, each model should provide a :meth:`KernelModel.make_kernel`
 call which returns an executable kernel, :class:`Kernel`, that operates
 on the given set of *q_vector* inputs.  On completion of the computation,
 the kernel should be released, which also releases the inputs.
+
+Kernels may be called from multiple threads at the same time.  The
+compiled kernels allocate the result for each call, so calls to the
+same kernel can run concurrently; calls which share buffers on the
+OpenCL device, or the parameter vector of a python kernel, are run one
+at a time.  The *results* attribute of composite kernels such as
+P(Q)*S(Q) holds the intermediate results from the most recent call, so
+callers which need them should not share the kernel between threads.
+Making and releasing kernels, and loading and releasing models, is not
+thread safe.
+
+:meth:`Kernel.submit` starts a kernel call and returns a
+:class:`KernelFuture` without waiting for the result, so that the caller
+can do other work, such as starting other kernels, while it runs.  OpenCL
+kernels each have their own command queue so that calls to different
+kernels can run on the device at the same time.  Other kernels complete
+the call before returning.
+
+Kernel calls can record performance counters.  Use :func:`enable_stats` to
+start recording, which returns a :class:`KernelStats` object accumulating
+the counters for each model, and :func:`disable_stats` to stop.  The
+counters are only gathered while recording, so the cost is negligible
+otherwise.  Pass *hook=log_stats* to :func:`enable_stats` to log the
+counters for each call.
 """
 
 from __future__ import division, print_function
 
+import time
+import logging
+import threading
+
 import numpy as np
 
+from .details import count_skipped
+
 try:
-    from typing import List
+    from typing import List, Tuple, Dict, Callable, Optional
 except ImportError:
     pass
 else:
@@ -39,11 +69,327 @@ class Kernel(object):
     info = None  # type: ModelInfo
     results = None # type: List[np.ndarray]
     dtype = None  # type: np.dtype
+    #: True if the kernel can visit a list of points in the polydispersity
+    #: mesh rather than the entire mesh (see :func:`details.prune_details`)
+    sparse = False
 
     def __call__(self, call_details, values, cutoff, magnetic):
         # type: (CallDetails, np.ndarray, np.ndarray, float, bool) -> np.ndarray
         raise NotImplementedError("need to implement __call__")
 
+    def call_parts(self, call_details, values, cutoff, magnetic):
+        # type: (CallDetails, np.ndarray, float, bool) -> Tuple[np.ndarray, float]
+        r"""
+        Evaluate the kernel without applying scale and background.
+
+        Returns the unnormalized sum over the polydispersity mesh, *total*,
+        and the normalization, *pd_norm*, such that the kernel returns
+        *scale\*total/pd_norm + background*.  Since *scale* and *background*
+        are not used otherwise, callers can keep the parts and reuse them
+        when only *scale* and *background* change.
+
+        This default implementation calls the kernel with *scale=1* and
+        *background=0*, returning a normalization of one.
+        """
+        values = np.array(values)
+        values[0:2] = [1., 0.]
+        return self(call_details, values, cutoff, magnetic), 1.0
+
+    def call_batch(self, call_details, values, cutoff, magnetic):
+        # type: (List[CallDetails], List[np.ndarray], float, bool) -> np.ndarray
+        """
+        Evaluate the kernel for a batch of parameter sets at the same q.
+
+        *call_details* and *values* are sequences with one entry for each
+        parameter set, such as those returned from
+        :func:`details.make_kernel_args`.  All sets use the same *cutoff*
+        and *magnetic* flag.  Returns an array of shape (len(values), nq).
+
+        This default implementation calls the kernel once for each set.
+        Kernels which can evaluate the entire batch in one call, keeping
+        the q vectors in place, should override it, calling this version
+        for batches containing sparse details.
+        """
+        return np.vstack([self(details, block, cutoff, magnetic)
+                          for details, block in zip(call_details, values)])
+
+    def submit(self, call_details, values, cutoff, magnetic):
+        # type: (CallDetails, np.ndarray, float, bool) -> "KernelFuture"
+        """
+        Start evaluating the kernel, returning a :class:`KernelFuture`
+        whose *result()* is the value of *kernel(call_details, values, ...)*.
+
+        *values* should not be modified until the result is available.
+
+        This default implementation evaluates the kernel before returning.
+        """
+        return KernelFuture(self(call_details, values, cutoff, magnetic))
+
     def release(self):
         # type: () -> None
         pass
+
+    def _record_call(self, stats, nq, call_details, values, cutoff, **counters):
+        # type: (KernelStats, int, CallDetails, np.ndarray, float, **float) -> None
+        """
+        Record the counters for a call with *call_details* and *values* in
+        *stats*, along with any kernel specific *counters*.
+        """
+        skipped = stats.skipped(call_details, values, cutoff)
+        stats.record(self.info.name, nq=nq, pd_points=call_details.num_eval,
+                     pd_skipped=skipped, **counters)
+
+    def _record_batch(self, stats, nq, call_details, values, cutoff, **counters):
+        # type: (KernelStats, int, List[CallDetails], List[np.ndarray], float, **float) -> None
+        """
+        Record the counters for a call with a batch of parameter sets as a
+        single call evaluating *nq* points for each set.
+        """
+        skipped = sum(stats.skipped(details, v, cutoff)
+                      for details, v in zip(call_details, values))
+        stats.record(self.info.name, nq=nq*len(values),
+                     pd_points=sum(details.num_eval for details in call_details),
+                     pd_skipped=skipped, **counters)
+
+class KernelFuture(object):
+    """
+    Handle for a kernel call started with :meth:`Kernel.submit`.
+
+    *value* is the result of a call which has already completed.
+    """
+    def __init__(self, value):
+        # type: (np.ndarray) -> None
+        self._value = value
+
+    def done(self):
+        # type: () -> bool
+        """
+        Return True if the result is available without waiting.
+        """
+        return True
+
+    def result(self):
+        # type: () -> np.ndarray
+        """
+        Wait for the call to complete and return the result.
+        """
+        return self._value
+
+
+# CRUFT: time.clock() is not available in python 3.8 and later
+clock = getattr(time, 'perf_counter', None) or time.clock
+
+class KernelStats(object):
+    """
+    Performance counters for kernel calls, accumulated for each model.
+
+    Kernels record the following counters for each call, where available:
+
+    * *nq* is the number of q points
+    * *pd_points* is the number of polydispersity points visited
+    * *pd_skipped* is the number of points removed by the cutoff before
+      the call; if *count_skipped* is True, this also includes the points
+      skipped by the cutoff in the kernel, which are counted by walking the
+      polydispersity mesh in python for each call
+    * *chunks* is the number of kernel launches
+    * *bytes_to_device* is the number of bytes copied to the OpenCL device
+    * *time_<phase>* is the wall time in seconds for each phase of the
+      call, such as *time_upload*, *time_compute* and *time_download*
+
+    Composite kernels, such as P(Q)*S(Q) and mixtures, record their calls
+    under the composite model name, with the time including the calls to
+    their parts, and each part also records its own calls.
+
+    *totals* maps model name to the sum of each counter over all calls,
+    along with the number of *calls*.  *hook*, if given, is called as
+    *hook(name, counters)* after each call.
+    """
+    def __init__(self, hook=None, count_skipped=False):
+        # type: (Callable[[str, Dict[str, float]], None], bool) -> None
+        self.hook = hook
+        self.count_skipped = count_skipped
+        self.totals = {}  # type: Dict[str, Dict[str, float]]
+        self._lock = threading.Lock()
+
+    def skipped(self, call_details, values, cutoff):
+        # type: (CallDetails, np.ndarray, float) -> int
+        """
+        Return the *pd_skipped* counter for a call.
+        """
+        skipped = call_details.num_pruned
+        # Pruned details only list points above the cutoff.
+        if self.count_skipped and not call_details.sparse:
+            skipped += count_skipped(call_details, values, cutoff)
+        return skipped
+
+    def record(self, name, **counters):
+        # type: (str, **float) -> None
+        """
+        Add the *counters* for a call to the model *name*.
+        """
+        with self._lock:
+            total = self.totals.setdefault(name, {'calls': 0})
+            total['calls'] += 1
+            for key, value in counters.items():
+                total[key] = total.get(key, 0) + value
+        if self.hook is not None:
+            self.hook(name, counters)
+
+    def reset(self):
+        # type: () -> None
+        """
+        Clear the accumulated counters.
+        """
+        with self._lock:
+            self.totals = {}
+
+    def __str__(self):
+        # type: () -> str
+        lines = []
+        for name, total in sorted(self.totals.items()):
+            lines.append("%s: %s" % (name, ", ".join(
+                "%s=%.6g" % (key, value) for key, value in sorted(total.items()))))
+        return "\n".join(lines)
+
+_STATS = None  # type: Optional[KernelStats]
+
+def enable_stats(hook=None, count_skipped=False):
+    # type: (Callable[[str, Dict[str, float]], None], bool) -> KernelStats
+    """
+    Start recording performance counters for all kernel calls, returning
+    the :class:`KernelStats` object which accumulates them.  *hook* is
+    called with the model name and the counters after each call.  Set
+    *count_skipped* to include the points skipped by the cutoff inside
+    the kernel, which is expensive for large polydispersity meshes.
+    """
+    global _STATS
+    _STATS = KernelStats(hook=hook, count_skipped=count_skipped)
+    return _STATS
+
+def disable_stats():
+    # type: () -> Optional[KernelStats]
+    """
+    Stop recording performance counters, returning the counters so far.
+    """
+    global _STATS
+    stats, _STATS = _STATS, None
+    return stats
+
+def get_stats():
+    # type: () -> Optional[KernelStats]
+    """
+    Return the active :class:`KernelStats`, or None if not recording.
+    """
+    return _STATS
+
+def log_stats(name, counters):
+    # type: (str, Dict[str, float]) -> None
+    """
+    Stats hook which logs the counters for each call at debug level.
+    """
+    logging.debug("kernel %s: %s", name, ", ".join(
+        "%s=%.6g" % (key, value) for key, value in sorted(counters.items())))
+
+
+def test_call_batch():
+    # type: () -> None
+    """
+    Check that batch evaluation matches separate kernel calls.
+    """
+    from .direct_model import _test_kernel, _kernel_args
+
+    _, kernel = _test_kernel()
+    pars_list = [
+        dict(radius=20, scale=2.),
+        dict(radius=30, radius_pd=0.1, radius_pd_n=35, background=0.5),
+        dict(radius=40, length=100, length_pd=0.2, length_pd_n=11),
+        ]
+    args = [_kernel_args(kernel, pars, False) for pars in pars_list]
+    call_details, values, _ = zip(*args)
+    actual = kernel.call_batch(call_details, values, 0., False)
+    for k, (details, block, magnetic) in enumerate(args):
+        target = kernel(details, block, 0., magnetic)
+        assert np.allclose(actual[k], target, rtol=1e-12), \
+            "batch %d: expected %s but got %s"%(k, target, actual[k])
+
+    # Batches with sparse details fall back to one call for each set.
+    cutoff = 1e-3
+    pars = dict(radius=30, radius_pd=0.3, radius_pd_n=35,
+                length=100, length_pd=0.3, length_pd_n=35)
+    args = [_kernel_args(kernel, pars, False),
+            _kernel_args(kernel, pars, False, cutoff=cutoff)]
+    assert args[1][0].sparse and not args[0][0].sparse
+    call_details, values, _ = zip(*args)
+    actual = kernel.call_batch(call_details, values, cutoff, False)
+    target = kernel(args[0][0], args[0][1], cutoff, False)
+    for k in range(len(args)):
+        assert np.allclose(actual[k], target, rtol=1e-12), \
+            "sparse batch %d: expected %s but got %s"%(k, target, actual[k])
+
+def test_kernel_stats():
+    # type: () -> None
+    """
+    Check the performance counters for a kernel call.
+    """
+    from .direct_model import _test_kernel, _kernel_args
+
+    _, kernel = _test_kernel(is_2d=True)
+    pars = dict(radius=30, radius_pd=0.2, radius_pd_n=15,
+                length=100, length_pd=0.3, length_pd_n=15,
+                theta=20, theta_pd=10, theta_pd_n=15,
+                phi=30, phi_pd=10, phi_pd_n=15)
+    cutoff = 1e-5
+    dense_args = _kernel_args(kernel, pars, False)
+    # The points skipped by the kernel are instead pruned before the call.
+    sparse_args = _kernel_args(kernel, pars, False, cutoff=cutoff)
+    totals = []
+    for count_skipped in (False, True):
+        stats = enable_stats(count_skipped=count_skipped)
+        try:
+            for call_details, values, magnetic in (dense_args, sparse_args):
+                kernel(call_details, values, cutoff, magnetic)
+                totals.append(dict(stats.totals['cylinder']))
+                stats.reset()
+        finally:
+            disable_stats()
+    dense, sparse, counted, counted_sparse = totals
+    assert dense['calls'] == 1 and dense['nq'] == kernel.q_input.nq
+    assert dense['pd_points'] == 15**4
+    # Only the pruned points are counted unless asked to walk the mesh.
+    assert dense['pd_skipped'] == 0
+    assert sparse['pd_skipped'] == sparse_args[0].num_pruned > 0
+    assert counted['pd_skipped'] == sparse['pd_skipped']
+    assert counted_sparse['pd_skipped'] == sparse['pd_skipped']
+    assert sparse['pd_points'] == dense['pd_points'] - sparse['pd_skipped']
+
+    # Composite kernels record their calls along with those of their parts.
+    pars = dict(A_radius=30, A_radius_pd=0.2, A_radius_pd_n=15)
+    for name in ('cylinder*hardsphere', 'cylinder+sphere'):
+        _, kernel = _test_kernel(name, nq=20)
+        stats = enable_stats()
+        try:
+            call_details, values, magnetic = _kernel_args(kernel, pars, False)
+            kernel(call_details, values, cutoff, magnetic)
+        finally:
+            disable_stats()
+        total = stats.totals[kernel.info.name]
+        assert total['calls'] == 1 and total['nq'] == 20
+        assert total['pd_points'] == 15 and total['time_compute'] > 0
+        assert stats.totals['cylinder']['calls'] == 1
+
+def test_submit():
+    # type: () -> None
+    """
+    Check that a submitted kernel call returns the kernel value.
+    """
+    from .direct_model import _test_kernel, _kernel_args
+
+    _, kernel = _test_kernel()
+    pars = dict(radius=30, radius_pd=0.1, radius_pd_n=35, background=0.5)
+    call_details, values, magnetic = _kernel_args(kernel, pars, False)
+    future = kernel.submit(call_details, values, 1e-5, magnetic)
+    target = kernel(call_details, values, 1e-5, magnetic)
+    actual = future.result()
+    assert future.done()
+    assert np.allclose(actual, target, rtol=1e-12), \
+        "submit: expected %s but got %s"%(target, actual)
@@ -2,6 +2,7 @@
 # define USE_OPENCL
 #elif defined(_OPENMP)
 # define USE_OPENMP
+# include <omp.h>
 #endif
 
 // If opencl is not available, then we are compiling a C function
@@ -211,3 +212,49 @@ inline double sas_sinx_x(double x) { return x==0 ? 1.0 : sin(x)/x; }
     cos_nu = (-cos_phi*sin_psi*sin_theta + sin_phi*cos_psi)*qxhat + sin_psi*cos_theta*qyhat; \
     } while (0)
 #endif
+
+// The rotation which takes the unit vector along (qx, qy) into the
+// particle frame depends only on the orientation, so the kernel computes
+// it once for each orientation in the polydispersity loop and the models
+// project each q through it.  The rows give (xhat, yhat, zhat) in terms
+// of (qx, qy)/q, matching ORIENT_ASYMMETRIC above; the last row gives
+// -cos(alpha) for ORIENT_SYMMETRIC, which does not depend on psi.
+typedef struct {
+    double R11, R12;
+    double R21, R22;
+    double R31, R32;
+} QACRotation;
+
+static void qac_rotation(QACRotation *rotation,
+    double theta, double phi, double psi)
+{
+    double sin_theta, cos_theta;
+    double sin_phi, cos_phi;
+    double sin_psi, cos_psi;
+    SINCOS(theta*M_PI_180, sin_theta, cos_theta);
+    SINCOS(phi*M_PI_180, sin_phi, cos_phi);
+    SINCOS(psi*M_PI_180, sin_psi, cos_psi);
+    rotation->R11 = -sin_phi*sin_psi + cos_theta*cos_phi*cos_psi;
+    rotation->R12 =  cos_phi*sin_psi + cos_theta*sin_phi*cos_psi;
+    rotation->R21 = -sin_phi*cos_psi - cos_theta*cos_phi*sin_psi;
+    rotation->R22 =  cos_phi*cos_psi - cos_theta*sin_phi*sin_psi;
+    rotation->R31 = -sin_theta*cos_phi;
+    rotation->R32 = -sin_theta*sin_phi;
+}
+
+// Equivalent to ORIENT_SYMMETRIC and ORIENT_ASYMMETRIC for the orientation
+// of *rotation*, but without the trig functions.
+#define QAC_SYMMETRIC(rotation, qx, qy, q, sn, cn) do { \
+    q = sqrt(qx*qx + qy*qy); \
+    cn = (q==0. ? 1.0 : -((rotation)->R31*qx + (rotation)->R32*qy)/q); \
+    sn = sqrt(1 - cn*cn); \
+    } while (0)
+
+#define QAC_ASYMMETRIC(rotation, qx, qy, q, xhat, yhat, zhat) do { \
+    q = sqrt(qx*qx + qy*qy); \
+    const double qxhat = qx/q; \
+    const double qyhat = qy/q; \
+    xhat = (rotation)->R11*qxhat + (rotation)->R12*qyhat; \
+    yhat = (rotation)->R21*qxhat + (rotation)->R22*qyhat; \
+    zhat = (rotation)->R31*qxhat + (rotation)->R32*qyhat; \
+    } while (0)
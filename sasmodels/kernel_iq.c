@@ -25,8 +25,18 @@ typedef struct {
     int32_t num_weights;        // total length of the weights vector
     int32_t num_active;         // number of non-trivial pd loops
     int32_t theta_par;          // id of spherical correction variable
+    int32_t sparse;             // true if the list of points follows
 } ProblemDetails;
 
+// Number of polydispersity loops compiled into the kernel.  Kernels which
+// are specialized for the calls with fewer active loops define PD_LOOPS as
+// the number of active loops, and define PD_THETA as 0 if theta is not an
+// active loop, 1 if it is the inner loop or 2 if it is an outer loop.  The
+// remaining loops have length one, so their values are already in place.
+#ifndef PD_LOOPS
+#define PD_LOOPS MAX_PD
+#endif
+
 // Intel HD 4000 needs private arrays to be a multiple of 4 long
 typedef struct {
     PARAMETER_TABLE
@@ -35,6 +45,50 @@ typedef union {
     ParameterTable table;
     double vector[4*((NUM_PARS+3)/4)];
 } ParameterBlock;
+
+// Number of threads used by the OpenMP kernels, or 0 for the OpenMP default.
+static int32_t sas_num_threads = 0;
+
+// Set the number of threads for the OpenMP kernels, returning the number of
+// threads that will be used.  Use n=0 to restore the OpenMP default.  Kernels
+// compiled without OpenMP always run in a single thread.
+kernel
+int32_t set_num_threads(int32_t n)
+{
+  sas_num_threads = (n > 0 ? n : 0);
+#ifdef USE_OPENMP
+  return (sas_num_threads > 0 ? sas_num_threads : omp_get_max_threads());
+#else
+  return 1;
+#endif
+}
+
+#ifdef USE_OPENMP
+#ifdef _MSC_VER
+#define SAS_THREAD_LOCAL __declspec(thread)
+#else
+#define SAS_THREAD_LOCAL __thread
+#endif
+// Limit on the number of threads used by the OpenMP kernels when they are
+// called from the current thread, or 0 for no limit.  This is per calling
+// thread so that a call which slices q across a thread pool does not change
+// the number of threads used by other calls which are running at the time.
+static SAS_THREAD_LOCAL int32_t sas_thread_limit = 0;
+#endif
+
+// Limit the number of threads for the OpenMP kernels called from the current
+// thread, returning the previous limit.  Use n=0 to remove the limit.
+kernel
+int32_t set_thread_limit(int32_t n)
+{
+#ifdef USE_OPENMP
+  const int32_t previous = sas_thread_limit;
+  sas_thread_limit = (n > 0 ? n : 0);
+  return previous;
+#else
+  return 0;
+#endif
+}
 #endif // _PAR_BLOCK_
 
 
@@ -83,10 +137,6 @@ void KERNEL_NAME(
     const double cutoff     // cutoff in the polydispersity weight product
     )
 {
-  // Storage for the current parameter values.  These will be updated as we
-  // walk the polydispersity cube.
-  ParameterBlock local_values;
-
 #if defined(MAGNETIC) && NUM_MAGNETIC>0
   // Location of the sld parameters in the parameter vector.
   // These parameters are updated with the effective sld due to magnetism.
@@ -105,12 +155,49 @@ void KERNEL_NAME(
   SINCOS(-values[NUM_PARS+4]*M_PI_180, sin_mspin, cos_mspin);
 #endif // MAGNETIC
 
+  // Norm from the previous chunk, read before any thread updates it.
+  const double pd_norm_start = (pd_start == 0 ? 0.0 : result[nq]);
+
+  // Each thread owns a contiguous block of q values and walks the entire
+  // polydispersity hypercube for that block, so the thread team is started
+  // once per call rather than once per polydispersity point.  Every thread
+  // accumulates the same pd_norm in the same order; the first thread saves
+  // it, so the result does not depend on the number of threads.
+#ifdef USE_OPENMP
+  int32_t num_threads = (sas_num_threads > 0 ? sas_num_threads : omp_get_max_threads());
+  if (sas_thread_limit > 0 && num_threads > sas_thread_limit) num_threads = sas_thread_limit;
+  if (num_threads > nq) num_threads = nq;
+  if (num_threads < 1) num_threads = 1;
+  #pragma omp parallel num_threads(num_threads)
+#endif
+  {
+#ifdef USE_OPENMP
+  const int thread_id = omp_get_thread_num();
+  const int thread_count = omp_get_num_threads();
+#else
+  const int thread_id = 0;
+  const int thread_count = 1;
+#endif
+  const int block_size = (nq + thread_count - 1)/thread_count;
+  const int q_start = thread_id*block_size;
+  const int q_stop = (q_start + block_size < nq ? q_start + block_size : nq);
+
+  // Storage for the current parameter values.  These will be updated as we
+  // walk the polydispersity cube.
+  ParameterBlock local_values;
+#ifdef CALL_SETUP
+  // Storage for the values computed by the model setup for the current
+  // parameters, which are then shared by all q.
+  double scratch[SCRATCH_SIZE];
+#endif
+#ifdef CALL_ROTATION
+  // Rotation into the particle frame for the current orientation.
+  QACRotation rotation;
+#endif
+
   // Fill in the initial variables
   //   values[0] is scale
   //   values[1] is background
-  #ifdef USE_OPENMP
-  #pragma omp parallel for
-  #endif
   for (int i=0; i < NUM_PARS; i++) {
     local_values.vector[i] = values[2+i];
 //printf("p%d = %g\n",i, local_values.vector[i]);
@@ -118,29 +205,26 @@ void KERNEL_NAME(
 //printf("NUM_VALUES:%d  NUM_PARS:%d  MAX_PD:%d\n", NUM_VALUES, NUM_PARS, MAX_PD);
 //printf("start:%d  stop:%d\n", pd_start, pd_stop);
 
-  double pd_norm = (pd_start == 0 ? 0.0 : result[nq]);
+  double pd_norm = pd_norm_start;
   if (pd_start == 0) {
-    #ifdef USE_OPENMP
-    #pragma omp parallel for
-    #endif
-    for (int q_index=0; q_index < nq; q_index++) result[q_index] = 0.0;
+    for (int q_index=q_start; q_index < q_stop; q_index++) result[q_index] = 0.0;
   }
 //printf("start %d %g %g\n", pd_start, pd_norm, result[0]);
 
-#if MAX_PD>0
+#if PD_LOOPS>0
   global const double *pd_value = values + NUM_VALUES;
   global const double *pd_weight = pd_value + details->num_weights;
 #endif
 
   // Jump into the middle of the polydispersity loop
-#if MAX_PD>4
+#if PD_LOOPS>4
   int n4=details->pd_length[4];
   int i4=(pd_start/details->pd_stride[4])%n4;
   const int p4=details->pd_par[4];
   global const double *v4 = pd_value + details->pd_offset[4];
   global const double *w4 = pd_weight + details->pd_offset[4];
 #endif
-#if MAX_PD>3
+#if PD_LOOPS>3
   int n3=details->pd_length[3];
   int i3=(pd_start/details->pd_stride[3])%n3;
   const int p3=details->pd_par[3];
@@ -148,21 +232,21 @@ void KERNEL_NAME(
   global const double *w3 = pd_weight + details->pd_offset[3];
 //printf("offset %d: %d %d\n", 3, details->pd_offset[3], NUM_VALUES);
 #endif
-#if MAX_PD>2
+#if PD_LOOPS>2
   int n2=details->pd_length[2];
   int i2=(pd_start/details->pd_stride[2])%n2;
   const int p2=details->pd_par[2];
   global const double *v2 = pd_value + details->pd_offset[2];
   global const double *w2 = pd_weight + details->pd_offset[2];
 #endif
-#if MAX_PD>1
+#if PD_LOOPS>1
   int n1=details->pd_length[1];
   int i1=(pd_start/details->pd_stride[1])%n1;
   const int p1=details->pd_par[1];
   global const double *v1 = pd_value + details->pd_offset[1];
   global const double *w1 = pd_weight + details->pd_offset[1];
 #endif
-#if MAX_PD>0
+#if PD_LOOPS>0
   int n0=details->pd_length[0];
   int i0=(pd_start/details->pd_stride[0])%n0;
   const int p0=details->pd_par[0];
@@ -172,10 +256,15 @@ void KERNEL_NAME(
 #endif
 
 
-#if MAX_PD>0
+#if PD_LOOPS>0
   const int theta_par = details->theta_par;
+#ifdef PD_THETA
+  const int fast_theta = (PD_THETA == 1);
+  const int slow_theta = (PD_THETA == 2);
+#else
   const int fast_theta = (theta_par == p0);
   const int slow_theta = (theta_par >= 0 && !fast_theta);
+#endif
   double spherical_correction = 1.0;
 #else
   // Note: if not polydisperse the weights cancel and we don't need the
@@ -185,40 +274,67 @@ void KERNEL_NAME(
 
   int step = pd_start;
 
-#if MAX_PD>4
+#if PD_LOOPS>0
+  // If sparse, the list of positions in the hypercube follows the details
+  // and step is the index into this list.  Each time through the outer
+  // loop, the polydispersity loops start at the next point on the list and
+  // continue along the inner loop while the points on the list are
+  // consecutive.
+  const int sparse = details->sparse;
+  global const int32_t *pd_points = (global const int32_t *)(details + 1);
+  while (step < pd_stop) {
+  if (sparse) {
+    const int point = pd_points[step];
+#if PD_LOOPS>4
+    i4 = (point/details->pd_stride[4])%n4;
+#endif
+#if PD_LOOPS>3
+    i3 = (point/details->pd_stride[3])%n3;
+#endif
+#if PD_LOOPS>2
+    i2 = (point/details->pd_stride[2])%n2;
+#endif
+#if PD_LOOPS>1
+    i1 = (point/details->pd_stride[1])%n1;
+#endif
+    i0 = (point/details->pd_stride[0])%n0;
+  }
+#endif
+
+#if PD_LOOPS>4
   const double weight5 = 1.0;
   while (i4 < n4) {
     local_values.vector[p4] = v4[i4];
     double weight4 = w4[i4] * weight5;
 //printf("step:%d level %d: p:%d i:%d n:%d value:%g weight:%g\n", step, 4, p4, i4, n4, local_values.vector[p4], weight4);
-#elif MAX_PD>3
+#elif PD_LOOPS>3
     const double weight4 = 1.0;
 #endif
-#if MAX_PD>3
+#if PD_LOOPS>3
   while (i3 < n3) {
     local_values.vector[p3] = v3[i3];
     double weight3 = w3[i3] * weight4;
 //printf("step:%d level %d: p:%d i:%d n:%d value:%g weight:%g\n", step, 3, p3, i3, n3, local_values.vector[p3], weight3);
-#elif MAX_PD>2
+#elif PD_LOOPS>2
     const double weight3 = 1.0;
 #endif
-#if MAX_PD>2
+#if PD_LOOPS>2
   while (i2 < n2) {
     local_values.vector[p2] = v2[i2];
     double weight2 = w2[i2] * weight3;
 //printf("step:%d level %d: p:%d i:%d n:%d value:%g weight:%g\n", step, 2, p2, i2, n2, local_values.vector[p2], weight2);
-#elif MAX_PD>1
+#elif PD_LOOPS>1
     const double weight2 = 1.0;
 #endif
-#if MAX_PD>1
+#if PD_LOOPS>1
   while (i1 < n1) {
     local_values.vector[p1] = v1[i1];
     double weight1 = w1[i1] * weight2;
 //printf("step:%d level %d: p:%d i:%d n:%d value:%g weight:%g\n", step, 1, p1, i1, n1, local_values.vector[p1], weight1);
-#elif MAX_PD>0
+#elif PD_LOOPS>0
     const double weight1 = 1.0;
 #endif
-#if MAX_PD>0
+#if PD_LOOPS>0
   if (slow_theta) { // Theta is not in inner loop
     spherical_correction = fmax(fabs(cos(M_PI_180*local_values.vector[theta_par])), 1.e-6);
   }
@@ -247,11 +363,14 @@ void KERNEL_NAME(
         // would be problems looking at models with theta=90.
         const double weight = weight0 * spherical_correction;
         pd_norm += weight * CALL_VOLUME(local_values.table);
+#if defined(CALL_SETUP) && !(defined(MAGNETIC) && NUM_MAGNETIC > 0)
+        CALL_SETUP(scratch, local_values.table);
+#endif
+#ifdef CALL_ROTATION
+        CALL_ROTATION(rotation, local_values.table);
+#endif
 
-        #ifdef USE_OPENMP
-        #pragma omp parallel for
-        #endif
-        for (int q_index=0; q_index<nq; q_index++) {
+        for (int q_index=q_start; q_index<q_stop; q_index++) {
 #if defined(MAGNETIC) && NUM_MAGNETIC > 0
           const double qx = q[2*q_index];
           const double qy = q[2*q_index+1];
@@ -294,13 +413,16 @@ void KERNEL_NAME(
                       SLD(M1+3*sk, slds[sk]);
                   }
                   #endif
-                  scattering += CALL_IQ(q, q_index, local_values.table);
+                  #ifdef CALL_SETUP
+                  CALL_SETUP(scratch, local_values.table);
+                  #endif
+                  scattering += CALL_IQ(q, q_index, local_values.table, scratch, rotation);
                 }
               }
             }
           }
 #else  // !MAGNETIC
-          const double scattering = CALL_IQ(q, q_index, local_values.table);
+          const double scattering = CALL_IQ(q, q_index, local_values.table, scratch, rotation);
 #endif // !MAGNETIC
 //printf("q_index:%d %g %g %g %g\n",q_index, scattering, weight, spherical_correction, weight0);
           result[q_index] += weight * scattering;
@@ -308,38 +430,73 @@ void KERNEL_NAME(
       }
     }
     ++step;
-#if MAX_PD>0
+#if PD_LOOPS>0
     if (step >= pd_stop) break;
+    if (sparse && pd_points[step] != pd_points[step-1]+1) break;
     ++i0;
   }
   i0 = 0;
 #endif
-#if MAX_PD>1
-    if (step >= pd_stop) break;
+#if PD_LOOPS>1
+    if (step >= pd_stop || sparse) break;
     ++i1;
   }
   i1 = 0;
 #endif
-#if MAX_PD>2
-    if (step >= pd_stop) break;
+#if PD_LOOPS>2
+    if (step >= pd_stop || sparse) break;
     ++i2;
   }
   i2 = 0;
 #endif
-#if MAX_PD>3
-    if (step >= pd_stop) break;
+#if PD_LOOPS>3
+    if (step >= pd_stop || sparse) break;
     ++i3;
   }
   i3 = 0;
 #endif
-#if MAX_PD>4
-    if (step >= pd_stop) break;
+#if PD_LOOPS>4
+    if (step >= pd_stop || sparse) break;
     ++i4;
   }
   i4 = 0;
 #endif
+#if PD_LOOPS>0
+  if (!sparse) break;
+  } // end of sparse points loop
+#endif
 
 //printf("res: %g/%g\n", result[0], pd_norm);
   // Remember the updated norm.
-  result[nq] = pd_norm;
+  if (thread_id == 0) result[nq] = pd_norm;
+  } // end of parallel block
+}
+
+#ifdef BATCH_KERNEL_NAME
+// Evaluate the kernel for a batch of parameter sets at the same q values.
+// Parameter set k uses details[k] and the value block starting at
+// values + k*values_stride, and returns nq+1 values starting at
+// result + k*(nq+1).
+//
+// The details are indexed as a packed array of fixed size ProblemDetails,
+// so sparse details, whose list of points follows the structure, cannot be
+// used here.  Callers must evaluate batches containing sparse details one
+// set at a time with KERNEL_NAME.
+kernel
+void BATCH_KERNEL_NAME(
+    int32_t nq,                 // number of q values
+    const int32_t num_sets,     // number of parameter sets
+    global const ProblemDetails *details, // details for each parameter set
+    global const double *values,  // value blocks for each parameter set
+    const int32_t values_stride,  // distance between value blocks
+    global const double *q, // nq q values, with padding to boundary
+    global double *result,  // num_sets blocks of nq+1 return values
+    const double cutoff     // cutoff in the polydispersity weight product
+    )
+{
+  for (int k=0; k < num_sets; k++) {
+    KERNEL_NAME(nq, 0, details[k].num_eval, details+k,
+                values + k*values_stride, q, result + k*(nq+1), cutoff);
+  }
 }
+#endif // BATCH_KERNEL_NAME
@@ -25,8 +25,18 @@ typedef struct {
     int32_t num_weights;        // total length of the weights vector
     int32_t num_active;         // number of non-trivial pd loops
     int32_t theta_par;          // id of spherical correction variable
+    int32_t sparse;             // true if the list of points follows
 } ProblemDetails;
 
+// Number of polydispersity loops compiled into the kernel.  Kernels which
+// are specialized for the calls with fewer active loops define PD_LOOPS as
+// the number of active loops, and define PD_THETA as 0 if theta is not an
+// active loop, 1 if it is the inner loop or 2 if it is an outer loop.  The
+// remaining loops have length one, so their values are already in place.
+#ifndef PD_LOOPS
+#define PD_LOOPS MAX_PD
+#endif
+
 // Intel HD 4000 needs private arrays to be a multiple of 4 long
 typedef struct {
     PARAMETER_TABLE
@@ -80,7 +90,9 @@ void KERNEL_NAME(
     global const double *values,
     global const double *q, // nq q values, with padding to boundary
     global double *result,  // nq+1 return values, again with padding
-    const double cutoff     // cutoff in the polydispersity weight product
+    const double cutoff,    // cutoff in the polydispersity weight product
+    const int32_t values_stride, // distance between batch value blocks
+    const int32_t result_stride  // distance between batch result blocks
     )
 {
 
@@ -88,9 +100,29 @@ void KERNEL_NAME(
   const int q_index = get_global_id(0);
   if (q_index >= nq) return;
 
+  // Which parameter set we are working with.  The second dimension of the
+  // work group is only used when evaluating a batch of parameter sets, so
+  // for a single parameter set the batch index is zero.
+  const int batch_index = get_global_id(1);
+  details += batch_index;
+  values += batch_index*values_stride;
+  result += batch_index*result_stride;
+  // Parameter sets in a batch may have polydispersity loops of different
+  // lengths; skip the remaining chunks once this one is complete.
+  if (pd_start >= details->num_eval) return;
+
   // Storage for the current parameter values.  These will be updated as we
   // walk the polydispersity cube.
   ParameterBlock local_values;
+#ifdef CALL_SETUP
+  // Storage for the values computed by the model setup for the current
+  // parameters, which are then shared by all q.
+  double scratch[SCRATCH_SIZE];
+#endif
+#ifdef CALL_ROTATION
+  // Rotation into the particle frame for the current orientation.
+  QACRotation rotation;
+#endif
 
 #if defined(MAGNETIC) && NUM_MAGNETIC>0
   // Location of the sld parameters in the parameter vector.
@@ -124,20 +156,20 @@ void KERNEL_NAME(
   double this_result = (pd_start == 0 ? 0.0 : result[q_index]);
 //if (q_index==0) printf("start %d %g %g\n", pd_start, pd_norm, this_result);
 
-#if MAX_PD>0
+#if PD_LOOPS>0
   global const double *pd_value = values + NUM_VALUES;
   global const double *pd_weight = pd_value + details->num_weights;
 #endif
 
   // Jump into the middle of the polydispersity loop
-#if MAX_PD>4
+#if PD_LOOPS>4
   int n4=details->pd_length[4];
   int i4=(pd_start/details->pd_stride[4])%n4;
   const int p4=details->pd_par[4];
   global const double *v4 = pd_value + details->pd_offset[4];
   global const double *w4 = pd_weight + details->pd_offset[4];
 #endif
-#if MAX_PD>3
+#if PD_LOOPS>3
   int n3=details->pd_length[3];
   int i3=(pd_start/details->pd_stride[3])%n3;
   const int p3=details->pd_par[3];
@@ -145,21 +177,21 @@ void KERNEL_NAME(
   global const double *w3 = pd_weight + details->pd_offset[3];
 //if (q_index==0) printf("offset %d: %d %d\n", 3, details->pd_offset[3], NUM_VALUES);
 #endif
-#if MAX_PD>2
+#if PD_LOOPS>2
   int n2=details->pd_length[2];
   int i2=(pd_start/details->pd_stride[2])%n2;
   const int p2=details->pd_par[2];
   global const double *v2 = pd_value + details->pd_offset[2];
   global const double *w2 = pd_weight + details->pd_offset[2];
 #endif
-#if MAX_PD>1
+#if PD_LOOPS>1
   int n1=details->pd_length[1];
   int i1=(pd_start/details->pd_stride[1])%n1;
   const int p1=details->pd_par[1];
   global const double *v1 = pd_value + details->pd_offset[1];
   global const double *w1 = pd_weight + details->pd_offset[1];
 #endif
-#if MAX_PD>0
+#if PD_LOOPS>0
   int n0=details->pd_length[0];
   int i0=(pd_start/details->pd_stride[0])%n0;
   const int p0=details->pd_par[0];
@@ -168,10 +200,15 @@ void KERNEL_NAME(
 #endif
 
 
-#if MAX_PD>0
+#if PD_LOOPS>0
   const int theta_par = details->theta_par;
+#ifdef PD_THETA
+  const bool fast_theta = (PD_THETA == 1);
+  const bool slow_theta = (PD_THETA == 2);
+#else
   const bool fast_theta = (theta_par == p0);
   const bool slow_theta = (theta_par >= 0 && !fast_theta);
+#endif
   double spherical_correction = 1.0;
 #else
   // Note: if not polydisperse the weights cancel and we don't need the
@@ -181,41 +218,68 @@ void KERNEL_NAME(
 
   int step = pd_start;
 
+#if PD_LOOPS>0
+  // If sparse, the list of positions in the hypercube follows the details
+  // and step is the index into this list.  Each time through the outer
+  // loop, the polydispersity loops start at the next point on the list and
+  // continue along the inner loop while the points on the list are
+  // consecutive.
+  const int sparse = details->sparse;
+  global const int32_t *pd_points = (global const int32_t *)(details + 1);
+  while (step < pd_stop) {
+  if (sparse) {
+    const int point = pd_points[step];
+#if PD_LOOPS>4
+    i4 = (point/details->pd_stride[4])%n4;
+#endif
+#if PD_LOOPS>3
+    i3 = (point/details->pd_stride[3])%n3;
+#endif
+#if PD_LOOPS>2
+    i2 = (point/details->pd_stride[2])%n2;
+#endif
+#if PD_LOOPS>1
+    i1 = (point/details->pd_stride[1])%n1;
+#endif
+    i0 = (point/details->pd_stride[0])%n0;
+  }
+#endif
+
 
-#if MAX_PD>4
+#if PD_LOOPS>4
   const double weight5 = 1.0;
   while (i4 < n4) {
     local_values.vector[p4] = v4[i4];
     double weight4 = w4[i4] * weight5;
 //if (q_index == 0) printf("step:%d level %d: p:%d i:%d n:%d value:%g weight:%g\n", step, 4, p4, i4, n4, local_values.vector[p4], weight4);
-#elif MAX_PD>3
+#elif PD_LOOPS>3
     const double weight4 = 1.0;
 #endif
-#if MAX_PD>3
+#if PD_LOOPS>3
   while (i3 < n3) {
     local_values.vector[p3] = v3[i3];
     double weight3 = w3[i3] * weight4;
 //if (q_index == 0) printf("step:%d level %d: p:%d i:%d n:%d value:%g weight:%g\n", step, 3, p3, i3, n3, local_values.vector[p3], weight3);
-#elif MAX_PD>2
+#elif PD_LOOPS>2
     const double weight3 = 1.0;
 #endif
-#if MAX_PD>2
+#if PD_LOOPS>2
   while (i2 < n2) {
     local_values.vector[p2] = v2[i2];
     double weight2 = w2[i2] * weight3;
 //if (q_index == 0) printf("step:%d level %d: p:%d i:%d n:%d value:%g weight:%g\n", step, 2, p2, i2, n2, local_values.vector[p2], weight2);
-#elif MAX_PD>1
+#elif PD_LOOPS>1
     const double weight2 = 1.0;
 #endif
-#if MAX_PD>1
+#if PD_LOOPS>1
   while (i1 < n1) {
     local_values.vector[p1] = v1[i1];
     double weight1 = w1[i1] * weight2;
 //if (q_index == 0) printf("step:%d level %d: p:%d i:%d n:%d value:%g weight:%g\n", step, 1, p1, i1, n1, local_values.vector[p1], weight1);
-#elif MAX_PD>0
+#elif PD_LOOPS>0
     const double weight1 = 1.0;
 #endif
-#if MAX_PD>0
+#if PD_LOOPS>0
   if (slow_theta) { // Theta is not in inner loop
     spherical_correction = fmax(fabs(cos(M_PI_180*local_values.vector[theta_par])), 1.e-6);
   }
@@ -244,6 +308,12 @@ void KERNEL_NAME(
         // would be problems looking at models with theta=90.
         const double weight = weight0 * spherical_correction;
         pd_norm += weight * CALL_VOLUME(local_values.table);
+#if defined(CALL_SETUP) && !(defined(MAGNETIC) && NUM_MAGNETIC > 0)
+        CALL_SETUP(scratch, local_values.table);
+#endif
+#ifdef CALL_ROTATION
+        CALL_ROTATION(rotation, local_values.table);
+#endif
 
 #if defined(MAGNETIC) && NUM_MAGNETIC > 0
         const double qx = q[2*q_index];
@@ -287,48 +357,56 @@ void KERNEL_NAME(
                     SLD(M1+3*sk, slds[sk]);
                 }
                 #endif
-                scattering += CALL_IQ(q, q_index, local_values.table);
+                #ifdef CALL_SETUP
+                CALL_SETUP(scratch, local_values.table);
+                #endif
+                scattering += CALL_IQ(q, q_index, local_values.table, scratch, rotation);
               }
             }
           }
         }
 #else  // !MAGNETIC
-        const double scattering = CALL_IQ(q, q_index, local_values.table);
+        const double scattering = CALL_IQ(q, q_index, local_values.table, scratch, rotation);
 #endif // !MAGNETIC
         this_result += weight * scattering;
       }
     }
     ++step;
-#if MAX_PD>0
+#if PD_LOOPS>0
     if (step >= pd_stop) break;
+    if (sparse && pd_points[step] != pd_points[step-1]+1) break;
     ++i0;
   }
   i0 = 0;
 #endif
-#if MAX_PD>1
-    if (step >= pd_stop) break;
+#if PD_LOOPS>1
+    if (step >= pd_stop || sparse) break;
     ++i1;
   }
   i1 = 0;
 #endif
-#if MAX_PD>2
-    if (step >= pd_stop) break;
+#if PD_LOOPS>2
+    if (step >= pd_stop || sparse) break;
     ++i2;
   }
   i2 = 0;
 #endif
-#if MAX_PD>3
-    if (step >= pd_stop) break;
+#if PD_LOOPS>3
+    if (step >= pd_stop || sparse) break;
     ++i3;
   }
   i3 = 0;
 #endif
-#if MAX_PD>4
-    if (step >= pd_stop) break;
+#if PD_LOOPS>4
+    if (step >= pd_stop || sparse) break;
     ++i4;
   }
   i4 = 0;
 #endif
+#if PD_LOOPS>0
+  if (!sparse) break;
+  } // end of sparse points loop
+#endif
 
 //if (q_index==0) printf("res: %g/%g\n", this_result, pd_norm);
   // Remember the current result and the updated norm.
@@ -39,29 +39,63 @@ can select.  It will then tell you that you can use these drivers
 automatically by setting the SAS_OPENCL environment variable, which is
 PYOPENCL_CTX equivalent but not conflicting with other pyopnecl programs.
 
-Some graphics cards have multiple devices on the same card.  You cannot
-yet use both of them concurrently to evaluate models, but you can run
-the program twice using a different device for each session.
+Some graphics cards have multiple devices on the same card, and some
+machines have several graphics cards or both a GPU and a CPU driver.
+Normally only the first device which supports the model precision is
+used.  Set the environment variable *SAS_OPENCL_MULTI=1* to instead split
+the q values across all devices, in proportion to the throughput measured
+for each device (see :class:`MultiGpuKernel`).  Use
+:func:`reset_environment` to select the devices directly, such as the
+sub-devices of a CPU created with *device.create_sub_devices*.
 
 OpenCL kernels are compiled when needed by the device driver.  Some
 drivers produce compiler output even when there is no error.  You
 can see the output by setting PYOPENCL_COMPILER_OUTPUT=1.  It should be
 harmless, albeit annoying.
+
+The compiled program binaries are saved in *CACHE_PATH*, which defaults to
+*~/.sasmodels/opencl_cache*, so that later sessions can load them without
+compiling again.  The binaries are identified by a hash of the program
+source, the build options and the device and driver, so they are rebuilt
+if any of these change.  The devices chosen when *SAS_OPENCL* is not set
+are also recorded so that the remaining platforms need not be queried
+on the next start.  Importing the module does not query OpenCL at all;
+the devices are found when the first OpenCL model needs them.  Set the
+environment variable *SAS_OPENCL_CACHE* to use a different directory, or
+to "none" to disable the cache.
+
+The work-group size, the padding of the q vector and the number of
+polydispersity points in each kernel launch can be tuned for each model,
+device, precision and size of q using :func:`autotune`.  The fastest
+settings are saved in *tuning.json* in the cache and used for the kernels
+created in later sessions.  Set *SAS_OPENCL_TUNE=1* to tune each model
+the first time it is used on a device with a new size of q.
+
+Calls which use fewer polydispersity loops than the model allows, such as
+the monodisperse calls during a fit, use kernels compiled for the number
+of active loops and the position of theta in them (see
+:func:`generate.specialize`).  These are compiled the first time they are
+needed.  Set *SAS_OPENCL_SPECIALIZE=0* to always use the full kernel.
 """
 from __future__ import print_function
 
 import os
+from os.path import join as joinpath, expanduser, exists
 import warnings
 import logging
 import time
+import threading
+import hashlib
+import json
+import tempfile
+from functools import partial
+from contextlib import contextmanager
 
 import numpy as np  # type: ignore
 
 try:
     #raise NotImplementedError("OpenCL not yet implemented for new kernel template")
     import pyopencl as cl  # type: ignore
-    # Ask OpenCL for the default context so that we know that one exists
-    cl.create_some_context(interactive=False)
 except Exception as exc:
     warnings.warn("OpenCL startup failed with ***"
                   + str(exc) + "***; using C compiler instead")
@@ -71,10 +105,15 @@ from pyopencl import mem_flags as mf
 from pyopencl.characterize import get_fast_inaccurate_build_options
 
 from . import generate
-from .kernel import KernelModel, Kernel
+from .kernel import KernelModel, Kernel, KernelFuture, get_stats
+
+# CRUFT: time.clock() is not available in python 3.8 and later
+clock = getattr(time, 'perf_counter', None) or time.clock
+# CRUFT: python 2 does not have os.replace; rename is atomic on posix
+_replace = getattr(os, 'replace', os.rename)
 
 try:
-    from typing import Tuple, Callable, Any
+    from typing import Tuple, Callable, Any, List, Dict
     from .modelinfo import ModelInfo
     from .details import CallDetails
 except ImportError:
@@ -111,6 +150,34 @@ fix_pyopencl_include()
 MAX_LOOPS = 2048
 
 
+#: Split q across all devices which support the model precision rather than
+#: using the first one.  Set *SAS_OPENCL_MULTI=1* to enable.
+MULTI_DEVICE = os.environ.get("SAS_OPENCL_MULTI", "").lower() not in (
+    "", "0", "false", "no")
+
+#: Tune the launch settings when a kernel is first created for a new model,
+#: device, precision and size of q.  Set *SAS_OPENCL_TUNE=1* to enable.
+AUTOTUNE = os.environ.get("SAS_OPENCL_TUNE", "").lower() not in (
+    "", "0", "false", "no")
+
+#: Use kernels specialized for the active polydispersity loops of each call.
+#: Set *SAS_OPENCL_SPECIALIZE=0* to disable.
+SPECIALIZE = os.environ.get("SAS_OPENCL_SPECIALIZE", "1").lower() not in (
+    "", "0", "false", "no")
+
+#: Number of q points times polydispersity points in each kernel launch
+#: when the kernel has not been tuned.
+DEFAULT_WORK = 1000000
+
+#: Directory for cached program binaries and device selection, or None if
+#: the cache is disabled.
+CACHE_PATH = os.environ.get(
+    "SAS_OPENCL_CACHE",
+    joinpath(expanduser("~"), ".sasmodels", "opencl_cache"))
+if CACHE_PATH.lower() == "none":
+    CACHE_PATH = None
+
+
 # Pragmas for enable OpenCL features.  Be sure to protect them so that they
 # still compile even if OpenCL is not present.
 _F16_PRAGMA = """\
@@ -127,16 +194,48 @@ _F64_PRAGMA = """\
 
 
 ENV = None
+_ENV_LOCK = threading.Lock()
+# Message from the failed attempt to create the environment, if any.
+_ENV_ERROR = None
 def environment():
     # type: () -> "GpuEnvironment"
     """
     Returns a singleton :class:`GpuEnvironment`.
 
-    This provides an OpenCL context and one queue per device.
+    This provides an OpenCL context and one queue per device.  The devices
+    are not queried until the environment is first needed.  Raises
+    RuntimeError if OpenCL cannot be started.
     """
-    global ENV
+    global ENV, _ENV_ERROR
     if ENV is None:
-        ENV = GpuEnvironment()
+        with _ENV_LOCK:
+            if ENV is None:
+                if _ENV_ERROR is None:
+                    try:
+                        ENV = GpuEnvironment()
+                    except Exception as exc:
+                        _ENV_ERROR = str(exc)
+                        warnings.warn("OpenCL startup failed with ***"
+                                      + _ENV_ERROR
+                                      + "***; using C compiler instead")
+                if ENV is None:
+                    raise RuntimeError("OpenCL not available: " + _ENV_ERROR)
+    return ENV
+
+def reset_environment(devices=None, multi_device=MULTI_DEVICE):
+    # type: (List[cl.Device], bool) -> "GpuEnvironment"
+    """
+    Replace the singleton :class:`GpuEnvironment` with one using *devices*,
+    or the default devices if *devices* is None, returning the new
+    environment.  If *multi_device* is True, the kernels split q across
+    all the devices which support the model precision.
+
+    Models built before the reset hold programs for the old environment,
+    so they should be built again.
+    """
+    global ENV
+    with _ENV_LOCK:
+        ENV = GpuEnvironment(devices=devices, multi_device=multi_device)
     return ENV
 
 def has_type(device, dtype):
@@ -211,38 +310,150 @@ def compile_model(context, source, dtype, fast=False):
     options = (get_fast_inaccurate_build_options(context.devices[0])
                if fast else [])
     source = "\n".join(source_list)
-    program = cl.Program(context, source).build(options=options)
+    cache_files = [_binary_cache_file(source, options, d)
+                   for d in context.devices]
+    program = _load_binaries(context, cache_files, options)
+    if program is None:
+        program = cl.Program(context, source).build(options=options)
+        _save_binaries(program, cache_files)
     #print("done with "+program)
     return program
 
+def _binary_cache_file(source, options, device):
+    # type: (str, List[str], cl.Device) -> str
+    """
+    Return the cache file for the program binary compiled from *source*
+    with *options* on *device*, or None if the cache is disabled.
+    """
+    if CACHE_PATH is None:
+        return None
+    platform = device.platform
+    identity = [source, " ".join(options), device.name, device.vendor,
+                device.version, device.driver_version,
+                platform.name, platform.version]
+    digest = hashlib.sha1("\0".join(identity).encode('utf-8')).hexdigest()
+    return joinpath(CACHE_PATH, digest + ".bin")
+
+def _load_binaries(context, cache_files, options):
+    # type: (cl.Context, List[str], List[str]) -> cl.Program
+    """
+    Build the program from the cached binaries for the devices in
+    *context*, or return None if they are not all available.
+    """
+    if not all(f is not None and exists(f) for f in cache_files):
+        return None
+    try:
+        binaries = []
+        for filename in cache_files:
+            with open(filename, "rb") as fid:
+                binaries.append(fid.read())
+        return cl.Program(context, context.devices, binaries).build(options=options)
+    except Exception as exc:
+        # A damaged or incompatible binary; compile from source instead.
+        logging.info("ignoring cached OpenCL binary: %s", exc)
+        return None
+
+def _save_binaries(program, cache_files):
+    # type: (cl.Program, List[str]) -> None
+    """
+    Save the binaries for *program* to the cache.
+    """
+    if any(f is None for f in cache_files):
+        return
+    try:
+        binaries = program.get_info(cl.program_info.BINARIES)
+        for filename, binary in zip(cache_files, binaries):
+            _write_cache_file(filename, binary)
+    except Exception as exc:
+        logging.info("could not save OpenCL binary: %s", exc)
+
+def _write_cache_file(filename, content):
+    # type: (str, bytes) -> None
+    """
+    Write *content* to *filename* in the cache, replacing it atomically so
+    that other processes never see a partial file.
+    """
+    path = os.path.dirname(filename)
+    if not exists(path):
+        try:
+            os.makedirs(path)
+        except OSError: # another process may have created it
+            pass
+    system_fd, partial = tempfile.mkstemp(dir=path, suffix=".tmp")
+    try:
+        with os.fdopen(system_fd, "wb") as fid:
+            fid.write(content)
+        _replace(partial, filename)
+    finally:
+        if exists(partial):
+            os.unlink(partial)
+
 
-# for now, this returns one device in the context
-# TODO: create a context that contains all devices on all platforms
 class GpuEnvironment(object):
     """
     GPU context, with possibly many devices, and one queue per device.
+
+    *devices* is the list of devices to use, with one context for each.  If
+    it is not given, the devices are chosen from *SAS_OPENCL*, or are the
+    best GPU and CPU available, or are all devices if *multi_device* is True.
+
+    *multi_device* is True if kernels should split q across all devices
+    which support the model precision.  *throughput* holds the number of
+    q points times polydispersity points per second measured for the
+    device in each context, which is used to choose the split.
     """
-    def __init__(self):
-        # type: () -> None
+    def __init__(self, devices=None, multi_device=MULTI_DEVICE):
+        # type: (List[cl.Device], bool) -> None
         # find gpu context
         #self.context = cl.create_some_context()
 
         self.context = None
-        if 'SAS_OPENCL' in os.environ:
+        self.multi_device = multi_device
+        if devices is not None:
+            self.context = [cl.Context([d]) for d in devices]
+        elif 'SAS_OPENCL' in os.environ:
             #Setting PYOPENCL_CTX as a SAS_OPENCL to create cl context
             os.environ["PYOPENCL_CTX"] = os.environ["SAS_OPENCL"]
-        if 'PYOPENCL_CTX' in os.environ:
+        if self.context is None and 'PYOPENCL_CTX' in os.environ:
             self._create_some_context()
 
         if not self.context:
-            self.context = _get_default_context()
+            self.context = (_get_all_contexts() if multi_device
+                            else _get_default_context())
 
         # Byte boundary for data alignment
         #self.data_boundary = max(d.min_data_type_align_size
         #                         for d in self.context.devices)
         self.queues = [cl.CommandQueue(context, context.devices[0])
                        for context in self.context]
+        # Until measured, assume throughput scales with compute units.
+        self.throughput = [
+            float(max(1, sum(d.max_compute_units*d.max_clock_frequency
+                             for d in context.devices)))
+            for context in self.context]
         self.compiled = {}
+        self._compile_lock = threading.Lock()
+        self.tuning = _load_tuning()
+        self._tuning_lock = threading.Lock()
+
+    def get_tuning(self, key):
+        # type: (str) -> Dict[str, Any]
+        """
+        Return the tuned launch settings saved for *key*, or None if the
+        kernel has not been tuned.  See :func:`tuning_key`.
+        """
+        return self.tuning.get(key, None)
+
+    def set_tuning(self, key, settings):
+        # type: (str, Dict[str, Any]) -> None
+        """
+        Save the launch *settings* for *key* for use in later sessions.
+        """
+        with self._tuning_lock:
+            # Merge with the settings saved by other processes.
+            self.tuning = dict(_load_tuning(), **self.tuning)
+            self.tuning[key] = settings
+            _save_tuning(self.tuning)
 
     def has_type(self, dtype):
         # type: (np.dtype) -> bool
@@ -262,6 +473,23 @@ class GpuEnvironment(object):
             if all(has_type(d, dtype) for d in context.devices):
                 return queue
 
+    def make_queue(self, dtype, context=None, profile=False):
+        # type: (np.dtype, cl.Context, bool) -> cl.CommandQueue
+        """
+        Return a new command queue for the kernels of type dtype, using
+        *context* if it is given.  If *profile* is True, the queue records
+        the start and end time of each command.
+
+        Commands on a queue run in order, so kernels which need to run at
+        the same time as other kernels should use their own queue.
+        """
+        if context is None:
+            context = self.get_context(dtype)
+        properties = (cl.command_queue_properties.PROFILING_ENABLE
+                      if profile else 0)
+        return cl.CommandQueue(context, context.devices[0],
+                               properties=properties)
+
     def get_context(self, dtype):
         # type: (np.dtype) -> cl.Context
         """
@@ -271,6 +499,14 @@ class GpuEnvironment(object):
             if all(has_type(d, dtype) for d in context.devices):
                 return context
 
+    def get_contexts(self, dtype):
+        # type: (np.dtype) -> List[cl.Context]
+        """
+        Return all OpenCL contexts which support kernels of type dtype.
+        """
+        return [context for context in self.context
+                if all(has_type(d, dtype) for d in context.devices)]
+
     def _create_some_context(self):
         # type: () -> cl.Context
         """
@@ -285,27 +521,31 @@ class GpuEnvironment(object):
             warnings.warn("pyopencl.create_some_context() failed")
             warnings.warn("the environment variable 'SAS_OPENCL' might not be set correctly")
 
-    def compile_program(self, name, source, dtype, fast, timestamp):
-        # type: (str, str, np.dtype, bool, float) -> cl.Program
+    def compile_program(self, name, source, dtype, fast, timestamp,
+                        context=None):
+        # type: (str, str, np.dtype, bool, float, cl.Context) -> cl.Program
         """
-        Compile the program for the device in the given context.
+        Compile the program for the devices in *context*, or for the first
+        context supporting *dtype* if *context* is None.
         """
         # Note: PyOpenCL caches based on md5 hash of source, options and device
         # so we don't really need to cache things for ourselves.  I'll do so
         # anyway just to save some data munging time.
         tag = generate.tag_source(source)
-        key = "%s-%s-%s%s"%(name, dtype, tag, ("-fast" if fast else ""))
-        # Check timestamp on program
-        program, program_timestamp = self.compiled.get(key, (None, np.inf))
-        if program_timestamp < timestamp:
-            del self.compiled[key]
-        if key not in self.compiled:
+        if context is None:
             context = self.get_context(dtype)
-            logging.info("building %s for OpenCL %s", key,
-                         context.devices[0].name.strip())
-            program = compile_model(self.get_context(dtype),
-                                    str(source), dtype, fast)
-            self.compiled[key] = (program, timestamp)
+        key = "%s-%s-%s%s-%d"%(name, dtype, tag, ("-fast" if fast else ""),
+                               self.context.index(context))
+        with self._compile_lock:
+            # Check timestamp on program
+            program, program_timestamp = self.compiled.get(key, (None, np.inf))
+            if program_timestamp < timestamp:
+                del self.compiled[key]
+            if key not in self.compiled:
+                logging.info("building %s for OpenCL %s", key,
+                             context.devices[0].name.strip())
+                program = compile_model(context, str(source), dtype, fast)
+                self.compiled[key] = (program, timestamp)
         return program
 
 def _get_default_context():
@@ -313,6 +553,223 @@ def _get_default_context():
     """
     Get an OpenCL context, preferring GPU over CPU, and preferring Intel
     drivers over AMD drivers.
+
+    The selected devices are saved in the cache and reused if the same
+    OpenCL platforms are available next time, so only the devices of the
+    selected platforms are queried.
+    """
+    devices = _load_device_selection()
+    if devices is None:
+        platforms = cl.get_platforms()
+        devices = _select_default_devices(platforms)
+        _save_device_selection(platforms, devices)
+    return [cl.Context([d]) for d in devices]
+
+def _tuning_file():
+    # type: () -> str
+    return None if CACHE_PATH is None else joinpath(CACHE_PATH, "tuning.json")
+
+def _load_tuning():
+    # type: () -> Dict[str, Dict[str, Any]]
+    """
+    Return the launch settings saved by :func:`_save_tuning`.
+    """
+    filename = _tuning_file()
+    if filename is None or not exists(filename):
+        return {}
+    try:
+        with open(filename) as fid:
+            return json.load(fid)
+    except Exception as exc:
+        logging.info("ignoring cached OpenCL tuning: %s", exc)
+        return {}
+
+def _save_tuning(tuning):
+    # type: (Dict[str, Dict[str, Any]]) -> None
+    """
+    Save the launch settings to the cache.
+    """
+    filename = _tuning_file()
+    if filename is None:
+        return
+    try:
+        content = json.dumps(tuning, indent=2, sort_keys=True)
+        _write_cache_file(filename, content.encode('utf-8'))
+    except Exception as exc:
+        logging.info("could not save OpenCL tuning: %s", exc)
+
+def tuning_key(model_info, dim, dtype, fast, device, nq):
+    # type: (ModelInfo, str, np.dtype, bool, cl.Device, int) -> str
+    """
+    Return the key for the tuned launch settings of the *dim* kernel of
+    *model_info* with precision *dtype* (and *fast*) running on *device*.
+    Kernels share settings if *nq* rounds up to the same power of two.
+    """
+    bucket = 1 << int(np.ceil(np.log2(max(nq, 1))))
+    precision = np.dtype(dtype).name + ("-fast" if fast else "")
+    platform = device.platform
+    return "|".join([model_info.name, dim, precision, device.name.strip(),
+                     device.driver_version, platform.name.strip(),
+                     str(bucket)])
+
+def default_tuning(is_2d):
+    # type: (bool) -> Dict[str, Any]
+    """
+    Return the launch settings for a kernel which has not been tuned.
+
+    *local_size* is the work-group size, or None to let the driver choose.
+    *boundary* is the multiple to which the q vector is padded, which must
+    be a multiple of the work-group size.  *work* is the number of q points
+    times polydispersity points in each kernel launch.
+    """
+    # Note: 16 and 32 are good on the set of architectures tested so far.
+    return dict(local_size=None, boundary=16 if is_2d else 32,
+                work=DEFAULT_WORK)
+
+def autotune(model, q_vectors, pars=None, context=None, repeat=3):
+    # type: ("GpuModel", List[np.ndarray], Dict[str, float], cl.Context, int) -> Dict[str, Any]
+    """
+    Find the fastest launch settings for *model* at *q_vectors* on the
+    device for *context*, save them, and return them.
+
+    The work-group size and q padding are chosen first from multiples of
+    the preferred work-group size multiple for the kernel, then the number
+    of points per launch is chosen for the best work-group size.  Each
+    candidate is timed with the best of *repeat* calls using the parameters
+    *pars*.  The default parameters disperse the first two polydisperse
+    parameters of the model with 35 points each, so that the polydispersity
+    loop is split into several launches.
+    """
+    from .direct_model import call_kernel
+
+    env = environment()
+    if context is None:
+        context = env.get_context(model.dtype)
+    is_2d = len(q_vectors) == 2
+    dim = '2d' if is_2d else '1d'
+    kernel = model._get_kernel(context, is_2d)
+    device = context.devices[0]
+    if pars is None:
+        parameters = model.info.parameters
+        active = parameters.pd_2d if is_2d else parameters.pd_1d
+        dispersed = [p.name for p in parameters.call_parameters
+                     if p.name in active][:2]
+        pars = {}
+        for name in dispersed:
+            pars[name+'_pd'] = 10. if parameters[name].type == 'orientation' else 0.1
+            pars[name+'_pd_n'] = 35
+
+    def _time(settings):
+        # type: (Dict[str, Any]) -> float
+        calculator = GpuKernel(kernel, model.dtype, model.info, q_vectors,
+                               lock=model._lock, context=context,
+                               tuning=settings)
+        try:
+            call_kernel(calculator, pars)  # warm up
+            best = np.inf
+            for _ in range(repeat):
+                start = clock()
+                call_kernel(calculator, pars)
+                best = min(best, clock() - start)
+            return best
+        except Exception as exc:
+            logging.info("tuning %s failed for %s: %s",
+                         model.info.name, settings, exc)
+            return np.inf
+        finally:
+            calculator.release()
+
+    default = default_tuning(is_2d)
+    max_local = kernel[0].get_work_group_info(
+        cl.kernel_work_group_info.WORK_GROUP_SIZE, device)
+    warp = kernel[0].get_work_group_info(
+        cl.kernel_work_group_info.PREFERRED_WORK_GROUP_SIZE_MULTIPLE, device)
+    candidates = [default]
+    candidates.extend([dict(default, boundary=2*default['boundary']),
+                       dict(default, boundary=4*default['boundary'])])
+    for local_size in (warp, 2*warp, 4*warp, 8*warp):
+        if local_size <= max_local:
+            boundary = -(-default['boundary']//local_size)*local_size
+            candidates.append(dict(default, local_size=local_size,
+                                   boundary=boundary))
+    best = min(candidates, key=_time)
+    candidates = [dict(best, work=work)
+                  for work in (DEFAULT_WORK//4, DEFAULT_WORK, DEFAULT_WORK*4)]
+    best = min(candidates, key=_time)
+    nq = q_vectors[0].size
+    key = tuning_key(model.info, dim, model.dtype, model.fast, device, nq)
+    logging.info("tuned %s: %s", key, best)
+    env.set_tuning(key, best)
+    return best
+
+def _get_all_contexts():
+    # type: () -> List[cl.Context]
+    """
+    Get an OpenCL context for every device on every platform.
+    """
+    return [cl.Context([d])
+            for platform in cl.get_platforms()
+            for d in platform.get_devices()]
+
+def _device_selection_file():
+    # type: () -> str
+    return None if CACHE_PATH is None else joinpath(CACHE_PATH, "devices.json")
+
+def _load_device_selection():
+    # type: () -> List[cl.Device]
+    """
+    Return the devices saved by :func:`_save_device_selection`, or None if
+    there are none or the platforms have changed.
+
+    The cache is read before OpenCL is queried.  The platform handles are
+    needed to look up the devices, but only the devices on the selected
+    platforms are enumerated.
+    """
+    filename = _device_selection_file()
+    if filename is None or not exists(filename):
+        return None
+    try:
+        with open(filename) as fid:
+            selection = json.load(fid)
+        platforms = cl.get_platforms()
+        if selection['platforms'] != [p.name for p in platforms]:
+            return None
+        devices = []
+        for platform_index, device_name in selection['devices']:
+            # Only query the devices on the platforms that were selected.
+            matches = [d for d in platforms[platform_index].get_devices()
+                       if d.name == device_name]
+            if not matches:
+                return None
+            devices.append(matches[0])
+        return devices
+    except Exception as exc:
+        logging.info("ignoring cached OpenCL device selection: %s", exc)
+        return None
+
+def _save_device_selection(platforms, devices):
+    # type: (List[cl.Platform], List[cl.Device]) -> None
+    """
+    Save the selected devices to the cache.
+    """
+    filename = _device_selection_file()
+    if filename is None:
+        return
+    platform_names = [p.name for p in platforms]
+    selection = {
+        'platforms': platform_names,
+        'devices': [(platforms.index(d.platform), d.name)
+                    for d in devices],
+    }
+    try:
+        _write_cache_file(filename, json.dumps(selection).encode('utf-8'))
+    except Exception as exc:
+        logging.info("could not save OpenCL device selection: %s", exc)
+
+def _select_default_devices(platforms):
+    # type: (List[cl.Platform]) -> List[cl.Device]
+    """
+    Search the OpenCL *platforms* for the best GPU and CPU devices.
     """
     # Note: on mobile devices there is automatic clock scaling if either the
     # CPU or the GPU is underutilized; probably doesn't affect us, but we if
@@ -326,7 +783,7 @@ def _get_default_context():
     # 2 x nvidia 295 with Intel and NVIDIA opencl drivers installed
     #     {'Intel': [CPU], 'NVIDIA': [GPU, GPU, GPU, GPU]}
     gpu, cpu = None, None
-    for platform in cl.get_platforms():
+    for platform in platforms:
         # AMD provides a much weaker CPU driver than Intel/Apple, so avoid it.
         # If someone has bothered to install the AMD/NVIDIA drivers, prefer
         # them over the integrated graphics driver that may have been supplied
@@ -362,7 +819,7 @@ def _get_default_context():
         devices.append(gpu)
     if cpu is not None:
         devices.append(cpu)
-    return [cl.Context([d]) for d in devices]
+    return devices
 
 
 class GpuModel(KernelModel):
@@ -387,7 +844,9 @@ class GpuModel(KernelModel):
         self.dtype = dtype
         self.fast = fast
         self.program = None # delay program creation
-        self._kernels = None
+        # (context index, loop key): {variant: kernel}, or None if failed
+        self._kernels = {}  # type: Dict[Tuple[int, Tuple[int, int]], Dict[str, cl.Kernel]]
+        self._lock = threading.Lock()
 
     def __getstate__(self):
         # type: () -> Tuple[ModelInfo, str, np.dtype, bool]
@@ -397,28 +856,84 @@ class GpuModel(KernelModel):
         # type: (Tuple[ModelInfo, str, np.dtype, bool]) -> None
         self.info, self.source, self.dtype, self.fast = state
         self.program = None
+        self._kernels = {}
+        self._lock = threading.Lock()
 
     def make_kernel(self, q_vectors):
-        # type: (List[np.ndarray]) -> "GpuKernel"
-        if self.program is None:
-            compile_program = environment().compile_program
+        # type: (List[np.ndarray]) -> Kernel
+        env = environment()
+        is_2d = len(q_vectors) == 2
+        contexts = env.get_contexts(self.dtype)
+        if env.multi_device and len(contexts) > 1:
+            kernels = [(context, self._get_kernel(context, is_2d))
+                       for context in contexts]
+            return MultiGpuKernel(kernels, self.dtype, self.info, q_vectors,
+                                  lock=self._lock,
+                                  specialized=partial(self._get_specialized, is_2d))
+        context = contexts[0]
+        kernel = self._get_kernel(context, is_2d)
+        key = tuning_key(self.info, '2d' if is_2d else '1d', self.dtype,
+                         self.fast, context.devices[0], q_vectors[0].size)
+        tuning = env.get_tuning(key)
+        if tuning is None and AUTOTUNE:
+            tuning = autotune(self, q_vectors, context=context)
+        return GpuKernel(kernel, self.dtype, self.info, q_vectors,
+                         lock=self._lock, tuning=tuning, context=context,
+                         specialized=partial(self._get_specialized, is_2d, context))
+
+    def _get_kernel(self, context, is_2d, key=None):
+        # type: (cl.Context, bool, Tuple[int, int]) -> List[cl.Kernel]
+        """
+        Return the [plain, magnetic] kernel pair for *context*, compiling
+        the program for the context if it is not yet compiled.
+
+        If *key* is given, return the kernels specialized for the
+        polydispersity loops in *key* (see :func:`generate.specialize`).
+        """
+        index = environment().context.index(context)
+        if (index, key) not in self._kernels:
+            source = self.source['opencl']
+            if key is not None:
+                source = generate.specialize(source, key)
             timestamp = generate.ocl_timestamp(self.info)
-            self.program = compile_program(
+            program = environment().compile_program(
                 self.info.name,
-                self.source['opencl'],
+                source,
                 self.dtype,
                 self.fast,
-                timestamp)
+                timestamp,
+                context=context)
+            if self.program is None and key is None:
+                self.program = program
             variants = ['Iq', 'Iqxy', 'Imagnetic']
             names = [generate.kernel_name(self.info, k) for k in variants]
-            kernels = [getattr(self.program, k) for k in names]
-            self._kernels = dict((k, v) for k, v in zip(variants, kernels))
-        is_2d = len(q_vectors) == 2
+            kernels = [getattr(program, k) for k in names]
+            self._kernels[index, key] = dict(zip(variants, kernels))
+        kernels = self._kernels[index, key]
         if is_2d:
-            kernel = [self._kernels['Iqxy'], self._kernels['Imagnetic']]
+            return [kernels['Iqxy'], kernels['Imagnetic']]
         else:
-            kernel = [self._kernels['Iq']]*2
-        return GpuKernel(kernel, self.dtype, self.info, q_vectors)
+            return [kernels['Iq']]*2
+
+    def _get_specialized(self, is_2d, context, key):
+        # type: (bool, cl.Context, Tuple[int, int]) -> List[cl.Kernel]
+        """
+        Return the [plain, magnetic] kernel pair for *context* specialized
+        for the polydispersity loops in *key*, or None if the full kernel
+        should be used.
+        """
+        # The full kernel already walks every loop.
+        if not SPECIALIZE or key[0] >= self.info.parameters.max_pd:
+            return None
+        index = environment().context.index(context)
+        if self._kernels.get((index, key), True) is None:
+            return None
+        try:
+            return self._get_kernel(context, is_2d, key)
+        except Exception as exc:
+            logging.warning("using unspecialized %s: %s", self.info.name, exc)
+            self._kernels[index, key] = None
+            return None
 
     def release(self):
         # type: () -> None
@@ -427,6 +942,7 @@ class GpuModel(KernelModel):
         """
         if self.program is not None:
             self.program = None
+        self._kernels = {}
 
     def __del__(self):
         # type: () -> None
@@ -449,33 +965,40 @@ class GpuInput(object):
     precision, so even if the program was created for double precision,
     the *GpuProgram.dtype* may be single precision.
 
+    *context* is the OpenCL context holding the q buffer, which defaults to
+    the first context supporting *dtype*.
+
+    *boundary* is the multiple to which the q vector is padded, which
+    defaults to 16 for 2-D and 32 for 1-D.  The padding includes space for
+    the normalization at the end of the result.
+
     Call :meth:`release` when complete.  Even if not called directly, the
     buffer will be released when the data object is freed.
     """
-    def __init__(self, q_vectors, dtype=generate.F32):
-        # type: (List[np.ndarray], np.dtype) -> None
+    def __init__(self, q_vectors, dtype=generate.F32, context=None,
+                 boundary=None):
+        # type: (List[np.ndarray], np.dtype, cl.Context, int) -> None
         # TODO: do we ever need double precision q?
         env = environment()
         self.nq = q_vectors[0].size
         self.dtype = np.dtype(dtype)
         self.is_2d = (len(q_vectors) == 2)
-        # TODO: stretch input based on get_warp()
-        # not doing it now since warp depends on kernel, which is not known
-        # at this point, so instead using 32, which is good on the set of
-        # architectures tested so far.
+        # The best boundary depends on the kernel and the device, so it is
+        # chosen by autotune() when the kernel is tuned.
+        if boundary is None:
+            boundary = default_tuning(self.is_2d)['boundary']
+        # Note: nq rather than nq-1 because result is 1 longer than input.
+        width = ((self.nq+boundary)//boundary)*boundary
         if self.is_2d:
-            # Note: 16 rather than 15 because result is 1 longer than input.
-            width = ((self.nq+16)//16)*16
             self.q = np.empty((width, 2), dtype=dtype)
             self.q[:self.nq, 0] = q_vectors[0]
             self.q[:self.nq, 1] = q_vectors[1]
         else:
-            # Note: 32 rather than 31 because result is 1 longer than input.
-            width = ((self.nq+32)//32)*32
             self.q = np.empty(width, dtype=dtype)
             self.q[:self.nq] = q_vectors[0]
         self.global_size = [self.q.shape[0]]
-        context = env.get_context(self.dtype)
+        if context is None:
+            context = env.get_context(self.dtype)
         #print("creating inputs of size", self.global_size)
         self.q_b = cl.Buffer(context, mf.READ_ONLY | mf.COPY_HOST_PTR,
                              hostbuf=self.q)
@@ -505,34 +1028,69 @@ class GpuKernel(Kernel):
 
     *dtype* is the kernel precision
 
+    *lock* is held while setting the arguments and running *kernel*.  The
+    OpenCL kernel objects remember their arguments, so all kernels using
+    the same OpenCL kernel objects should share the lock.
+
+    *context* is the OpenCL context for *kernel*, which defaults to the
+    first context supporting *dtype*.  If *profile* is True the command
+    queue records the time for each command.
+
+    *tuning* holds the launch settings, as returned from :func:`autotune`,
+    or None for :func:`default_tuning`.
+
+    *specialized* returns the [plain, magnetic] kernels specialized for
+    the loop key of the call details (see :attr:`CallDetails.loop_key`),
+    or None if *kernel* should be used.  Batch calls always use *kernel*.
+
     The resulting call method takes the *pars*, a list of values for
     the fixed parameters to the kernel, and *pd_pars*, a list of (value,weight)
     vectors for the polydisperse parameters.  *cutoff* determines the
     integration limits: any points with combined weight less than *cutoff*
     will not be calculated.
 
+    The device buffers for the call details and values are kept between
+    calls and grow as needed.  The call details are only copied to the
+    device when they differ from the previous call.  On devices which share
+    memory with the host, such as the CPU, creating a buffer from host
+    memory is cheaper than queuing a copy, so the buffers are replaced
+    rather than updated when they change.
+
+    Each kernel has its own command queue, so :meth:`submit` can start
+    calls on several kernels which then run on the device at the same time.
+
     Call :meth:`release` when done with the kernel instance.
     """
-    def __init__(self, kernel, dtype, model_info, q_vectors):
-        # type: (cl.Kernel, np.dtype, ModelInfo, List[np.ndarray]) -> None
-        q_input = GpuInput(q_vectors, dtype)
+    sparse = True
+    def __init__(self, kernel, dtype, model_info, q_vectors, lock=None,
+                 context=None, profile=False, tuning=None, specialized=None):
+        # type: (cl.Kernel, np.dtype, ModelInfo, List[np.ndarray], threading.Lock, cl.Context, bool, Dict[str, Any], Callable[[Tuple[int, int]], List[cl.Kernel]]) -> None
+        if tuning is None:
+            tuning = default_tuning(len(q_vectors) == 2)
+        q_input = GpuInput(q_vectors, dtype, context=context,
+                           boundary=tuning['boundary'])
+        self.local_size = tuning['local_size']
+        self.work = tuning['work']
         self.kernel = kernel
+        self.specialized = specialized
         self.info = model_info
         self.dtype = dtype
         self.dim = '2d' if q_input.is_2d else '1d'
-        # plus three for the normalization values
-        self.result = np.empty(q_input.nq+1, dtype)
 
         # Inputs and outputs for each kernel call
         # Note: res may be shorter than res_b if global_size != nq
         env = environment()
-        self.queue = env.get_queue(dtype)
+        self.queue = env.make_queue(dtype, context=context, profile=profile)
 
         self.result_b = cl.Buffer(self.queue.context, mf.READ_WRITE,
                                   q_input.global_size[0] * dtype.itemsize)
         self.q_input = q_input # allocated by GpuInput above
 
         self._need_release = [self.result_b, self.q_input]
+        # name: (device buffer, copy of the last upload or None)
+        self._pool = {}  # type: Dict[str, Tuple[cl.Buffer, np.ndarray]]
+        self._copy_to_pool = not self.queue.device.host_unified_memory
+        self._lock = threading.Lock() if lock is None else lock
         self.real = (np.float32 if dtype == generate.F32
                      else np.float64 if dtype == generate.F64
                      else np.float16 if dtype == generate.F16
@@ -540,52 +1098,246 @@ class GpuKernel(Kernel):
 
     def __call__(self, call_details, values, cutoff, magnetic):
         # type: (CallDetails, np.ndarray, np.ndarray, float, bool) -> np.ndarray
-        context = self.queue.context
-        # Arrange data transfer to card
-        details_b = cl.Buffer(context, mf.READ_ONLY | mf.COPY_HOST_PTR,
-                              hostbuf=call_details.buffer)
-        values_b = cl.Buffer(context, mf.READ_ONLY | mf.COPY_HOST_PTR,
-                             hostbuf=values)
+        total, pd_norm = self.call_parts(call_details, values, cutoff, magnetic)
+        scale = values[0]/(pd_norm if pd_norm != 0.0 else 1.0)
+        background = values[1]
+        #print("scale",scale,values[0],pd_norm,background)
+        return scale*total + background
 
-        kernel = self.kernel[1 if magnetic else 0]
-        args = [
-            np.uint32(self.q_input.nq), None, None,
-            details_b, values_b, self.q_input.q_b, self.result_b,
-            self.real(cutoff),
-        ]
+    def call_parts(self, call_details, values, cutoff, magnetic):
+        # type: (CallDetails, np.ndarray, float, bool) -> Tuple[np.ndarray, float]
+        stats = get_stats()
+        kernel = self._select_kernel(call_details, magnetic)
         #print("Calling OpenCL")
         #call_details.show(values)
         # Call kernel and retrieve results
-        wait_for = None
-        last_nap = time.clock()
-        step = 1000000//self.q_input.nq + 1
-        for start in range(0, call_details.num_eval, step):
-            stop = min(start + step, call_details.num_eval)
+        # plus one for the normalization value
+        result = np.empty(self.q_input.nq+1, self.dtype)
+        with self._lock:
+            if stats is not None:
+                start_time = clock()
+            # Arrange data transfer to card
+            details_b, details_bytes = self._upload(
+                'details', call_details.buffer, reuse=True)
+            values_b, values_bytes = self._upload('values', values)
+            if stats is not None:
+                upload_time = clock()
+            args = [
+                np.uint32(self.q_input.nq), None, None,
+                details_b, values_b, self.q_input.q_b, self.result_b,
+                self.real(cutoff),
+                np.int32(0), np.int32(0), # no batch strides
+            ]
+            step = self.work//self.q_input.nq + 1
+            self._enqueue(kernel, self.q_input.global_size, args,
+                          call_details.num_eval, step)
+            if stats is not None:
+                # Wait for the kernel so the copy time is measured separately.
+                self.queue.finish()
+                compute_time = clock()
+            cl.enqueue_copy(self.queue, result, self.result_b)
+        #print("result", result)
+
+        if stats is not None:
+            self._record_call(
+                stats, self.q_input.nq, call_details, values, cutoff,
+                chunks=-(-call_details.num_eval//step),
+                bytes_to_device=details_bytes + values_bytes,
+                time_upload=upload_time-start_time,
+                time_compute=compute_time-upload_time,
+                time_download=clock()-compute_time)
+        return result[:self.q_input.nq], result[self.q_input.nq]
+
+    def call_batch(self, call_details, values, cutoff, magnetic):
+        # type: (List[CallDetails], List[np.ndarray], float, bool) -> np.ndarray
+        if any(d.sparse for d in call_details):
+            return Kernel.call_batch(self, call_details, values, cutoff, magnetic)
+        stats = get_stats()
+        nq, num_sets = self.q_input.nq, len(values)
+        width = self.q_input.global_size[0]
+
+        # Stack the details and values for the parameter sets into blocks,
+        # one row per set, and send them to the card in one transfer.
+        details = np.vstack([d.buffer for d in call_details])
+        stride = max(len(v) for v in values)
+        blocks = np.zeros((num_sets, stride), self.dtype)
+        for k, v in enumerate(values):
+            blocks[k, :len(v)] = v
+        result = np.empty((num_sets, width), self.dtype)
+
+        kernel = self.kernel[1 if magnetic else 0]
+        # The kernel skips the parameter sets which have already completed
+        # their polydispersity loop, so run chunks until the longest is done.
+        num_eval = max(d.num_eval for d in call_details)
+        global_size = [width, num_sets]
+        with self._lock:
+            if stats is not None:
+                start_time = clock()
+            details_b, details_bytes = self._upload(
+                'batch_details', details, reuse=True)
+            values_b, values_bytes = self._upload('batch_values', blocks)
+            result_b = self._buffer('batch_result', result.nbytes)
+            if stats is not None:
+                upload_time = clock()
+            args = [
+                np.uint32(nq), None, None,
+                details_b, values_b, self.q_input.q_b, result_b,
+                self.real(cutoff),
+                np.int32(stride), np.int32(width),
+            ]
+            step = self.work//(nq*num_sets) + 1
+            self._enqueue(kernel, global_size, args, num_eval, step)
+            if stats is not None:
+                self.queue.finish()
+                compute_time = clock()
+            cl.enqueue_copy(self.queue, result, result_b)
+        if stats is not None:
+            self._record_batch(
+                stats, nq, call_details, values, cutoff,
+                chunks=-(-num_eval//step),
+                bytes_to_device=details_bytes + values_bytes,
+                time_upload=upload_time-start_time,
+                time_compute=compute_time-upload_time,
+                time_download=clock()-compute_time)
+
+        pd_norm = result[:, nq]
+        pd_norm[pd_norm == 0.0] = 1.0
+        scale = blocks[:, 0:1]/pd_norm[:, None]
+        background = blocks[:, 1:2]
+        return scale*result[:, :nq] + background
+
+    def submit(self, call_details, values, cutoff, magnetic):
+        # type: (CallDetails, np.ndarray, float, bool) -> "GpuFuture"
+        """
+        Queue the kernel call and the copy of the result from the device,
+        returning a :class:`GpuFuture` without waiting for them to complete.
+
+        *values* should not be modified until the result is available.
+        """
+        stats = get_stats()
+        events, event, result, nbytes = self._start(
+            call_details, values, cutoff, magnetic)
+        if stats is not None:
+            self._record_call(
+                stats, self.q_input.nq, call_details, values, cutoff,
+                chunks=len(events), bytes_to_device=nbytes)
+        return GpuFuture(event, result, values)
+
+    def _start(self, call_details, values, cutoff, magnetic):
+        # type: (CallDetails, np.ndarray, float, bool) -> Tuple[List[cl.Event], cl.Event, np.ndarray, int]
+        """
+        Queue the kernel call without waiting for it to complete.
+
+        Returns the events for the kernel chunks, the event for the copy
+        of the result from the device, the result array which will hold
+        the unnormalized sum followed by the normalization, and the number
+        of bytes copied to the device.
+        """
+        kernel = self._select_kernel(call_details, magnetic)
+        result = np.empty(self.q_input.nq+1, self.dtype)
+        with self._lock:
+            details_b, details_bytes = self._upload(
+                'details', call_details.buffer, reuse=True)
+            values_b, values_bytes = self._upload('values', values)
+            args = [
+                np.uint32(self.q_input.nq), None, None,
+                details_b, values_b, self.q_input.q_b, self.result_b,
+                self.real(cutoff),
+                np.int32(0), np.int32(0), # no batch strides
+            ]
+            step = self.work//self.q_input.nq + 1
+            events = self._enqueue(kernel, self.q_input.global_size, args,
+                                   call_details.num_eval, step, nap=False)
+            event = cl.enqueue_copy(self.queue, result, self.result_b,
+                                    wait_for=events[-1:] or None,
+                                    is_blocking=False)
+        # Start the commands on the device without waiting for them.
+        self.queue.flush()
+        return events, event, result, details_bytes + values_bytes
+
+    def _select_kernel(self, call_details, magnetic):
+        # type: (CallDetails, bool) -> cl.Kernel
+        """
+        Return the kernel for *call_details*, preferring the kernel
+        specialized for its polydispersity loops.
+        """
+        kernels = (None if self.specialized is None
+                   else self.specialized(call_details.loop_key))
+        if kernels is None:
+            kernels = self.kernel
+        return kernels[1 if magnetic else 0]
+
+    def _enqueue(self, kernel, global_size, args, num_eval, step, nap=True):
+        # type: (cl.Kernel, List[int], List[Any], int, int, bool) -> List[cl.Event]
+        """
+        Queue *kernel* in chunks of *step* points from the polydispersity
+        loop until *num_eval* points are done, returning the events for the
+        chunks in order.
+
+        If *nap* is True then wait for each chunk before queuing the next,
+        pausing now and then to allow other processes to use the device.
+        The caller must hold the kernel lock.
+        """
+        local_size = (None if self.local_size is None
+                      else [self.local_size] + [1]*(len(global_size)-1))
+        events = []  # type: List[cl.Event]
+        last_nap = clock()
+        for start in range(0, num_eval, step):
+            stop = min(start + step, num_eval)
             #print("queuing",start,stop)
             args[1:3] = [np.int32(start), np.int32(stop)]
-            wait_for = [kernel(self.queue, self.q_input.global_size, None,
-                               *args, wait_for=wait_for)]
-            if stop < call_details.num_eval:
+            events.append(kernel(self.queue, global_size, local_size,
+                                 *args, wait_for=events[-1:] or None))
+            if nap and stop < num_eval:
                 # Allow other processes to run
-                wait_for[0].wait()
-                current_time = time.clock()
+                events[-1].wait()
+                current_time = clock()
                 if current_time - last_nap > 0.5:
                     time.sleep(0.05)
                     last_nap = current_time
-        cl.enqueue_copy(self.queue, self.result, self.result_b)
-        #print("result", self.result)
+        return events
 
-        # Free buffers
-        for v in (details_b, values_b):
-            if v is not None:
-                v.release()
+    def _buffer(self, name, nbytes):
+        # type: (str, int) -> cl.Buffer
+        """
+        Return the device buffer *name* from the pool, replacing it with a
+        larger buffer if it is smaller than *nbytes*.  The buffer size at
+        least doubles when it grows, so a sequence of larger calls does not
+        allocate on every call.
+        """
+        buffer, _ = self._pool.get(name, (None, None))
+        if buffer is None or buffer.size < nbytes:
+            size = nbytes if buffer is None else max(nbytes, 2*buffer.size)
+            if buffer is not None:
+                buffer.release()
+            buffer = cl.Buffer(self.queue.context, mf.READ_WRITE, size)
+            self._pool[name] = (buffer, None)
+        return buffer
+
+    def _upload(self, name, hostbuf, reuse=False):
+        # type: (str, np.ndarray, bool) -> Tuple[cl.Buffer, int]
+        """
+        Copy *hostbuf* to the device buffer *name* from the pool, returning
+        the buffer and the number of bytes copied.  If *reuse* is True then
+        the copy is skipped when *hostbuf* is the same as the previous upload.
 
-        pd_norm = self.result[self.q_input.nq]
-        scale = values[0]/(pd_norm if pd_norm != 0.0 else 1.0)
-        background = values[1]
-        #print("scale",scale,values[0],self.result[self.q_input.nq],background)
-        return scale*self.result[:self.q_input.nq] + background
-        # return self.result[:self.q_input.nq]
+        The copy does not block, so *hostbuf* must not be modified until the
+        kernel has completed.  The caller must hold the kernel lock.
+        """
+        buffer, previous = self._pool.get(name, (None, None))
+        if (reuse and previous is not None and previous.dtype == hostbuf.dtype
+                and np.array_equal(previous, hostbuf)):
+            return buffer, 0
+        if self._copy_to_pool:
+            buffer = self._buffer(name, hostbuf.nbytes)
+            cl.enqueue_copy(self.queue, buffer, hostbuf, is_blocking=False)
+        else:
+            if buffer is not None:
+                buffer.release()
+            buffer = cl.Buffer(self.queue.context,
+                               mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=hostbuf)
+        self._pool[name] = (buffer, np.array(hostbuf) if reuse else None)
+        return buffer, hostbuf.nbytes
 
     def release(self):
         # type: () -> None
@@ -595,7 +1347,437 @@ class GpuKernel(Kernel):
         for v in self._need_release:
             v.release()
         self._need_release = []
+        for buffer, _ in self._pool.values():
+            buffer.release()
+        self._pool = {}
+
+    def __del__(self):
+        # type: () -> None
+        self.release()
+
+
+class MultiGpuKernel(Kernel):
+    """
+    Callable SAS kernel which splits q across several OpenCL devices.
+
+    *kernels* is a list of (context, kernel) pairs, with one pair for each
+    device, where *kernel* is the [plain, magnetic] pair of OpenCL kernels
+    compiled for the context.  *specialized(context, key)* returns the
+    specialized kernels for the context, or None.  The remaining arguments
+    are as for :class:`GpuKernel`.
+
+    The q points are divided into contiguous blocks, one for each device,
+    in proportion to the throughput recorded for the device in the
+    environment.  Each block is evaluated by a :class:`GpuKernel` on its
+    own queue, and the blocks run at the same time.  The device time for
+    each block is measured, and if the measured throughput no longer
+    matches the split, the q points are divided again for the next call.
+
+    Call :meth:`release` when done with the kernel instance.
+    """
+    sparse = True
+    #: Relative change in the split which triggers a new division of q.
+    rebalance_tolerance = 0.05
+    #: Minimum device time in seconds for a throughput measurement.
+    min_measure_time = 0.01
+
+    def __init__(self, kernels, dtype, model_info, q_vectors, lock=None,
+                 specialized=None):
+        # type: (List[Tuple[cl.Context, List[cl.Kernel]]], np.dtype, ModelInfo, List[np.ndarray], threading.Lock, Callable[[cl.Context, Tuple[int, int]], List[cl.Kernel]]) -> None
+        self.kernels = kernels
+        self.specialized = specialized
+        self.info = model_info
+        self.dtype = dtype
+        self.dim = '2d' if len(q_vectors) == 2 else '1d'
+        self.q_vectors = q_vectors
+        self.nq = q_vectors[0].size
+        self._lock = lock
+        env = environment()
+        self._index = [env.context.index(context) for context, _ in kernels]
+        self.parts = []  # type: List[Tuple[int, int, int, GpuKernel]]
+        self._split(self._bounds())
+
+    def _bounds(self):
+        # type: () -> np.ndarray
+        """
+        Return the boundaries of the q blocks for each device in proportion
+        to the measured throughput.
+        """
+        throughput = environment().throughput
+        weights = np.array([throughput[k] for k in self._index], 'd')
+        cumulative = np.hstack((0., np.cumsum(weights)))/np.sum(weights)
+        return np.round(cumulative*self.nq).astype(int)
+
+    def _split(self, bounds):
+        # type: (np.ndarray) -> None
+        """
+        Create a kernel for each nonempty block of q between *bounds*.
+
+        The previous kernels are released when no call is using them.
+        """
+        parts = []
+        for k, (context, kernel) in enumerate(self.kernels):
+            start, stop = bounds[k], bounds[k+1]
+            if stop > start:
+                q_block = [q[start:stop] for q in self.q_vectors]
+                specialized = (None if self.specialized is None
+                               else partial(self.specialized, context))
+                part = GpuKernel(kernel, self.dtype, self.info, q_block,
+                                 lock=self._lock, context=context,
+                                 profile=True, specialized=specialized)
+                parts.append((self._index[k], start, stop, part))
+        self.bounds = bounds
+        self.parts = parts
+
+    def __call__(self, call_details, values, cutoff, magnetic):
+        # type: (CallDetails, np.ndarray, np.ndarray, float, bool) -> np.ndarray
+        total, pd_norm = self.call_parts(call_details, values, cutoff, magnetic)
+        scale = values[0]/(pd_norm if pd_norm != 0.0 else 1.0)
+        background = values[1]
+        return scale*total + background
+
+    def call_parts(self, call_details, values, cutoff, magnetic):
+        # type: (CallDetails, np.ndarray, float, bool) -> Tuple[np.ndarray, float]
+        stats = get_stats()
+        if stats is not None:
+            start_time = clock()
+        parts = self.parts
+        pending = [part._start(call_details, values, cutoff, magnetic)
+                   for _, _, _, part in parts]
+        total = np.empty(self.nq, self.dtype)
+        # Every block sums over the same polydispersity points, so they
+        # all have the same normalization.
+        pd_norm = 0.0
+        device_time = []
+        for (_, start, stop, _), (events, event, result, _) in zip(parts, pending):
+            event.wait()
+            total[start:stop] = result[:-1]
+            pd_norm = result[-1]
+            device_time.append(
+                1e-9*(events[-1].profile.end - events[0].profile.start)
+                if events else 0.0)
+        self._measure(parts, device_time, call_details.num_eval)
+
+        if stats is not None:
+            self._record_call(
+                stats, self.nq, call_details, values, cutoff,
+                chunks=sum(len(p[0]) for p in pending),
+                bytes_to_device=sum(p[3] for p in pending),
+                time_compute=clock()-start_time)
+        return total, pd_norm
+
+    def _measure(self, parts, device_time, num_eval):
+        # type: (List[Tuple[int, int, int, GpuKernel]], List[float], int) -> None
+        """
+        Update the throughput for each device from the *device_time* for
+        its block, and divide q again if the split no longer matches.
+        """
+        if min(device_time) < self.min_measure_time:
+            return
+        throughput = environment().throughput
+        for (index, start, stop, _), seconds in zip(parts, device_time):
+            measured = (stop - start)*num_eval/seconds
+            # Smooth the measurement since the device may be shared.
+            throughput[index] = 0.5*throughput[index] + 0.5*measured
+        bounds = self._bounds()
+        shift = np.max(np.abs(bounds - self.bounds))
+        if shift > self.rebalance_tolerance*self.nq:
+            logging.info("dividing q for %s at %s", self.info.name, bounds)
+            self._split(bounds)
+
+    def release(self):
+        # type: () -> None
+        """
+        Release resources associated with the kernel.
+        """
+        for _, _, _, part in self.parts:
+            part.release()
+        self.parts = []
 
     def __del__(self):
         # type: () -> None
         self.release()
+
+
+class GpuFuture(KernelFuture):
+    """
+    Handle for a call started with :meth:`GpuKernel.submit`.
+
+    *event* completes when the kernel output has been copied into *result*,
+    which holds the unnormalized sum followed by the normalization.  The
+    scale and background are taken from *values* when the result is first
+    requested.
+    """
+    def __init__(self, event, result, values):
+        # type: (cl.Event, np.ndarray, np.ndarray) -> None
+        KernelFuture.__init__(self, None)
+        self._event = event
+        self._result = result
+        # Keep values alive until the upload has completed.
+        self._values = values
+
+    def done(self):
+        # type: () -> bool
+        return (self._event is None
+                or (self._event.command_execution_status
+                    == cl.command_execution_status.COMPLETE))
+
+    def result(self):
+        # type: () -> np.ndarray
+        if self._event is not None:
+            self._event.wait()
+            total, pd_norm = self._result[:-1], self._result[-1]
+            scale = self._values[0]/(pd_norm if pd_norm != 0.0 else 1.0)
+            self._value = scale*total + self._values[1]
+            self._event = self._result = self._values = None
+        return self._value
+
+
+def _test_environment():
+    # type: () -> GpuEnvironment
+    """
+    Return the OpenCL environment for the unit tests, or None if there is
+    no OpenCL device, in which case the tests are skipped.
+    """
+    try:
+        env = environment()
+    except RuntimeError:
+        return None
+    return env if env.context else None
+
+@contextmanager
+def _test_cache():
+    # type: () -> str
+    """
+    Use an empty cache directory for a unit test, restoring the cache path
+    and the OpenCL environment afterward.
+    """
+    import shutil
+
+    global CACHE_PATH, ENV
+    saved = CACHE_PATH, ENV
+    CACHE_PATH = tempfile.mkdtemp()
+    try:
+        yield CACHE_PATH
+    finally:
+        shutil.rmtree(CACHE_PATH)
+        CACHE_PATH, ENV = saved
+
+def _test_model(env, name='cylinder'):
+    # type: (GpuEnvironment, str) -> Tuple[GpuModel, float]
+    """
+    Return the OpenCL model for *name* in double precision if *env*
+    supports it, otherwise single, along with the tolerance for comparing
+    results.
+    """
+    from .core import load_model_info
+
+    model_info = load_model_info(name)
+    dtype = generate.F64 if env.has_type(generate.F64) else generate.F32
+    model = GpuModel(generate.make_source(model_info), model_info, dtype)
+    return model, (1e-12 if dtype == generate.F64 else 1e-5)
+
+def test_binary_cache():
+    # type: () -> None
+    """
+    Check that a new environment loads the program from the binary cache
+    and uses the cached device selection.
+    """
+    from .direct_model import call_kernel
+
+    global _load_binaries
+    if _test_environment() is None:
+        return
+    q = np.linspace(0.001, 0.5, 50)
+    pars = dict(radius=30, radius_pd=0.1, radius_pd_n=15)
+    with _test_cache() as path:
+        env = reset_environment()
+        model, rtol = _test_model(env)
+        target = call_kernel(model.make_kernel([q]), pars)
+        assert any(name.endswith(".bin") for name in os.listdir(path))
+        if 'PYOPENCL_CTX' not in os.environ:
+            devices = _load_device_selection()
+            assert ([d.name for d in devices]
+                    == [c.devices[0].name for c in env.context])
+
+        loaded = []
+        saved_load = _load_binaries
+        def load(context, cache_files, options):
+            program = saved_load(context, cache_files, options)
+            loaded.append(program)
+            return program
+        try:
+            _load_binaries = load
+            env = reset_environment()
+            model, rtol = _test_model(env)
+            actual = call_kernel(model.make_kernel([q]), pars)
+        finally:
+            _load_binaries = saved_load
+        assert loaded and all(program is not None for program in loaded)
+        assert np.allclose(actual, target, rtol=rtol), \
+            "cached: expected %s but got %s"%(target, actual)
+
+def test_buffer_pool():
+    # type: () -> None
+    """
+    Check that unchanged call details are not copied to the device again,
+    and that the pooled buffers give the same results as a new kernel,
+    whether the buffers are replaced or updated by copying.
+    """
+    from .kernel import enable_stats, disable_stats
+    from .direct_model import _kernel_args
+
+    env = _test_environment()
+    if env is None:
+        return
+    model, rtol = _test_model(env)
+    q = np.linspace(0.001, 0.5, 50)
+    pars_list = [
+        dict(radius=30, radius_pd=0.1, radius_pd_n=15),
+        dict(radius=30, radius_pd=0.1, radius_pd_n=15, scale=2.),
+        dict(radius=30, radius_pd=0.1, radius_pd_n=35,
+             length=100, length_pd=0.1, length_pd_n=15),
+        dict(radius=20),
+        ]
+    args = [_kernel_args(model.make_kernel([q]), pars, False)
+            for pars in pars_list]
+    targets = []
+    for call_details, values, magnetic in args:
+        fresh = model.make_kernel([q])
+        targets.append(fresh(call_details, values, 1e-5, magnetic))
+        fresh.release()
+    for copy_to_pool in (False, True):
+        kernel = model.make_kernel([q])
+        kernel._copy_to_pool = copy_to_pool
+        calls = []
+        enable_stats(hook=lambda name, counters: calls.append(counters))
+        try:
+            for (call_details, values, magnetic), target in zip(args, targets):
+                actual = kernel(call_details, values, 1e-5, magnetic)
+                assert np.allclose(actual, target, rtol=rtol), \
+                    "pooled: expected %s but got %s"%(target, actual)
+        finally:
+            disable_stats()
+        kernel.release()
+        # Only the values are copied when the details are unchanged.
+        sizes = [values.nbytes for _, values, _ in args]
+        assert calls[0]['bytes_to_device'] > sizes[0]
+        assert calls[1]['bytes_to_device'] == sizes[1]
+        assert calls[2]['bytes_to_device'] > sizes[2]
+
+def test_submit():
+    # type: () -> None
+    """
+    Check that submitted calls return the kernel values, including calls
+    on two kernels which are both queued before either result is read.
+    """
+    from .direct_model import _kernel_args
+
+    env = _test_environment()
+    if env is None:
+        return
+    model, rtol = _test_model(env)
+    kernels = [model.make_kernel([np.linspace(0.001, 0.5, nq)])
+               for nq in (200, 50)]
+    pars = dict(radius=30, radius_pd=0.1, radius_pd_n=35,
+                length=100, length_pd=0.1, length_pd_n=35, background=0.5)
+    args = [_kernel_args(kernel, pars, False) for kernel in kernels]
+    targets = [kernel(call_details, values, 1e-5, magnetic)
+               for kernel, (call_details, values, magnetic)
+               in zip(kernels, args)]
+    futures = [kernel.submit(call_details, values, 1e-5, magnetic)
+               for kernel, (call_details, values, magnetic)
+               in zip(kernels, args)]
+    # Each kernel has its own queue, so both calls are on the device.
+    assert kernels[0].queue is not kernels[1].queue
+    for future, target in zip(futures[::-1], targets[::-1]):
+        actual = future.result()
+        assert future.done()
+        assert np.allclose(actual, target, rtol=rtol), \
+            "submit: expected %s but got %s"%(target, actual)
+    for kernel in kernels:
+        kernel.release()
+
+def test_multi_device():
+    # type: () -> None
+    """
+    Check that splitting q across two contexts on the same device matches
+    the single device result and normalization, including after the q
+    blocks are divided again for a new throughput.
+    """
+    from .direct_model import _kernel_args
+
+    env = _test_environment()
+    if env is None:
+        return
+    device = env.context[0].devices[0]
+    q = np.linspace(0.001, 0.5, 200)
+    pars = dict(radius=30, radius_pd=0.1, radius_pd_n=35,
+                length=100, length_pd=0.1, length_pd_n=15, background=0.5)
+    with _test_cache():
+        env = reset_environment(devices=[device])
+        model, rtol = _test_model(env)
+        kernel = model.make_kernel([q])
+        call_details, values, magnetic = _kernel_args(kernel, pars, False)
+        target_total, target_norm = kernel.call_parts(
+            call_details, values, 1e-5, magnetic)
+        target = kernel(call_details, values, 1e-5, magnetic)
+
+        env = reset_environment(devices=[device, device], multi_device=True)
+        model, rtol = _test_model(env)
+        kernel = model.make_kernel([q])
+        assert isinstance(kernel, MultiGpuKernel) and len(kernel.parts) == 2
+        # Measure every call and rebalance for a three to one split.
+        kernel.min_measure_time = 0.
+        env.throughput[:] = [1., 3.]
+        kernel._split(kernel._bounds())
+        assert list(kernel.bounds) == [0, 50, 200]
+        for _ in range(2):
+            total, pd_norm = kernel.call_parts(
+                call_details, values, 1e-5, magnetic)
+            assert np.allclose(pd_norm, target_norm, rtol=rtol), \
+                "pd_norm: expected %s but got %s"%(target_norm, pd_norm)
+            assert np.allclose(total, target_total, rtol=rtol), \
+                "total: expected %s but got %s"%(target_total, total)
+        assert all(throughput > 0 for throughput in env.throughput)
+        actual = kernel(call_details, values, 1e-5, magnetic)
+        assert np.allclose(actual, target, rtol=rtol), \
+            "multi: expected %s but got %s"%(target, actual)
+        kernel.release()
+
+def test_tuning():
+    # type: () -> None
+    """
+    Check that the settings found by :func:`autotune` are saved, and that
+    the saved settings are applied by a new environment.
+    """
+    from .direct_model import call_kernel
+
+    if _test_environment() is None:
+        return
+    q = np.linspace(0.001, 0.5, 100)
+    pars = dict(radius=30, radius_pd=0.1, radius_pd_n=15)
+    with _test_cache() as path:
+        env = reset_environment()
+        model, rtol = _test_model(env)
+        target = call_kernel(model.make_kernel([q]), pars)
+        best = autotune(model, [q], pars=pars, repeat=1)
+        context = env.get_context(model.dtype)
+        key = tuning_key(model.info, '1d', model.dtype, model.fast,
+                         context.devices[0], q.size)
+        assert env.get_tuning(key) == best
+        assert exists(joinpath(path, "tuning.json"))
+
+        # Change the saved settings so that their use can be seen.
+        settings = dict(best, boundary=8*best['boundary'], work=1000)
+        env.set_tuning(key, settings)
+        env = reset_environment()
+        assert env.get_tuning(key) == settings
+        model, rtol = _test_model(env)
+        kernel = model.make_kernel([q])
+        assert kernel.local_size == settings['local_size']
+        assert kernel.work == settings['work']
+        assert kernel.q_input.global_size[0] % settings['boundary'] == 0
+        actual = call_kernel(kernel, pars)
+        assert np.allclose(actual, target, rtol=rtol), \
+            "tuned: expected %s but got %s"%(target, actual)
@@ -6,6 +6,11 @@ will attempt to compile with OpenMP flags so that the model can use all
 available kernels.  This may or may not be available on your compiler
 toolchain.  Depending on operating system and environment.
 
+With OpenMP, each thread evaluates a contiguous block of *q* values over
+the entire polydispersity loop.  The number of threads defaults to the
+OpenMP default (see *OMP_NUM_THREADS*), and can be changed while the
+program is running using :meth:`DllModel.set_num_threads`.
+
 Windows does not have provide a compiler with the operating system.
 Instead, we assume that TinyCC is installed and available.  This can
 be done with a simple pip command if it is not already available::
@@ -60,20 +65,74 @@ and the name of the output file and returns a compile command that can be
 evaluated in the shell.  For even more control, replace the entire
 *compile(source,output)* function.
 
+Compiled models are cached in *DLL_PATH*, which is the system temporary
+directory (or *~/.sasmodels/compiled_models* on windows) unless the
+environment variable *SAS_DLL_PATH* is set.  The dll name includes a hash
+of the model source, the precision, the compiler and the compiler flags,
+so a model is only recompiled when one of these changes, and different
+versions of the model can be cached at the same time.  The location of the
+compiler is not included, so precompiled dlls can be shipped to machines
+which have the compiler installed elsewhere.  Machines with no compiler
+at all fall back to a precompiled dll for the same source built with
+different flags.  The least recently used dlls are removed when the cache
+grows beyond *DLL_CACHE_SIZE* MB, which can be set from the environment
+variable *SAS_DLL_CACHE_SIZE*.  Use 0 for no limit.
+
 The global attribute *ALLOW_SINGLE_PRECISION_DLLS* should be set to *False* if
 you wish to prevent single precision floating point evaluation for the compiled
 models, otherwise set it defaults to *True*.
+
+Compilers without OpenMP support (TinyCC, clang on the Mac, or cc without
+*-fopenmp*) produce kernels which run in a single thread.  These can still
+use multiple cores by splitting the *q* vector into contiguous slices and
+evaluating each slice in a separate python thread.  The ctypes call releases
+the python global interpreter lock, so the slices run concurrently.  Set the
+global attribute *THREAD_POOL_SIZE* (or the environment variable
+*SAS_DLL_THREADS*) to the number of threads to use, or set the
+*thread_pool_size* attribute of an individual kernel.  The default of 0
+calls the kernel directly in the current thread.  Slices are at least
+*MIN_THREAD_BLOCK* points long, so small *q* vectors use fewer threads.
+Each slice of a sliced call limits kernels compiled with OpenMP to a single
+OpenMP thread so that the cores are not oversubscribed.  The limit applies
+only to the pool thread evaluating the slice, so other calls running at the
+same time keep the thread count set by :meth:`DllModel.set_num_threads`.
+
+The kernel in the model dll walks every polydispersity loop the model
+allows.  Calls which use fewer loops, such as the monodisperse calls
+during a fit, instead use a dll compiled for the number of active loops
+and the position of theta in them (see :func:`generate.specialize`).
+These dlls are compiled in a background thread the first time they are
+needed, with the model dll used until they are ready, and are cached along
+with the model dll.  Set the global attribute *SPECIALIZE* (or the
+environment variable *SAS_DLL_SPECIALIZE*) to 0 to always use the model
+dll.
 """
 from __future__ import print_function
 
 import sys
 import os
+import re
+import hashlib
+import glob
 from os.path import join as joinpath, splitext
 import subprocess
 import tempfile
 import ctypes as ct  # type: ignore
 import _ctypes as _ct
 import logging
+import threading
+from contextlib import contextmanager
+try:
+    from shutil import which as _which
+except ImportError:
+    # CRUFT: python 2 does not have shutil.which
+    from distutils.spawn import find_executable as _which
+
+if os.name == 'nt':
+    import msvcrt
+    fcntl = None
+else:
+    import fcntl
 
 import numpy as np  # type: ignore
 
@@ -82,14 +141,20 @@ try:
 except ImportError:
     tinycc = None
 
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # CRUFT: python 2 without the futures backport
+    ThreadPoolExecutor = None
+
 from . import generate
-from .kernel import KernelModel, Kernel
+from .kernel import KernelModel, Kernel, get_stats, clock
 from .kernelpy import PyInput
 from .exception import annotate_exception
 from .generate import F16, F32, F64
 
 try:
-    from typing import Tuple, Callable, Any
+    from typing import Tuple, Callable, Any, List, Dict
     from .modelinfo import ModelInfo
     from .details import CallDetails
 except ImportError:
@@ -111,6 +176,8 @@ else:
     COMPILER = "unix"
 
 ARCH = "" if ct.sizeof(ct.c_void_p) > 4 else "x86"  # 4 byte pointers on x86
+# Compiler executable followed by the compiler flags.
+CC = []  # type: List[str]
 if COMPILER == "unix":
     # Generic unix compile
     # On mac users will need the X code command line tools installed
@@ -153,8 +220,12 @@ elif COMPILER == "mingw":
         """mingw compiler command"""
         return CC + [source, "-o", output, "-lm"]
 
+if "SAS_DLL_PATH" in os.environ:
+    DLL_PATH = os.environ["SAS_DLL_PATH"]
+    if not os.path.exists(DLL_PATH):
+        os.makedirs(DLL_PATH)
 # Windows-specific solution
-if os.name == 'nt':
+elif os.name == 'nt':
     # Assume the default location of module DLLs is in .sasmodels/compiled_models.
     DLL_PATH = os.path.join(os.path.expanduser("~"), ".sasmodels", "compiled_models")
     if not os.path.exists(DLL_PATH):
@@ -163,8 +234,62 @@ else:
     # Set up the default path for compiled modules.
     DLL_PATH = tempfile.gettempdir()
 
+#: Maximum total size in MB of the compiled models in *DLL_PATH*, or 0 for
+#: no limit.  The least recently used dlls are removed when the limit is
+#: exceeded.
+DLL_CACHE_SIZE = float(os.environ.get("SAS_DLL_CACHE_SIZE", "200"))
+
 ALLOW_SINGLE_PRECISION_DLLS = True
 
+#: Number of python threads used to evaluate slices of q in parallel, or 0
+#: to call the kernel directly.
+THREAD_POOL_SIZE = int(os.environ.get("SAS_DLL_THREADS", "0"))
+#: Minimum number of q points in each slice.
+MIN_THREAD_BLOCK = 32
+
+#: Use dlls specialized for the active polydispersity loops of each call.
+SPECIALIZE = os.environ.get("SAS_DLL_SPECIALIZE", "1").lower() not in (
+    "", "0", "false", "no", "off")
+
+# CRUFT: python 2 does not have os.replace; rename is atomic on posix
+_replace = getattr(os, 'replace', os.rename)
+
+_THREAD_POOL = (0, None) # type: Tuple[int, ThreadPoolExecutor]
+_THREAD_POOL_LOCK = threading.Lock()
+def _thread_pool(size):
+    # type: (int) -> ThreadPoolExecutor
+    """
+    Return a shared thread pool with at least *size* workers.
+
+    The pool has at least *THREAD_POOL_SIZE* workers, so it is only replaced
+    when a kernel asks for more threads than that.  The old pool is not shut
+    down since other threads may still be submitting slices to it; its
+    workers exit once it is no longer referenced.
+    """
+    global _THREAD_POOL
+    with _THREAD_POOL_LOCK:
+        pool_size, pool = _THREAD_POOL
+        if pool_size < size:
+            size = max(size, THREAD_POOL_SIZE)
+            pool = ThreadPoolExecutor(max_workers=size)
+            _THREAD_POOL = (size, pool)
+        return pool
+
+def _thread_limit(dll):
+    # type: (ct.CDLL) -> Callable[[int], int]
+    """
+    Return the function which limits the OpenMP threads used by *dll* for
+    calls from the current thread, or None if the dll does not provide it.
+    """
+    # Thread control is missing from dlls compiled by older versions.
+    try:
+        set_thread_limit = dll.set_thread_limit
+    except AttributeError:
+        return None
+    set_thread_limit.argtypes = [ct.c_int32]
+    set_thread_limit.restype = ct.c_int32
+    return set_thread_limit
+
 def compile(source, output):
     # type: (str, str) -> None
     """
@@ -184,31 +309,99 @@ def compile(source, output):
     if not os.path.exists(output):
         raise RuntimeError("compile failed.  File is in %r"%source)
 
-def dll_name(model_info, dtype):
-    # type: (ModelInfo, np.dtype) ->  str
+# Path names in #line directives are ignored when computing the source tag
+# so that the same model installed in a different location has the same tag.
+_LINE_DIRECTIVE = re.compile(r'^(#line \d+ ")(?:[^"]*[/\\])?', re.MULTILINE)
+# Names of the dlls managed by the cache: sas<bits>_<model>_<tag><arch>.so
+_DLL_CACHE_NAME = re.compile(r'^sas\d+_.+_[0-9a-f]{16}(x86)?[.]so$')
+# Number of hex digits of the tag taken from the source hash; the remainder
+# of the 16 digit tag comes from the compiler hash.
+_SOURCE_TAG_LENGTH = 10
+
+def _compiler_id():
+    # type: () -> str
+    """
+    Return the compiler kind and flags used to build the dlls.
+
+    The path to the compiler executable is left out, so the id is the same
+    on every machine with the same compiler configuration.
+    """
+    return " ".join([COMPILER] + CC[1:])
+
+_HAVE_COMPILER = None # type: bool
+def _have_compiler():
+    # type: () -> bool
     """
-    Name of the dll containing the model.  This is the base file name without
-    any path or extension, with a form such as 'sas_sphere32'.
+    Return True if the compiler executable can be found.  The result is
+    saved after the first call.
+    """
+    global _HAVE_COMPILER
+    if _HAVE_COMPILER is None:
+        _HAVE_COMPILER = bool(CC) and _which(CC[0]) is not None
+    return _HAVE_COMPILER
+
+def dll_tag(source):
+    # type: (str) -> str
+    """
+    Return a tag for the dll compiled from *source*.
+
+    The tag is a hash of the source, which should already be converted to
+    the target precision, followed by a hash of the compiler kind and
+    flags, so that any change to the model code, the precision, the
+    compiler or the compiler flags produces a different dll.
+    """
+    source = _LINE_DIRECTIVE.sub(r'\1', source)
+    source_hash = hashlib.sha1(source.encode('utf-8')).hexdigest()
+    compiler_hash = hashlib.sha1(_compiler_id().encode('utf-8')).hexdigest()
+    return (source_hash[:_SOURCE_TAG_LENGTH]
+            + compiler_hash[:16-_SOURCE_TAG_LENGTH])
+
+def dll_name(model_info, dtype, source=None):
+    # type: (ModelInfo, np.dtype, str) ->  str
+    """
+    Name of the dll containing the model.  This is the base file name,
+    with a form such as 'sas32_sphere_<tag>.so', where <tag> is computed
+    from the converted *source* by :func:`dll_tag`.  Without *source* the
+    name has no tag, such as 'sas32_sphere.so'.
     """
     bits = 8*dtype.itemsize
     basename = "sas%d_%s"%(bits, model_info.id)
+    if source is not None:
+        basename += "_" + dll_tag(source)
     basename += ARCH + ".so"
+    return basename
 
-    # Hack to find precompiled dlls
-    path = joinpath(generate.DATA_PATH, '..', 'compiled_models', basename)
-    if os.path.exists(path):
-        return path
 
-    return joinpath(DLL_PATH, basename)
-
-
-def dll_path(model_info, dtype):
-    # type: (ModelInfo, np.dtype) -> str
+def dll_path(model_info, dtype, source=None):
+    # type: (ModelInfo, np.dtype, str) -> str
     """
     Complete path to the dll for the model.  Note that the dll may not
     exist yet if it hasn't been compiled.
+
+    Dlls precompiled into the *compiled_models* directory next to the
+    sasmodels package are used in preference to those in *DLL_PATH*.  If
+    there is no precompiled dll with the exact name and the compiler is
+    not available, then a precompiled dll for the same source and precision
+    built with a different compiler or different flags is used instead.
     """
-    return os.path.join(DLL_PATH, dll_name(model_info, dtype))
+    basename = dll_name(model_info, dtype, source)
+
+    # Hack to find precompiled dlls
+    compiled_models = joinpath(generate.DATA_PATH, '..', 'compiled_models')
+    path = joinpath(compiled_models, basename)
+    if os.path.exists(path):
+        return path
+    if source is not None and not _have_compiler():
+        # Same source tag with any compiler tag.
+        tag = dll_tag(source)[:_SOURCE_TAG_LENGTH]
+        pattern = "sas%d_%s_%s%s%s.so"%(
+            8*dtype.itemsize, model_info.id, tag,
+            "?"*(16-_SOURCE_TAG_LENGTH), ARCH)
+        matches = sorted(glob.glob(joinpath(compiled_models, pattern)))
+        if matches:
+            return matches[0]
+
+    return joinpath(DLL_PATH, basename)
 
 
 def make_dll(source, model_info, dtype=F64):
@@ -216,9 +409,16 @@ def make_dll(source, model_info, dtype=F64):
     """
     Returns the path to the compiled model defined by *kernel_module*.
 
-    If the model has not been compiled, or if the source file(s) are newer
-    than the dll, then *make_dll* will compile the model before returning.
-    This routine does not load the resulting dll.
+    The dll name includes a hash of the source code, the compiler and the
+    compiler flags (see :func:`dll_tag`), so the model is compiled only if
+    there is not already a dll for exactly this source.  Different versions of a
+    model, such as a custom model being edited, can therefore exist side by
+    side.  This routine does not load the resulting dll.
+
+    The compile is protected by a lock file next to the dll, so processes
+    which build the same model at the same time wait for the first one to
+    finish rather than compiling it again.  The dll is written to a
+    temporary file and renamed when complete.
 
     *dtype* is a numpy floating point precision specifier indicating whether
     the model should be single, double or long double precision.  The default
@@ -227,8 +427,11 @@ def make_dll(source, model_info, dtype=F64):
     Set *sasmodels.ALLOW_SINGLE_PRECISION_DLLS* to False if single precision
     models are not allowed as DLLs.
 
-    Set *sasmodels.kerneldll.DLL_PATH* to the compiled dll output path.
-    The default is the system temporary directory.
+    Set *sasmodels.kerneldll.DLL_PATH* to the compiled dll output path, or
+    set *SAS_DLL_PATH* in the environment.  The default is the system
+    temporary directory.  When a new dll is compiled, the least recently
+    used dlls are removed so that the total size stays below
+    *DLL_CACHE_SIZE* MB (see :func:`prune_dll_cache`).
     """
     if dtype == F16:
         raise ValueError("16 bit floats not supported")
@@ -236,29 +439,152 @@ def make_dll(source, model_info, dtype=F64):
         dtype = F64  # Force 64-bit dll
     # Note: dtype may be F128 for long double precision
 
-    dll = dll_path(model_info, dtype)
+    source = generate.convert_type(source, dtype)
+    dll = dll_path(model_info, dtype, source)
+
+    if os.path.exists(dll):
+        _touch(dll)
+        return dll
+
+    with _dll_lock(dll):
+        # Another process may have compiled the dll while we were waiting
+        # for the lock.
+        if os.path.exists(dll):
+            _touch(dll)
+            return dll
 
-    if not os.path.exists(dll):
-        need_recompile = True
-    else:
-        dll_time = os.path.getmtime(dll)
-        newest_source = generate.dll_timestamp(model_info)
-        need_recompile = dll_time < newest_source
-    if need_recompile:
         basename = splitext(os.path.basename(dll))[0] + "_"
         system_fd, filename = tempfile.mkstemp(suffix=".c", prefix=basename)
-        source = generate.convert_type(source, dtype)
         with os.fdopen(system_fd, "w") as file_handle:
             file_handle.write(source)
-        compile(source=filename, output=dll)
+        # Compile to a temporary file in the target directory then rename
+        # it so that the dll is never seen partially written.
+        partial = "%s.%d_%d.tmp"%(
+            dll, os.getpid(), threading.current_thread().ident)
+        try:
+            compile(source=filename, output=partial)
+            _replace(partial, dll)
+        finally:
+            if os.path.exists(partial):
+                os.unlink(partial)
         # comment the following to keep the generated c file
         # Note: if there is a syntax error then compile raises an error
         # and the source file will not be deleted.
         os.unlink(filename)
         #print("saving compiled file in %r"%filename)
+    prune_dll_cache(keep=[dll])
     return dll
 
 
+def _touch(path):
+    # type: (str) -> None
+    """
+    Mark the dll as recently used so that it stays in the cache.
+    """
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+
+@contextmanager
+def _dll_lock(dll):
+    # type: (str) -> None
+    """
+    Hold an exclusive lock on the file *dll*.lock while compiling *dll*.
+
+    The lock is shared between processes, so that only one of them compiles
+    the dll and the others wait and then use the result.  The lock file is
+    left in place after the lock is released, and is removed along with the
+    dll by :func:`prune_dll_cache`.
+    """
+    with open(dll + ".lock", "a") as handle:
+        fd = handle.fileno()
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        else:
+            handle.seek(0)
+            while True:
+                try:
+                    # LK_LOCK gives up after ten seconds, so keep trying.
+                    msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                    break
+                except (IOError, OSError):
+                    pass
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            else:
+                handle.seek(0)
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+def prune_dll_cache(path=None, max_size=None, keep=()):
+    # type: (str, float, List[str]) -> List[str]
+    """
+    Remove the least recently used dlls from the dll cache, returning the
+    list of files removed.
+
+    *path* is the cache directory, which defaults to *DLL_PATH*.
+
+    *max_size* is the maximum total size in MB of the dlls in the cache,
+    which defaults to *DLL_CACHE_SIZE*.  If it is zero, nothing is removed.
+
+    *keep* is a list of dll paths which should not be removed.
+
+    Only files with names of the form produced by :func:`dll_name` for
+    tagged sources are considered.  Dlls which are in use by another
+    process may not be removable on windows; these are skipped.  The
+    compile lock file for each removed dll is removed with it, as are lock
+    files left behind for dlls which are no longer in the cache.
+    """
+    path = DLL_PATH if path is None else path
+    max_size = DLL_CACHE_SIZE if max_size is None else max_size
+    if max_size <= 0:
+        return []
+    keep = set(os.path.abspath(f) for f in keep)
+    entries = []
+    names = os.listdir(path)
+    for name in names:
+        if not _DLL_CACHE_NAME.match(name):
+            continue
+        filename = joinpath(path, name)
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, filename))
+    total = sum(size for _, size, _ in entries)
+    limit = max_size*1024*1024
+    removed = []
+    for _, size, filename in sorted(entries):
+        if total <= limit:
+            break
+        if os.path.abspath(filename) in keep:
+            continue
+        try:
+            os.remove(filename)
+        except OSError:
+            continue
+        total -= size
+        removed.append(filename)
+    # Lock files for dlls that are gone, including those removed above.
+    # A lock which is still held cannot be removed on windows, and removing
+    # it elsewhere at worst lets a second process compile the same dll.
+    present = set(names)
+    for name in names:
+        if (name.endswith(".lock") and _DLL_CACHE_NAME.match(name[:-5])
+                and (name[:-5] not in present
+                     or joinpath(path, name[:-5]) in removed)):
+            try:
+                os.remove(joinpath(path, name))
+            except OSError:
+                pass
+    return removed
+
+
 def load_dll(source, model_info, dtype=F64):
     # type: (str, ModelInfo, np.dtype) -> "DllModel"
     """
@@ -269,7 +595,7 @@ def load_dll(source, model_info, dtype=F64):
     allowed floating point precision.
     """
     filename = make_dll(source, model_info, dtype=dtype)
-    return DllModel(filename, model_info, dtype=dtype)
+    return DllModel(filename, model_info, dtype=dtype, source=source)
 
 
 class DllModel(KernelModel):
@@ -284,22 +610,41 @@ class DllModel(KernelModel):
     for single and 'd', 'float64' or 'double' for double.  Double precision
     is an optional extension which may not be available on all devices.
 
+    *source* is the model source used to compile the dll.  If it is given,
+    then calls with fewer active polydispersity loops than the model allows
+    use dlls specialized for those loops (see :data:`SPECIALIZE`).
+
     Call :meth:`release` when done with the kernel.
     """
-    def __init__(self, dllpath, model_info, dtype=generate.F32):
-        # type: (str, ModelInfo, np.dtype) -> None
+    def __init__(self, dllpath, model_info, dtype=generate.F32, source=None):
+        # type: (str, ModelInfo, np.dtype, str) -> None
         self.info = model_info
         self.dllpath = dllpath
+        self.source = source
         self._dll = None  # type: ct.CDLL
         self._kernels = None # type: List[Callable, Callable]
+        self._batch_kernels = None # type: List[Callable, Callable]
+        self._set_num_threads = None # type: Callable[[int], int]
+        self._thread_limit = None # type: Callable[[int], int]
+        # loop key: (dll, [Iq, Iqxy, Imagnetic], thread limit), or None if it
+        # failed or is still being compiled
+        self._specialized = {}  # type: Dict[Tuple[int, int], Tuple[ct.CDLL, List[Callable], Callable[[int], int]]]
+        self._specialize_lock = threading.Lock()
+        # loop key: background thread compiling the specialized dll
+        self._compiling = {}  # type: Dict[Tuple[int, int], threading.Thread]
         self.dtype = np.dtype(dtype)
+        self.num_threads = 0
 
-    def _load_dll(self):
-        # type: () -> None
+    def _open_dll(self, path):
+        # type: (str) -> Tuple[ct.CDLL, List[Callable], Callable[[int], int]]
+        """
+        Load the dll at *path*, returning the dll, its [Iq, Iqxy, Imagnetic]
+        kernels with the argument types set and its thread limit function.
+        """
         try:
-            self._dll = ct.CDLL(self.dllpath)
+            dll = ct.CDLL(path)
         except:
-            annotate_exception("while loading "+self.dllpath)
+            annotate_exception("while loading "+path)
             raise
 
         float_type = (ct.c_float if self.dtype == generate.F32
@@ -310,18 +655,143 @@ class DllModel(KernelModel):
         argtypes = [ct.c_int32]*3 + [ct.c_void_p]*4 + [float_type]
         names = [generate.kernel_name(self.info, variant)
                  for variant in ("Iq", "Iqxy", "Imagnetic")]
-        self._kernels = [self._dll[name] for name in names]
-        for k in self._kernels:
+        kernels = [dll[name] for name in names]
+        for k in kernels:
             k.argtypes = argtypes
+        return dll, kernels, _thread_limit(dll)
+
+    def _load_dll(self):
+        # type: () -> None
+        self._dll, self._kernels, self._thread_limit = self._open_dll(self.dllpath)
+        names = [generate.kernel_name(self.info, variant)
+                 for variant in ("Iq", "Iqxy", "Imagnetic")]
+        float_type = (ct.c_float if self.dtype == generate.F32
+                      else ct.c_double if self.dtype == generate.F64
+                      else ct.c_longdouble)
+
+        # int, int, int*, double*, int, double*, double*, double
+        batch_argtypes = ([ct.c_int32]*2 + [ct.c_void_p]*2 + [ct.c_int32]
+                          + [ct.c_void_p]*2 + [float_type])
+        try:
+            self._batch_kernels = [self._dll[name+"_batch"] for name in names]
+        except AttributeError:
+            # Batch kernels are missing from dlls compiled by older versions.
+            self._batch_kernels = None
+        else:
+            for k in self._batch_kernels:
+                k.argtypes = batch_argtypes
+
+        # Thread control is missing from dlls compiled by older versions.
+        try:
+            set_num_threads = self._dll.set_num_threads
+        except AttributeError:
+            self._set_num_threads = lambda n: 1
+        else:
+            set_num_threads.argtypes = [ct.c_int32]
+            set_num_threads.restype = ct.c_int32
+            self._set_num_threads = set_num_threads
+        # Restore the thread count after the dll has been reloaded.
+        self._set_num_threads(self.num_threads)
+
+    def _get_specialized(self, key):
+        # type: (Tuple[int, int]) -> Tuple[ct.CDLL, List[Callable], Callable[[int], int]]
+        """
+        Return the dll, the [Iq, Iqxy, Imagnetic] kernels and the thread
+        limit function specialized for the polydispersity loops in *key*,
+        or None if the model dll should be used instead.
+
+        The first time the key is used the dll is compiled and loaded in a
+        background thread, and the model dll is used until it is ready.
+        """
+        # The model dll already walks every loop.
+        if (not SPECIALIZE or self.source is None
+                or key[0] >= self.info.parameters.max_pd):
+            return None
+        with self._specialize_lock:
+            if key not in self._specialized:
+                self._specialized[key] = None
+                thread = threading.Thread(
+                    target=self._make_specialized,
+                    args=(key, self._specialized))
+                thread.daemon = True
+                self._compiling[key] = thread
+                thread.start()
+            return self._specialized[key]
+
+    def _make_specialized(self, key, cache):
+        # type: (Tuple[int, int], Dict[Tuple[int, int], Any]) -> None
+        """
+        Compile and load the dll specialized for *key*, storing it in *cache*
+        unless the model has been released in the meantime.
+        """
+        source = generate.specialize(self.source, key)
+        try:
+            path = make_dll(source, self.info, dtype=self.dtype)
+            with self._specialize_lock:
+                if cache is not self._specialized:
+                    return
+                dll, kernels, thread_limit = self._open_dll(path)
+                dll.set_num_threads.argtypes = [ct.c_int32]
+                dll.set_num_threads(self.num_threads)
+                cache[key] = (dll, kernels, thread_limit)
+        except Exception as exc:
+            # Keep using the model dll, such as when the model dll
+            # was precompiled and there is no compiler.
+            logging.warning("using unspecialized %s: %s", self.info.name, exc)
+        finally:
+            with self._specialize_lock:
+                if self._compiling.get(key) is threading.current_thread():
+                    del self._compiling[key]
+
+    def _wait_specialized(self):
+        # type: () -> None
+        """
+        Wait for the specialized dlls being compiled in the background.
+        """
+        while True:
+            with self._specialize_lock:
+                threads = list(self._compiling.values())
+            if not threads:
+                break
+            for thread in threads:
+                thread.join()
 
     def __getstate__(self):
-        # type: () -> Tuple[ModelInfo, str]
-        return self.info, self.dllpath
+        # type: () -> Tuple[ModelInfo, str, np.dtype, str, int]
+        return (self.info, self.dllpath, self.dtype, self.source,
+                self.num_threads)
 
     def __setstate__(self, state):
-        # type: (Tuple[ModelInfo, str]) -> None
-        self.info, self.dllpath = state
+        # type: (Tuple[ModelInfo, str, np.dtype, str, int]) -> None
+        (self.info, self.dllpath, self.dtype, self.source,
+         self.num_threads) = state
         self._dll = None
+        self._kernels = None
+        self._batch_kernels = None
+        self._set_num_threads = None
+        self._thread_limit = None
+        self._specialized = {}
+        self._specialize_lock = threading.Lock()
+        self._compiling = {}
+
+    def set_num_threads(self, num_threads):
+        # type: (int) -> int
+        """
+        Set the number of OpenMP threads used to evaluate the model.
+
+        Use *num_threads=0* for the OpenMP default.  Returns the number
+        of threads that will be used, which is always 1 if the dll was
+        compiled without OpenMP support.
+        """
+        if self._dll is None:
+            self._load_dll()
+        with self._specialize_lock:
+            self.num_threads = num_threads
+            result = self._set_num_threads(num_threads)
+            for entry in self._specialized.values():
+                if entry is not None:
+                    entry[0].set_num_threads(num_threads)
+        return result
 
     def make_kernel(self, q_vectors):
         # type: (List[np.ndarray]) -> DllKernel
@@ -331,20 +801,38 @@ class DllModel(KernelModel):
             self._load_dll()
         is_2d = len(q_vectors) == 2
         kernel = self._kernels[1:3] if is_2d else [self._kernels[0]]*2
-        return DllKernel(kernel, self.info, q_input)
+        batch = self._batch_kernels
+        if batch is not None:
+            batch = batch[1:3] if is_2d else [batch[0]]*2
+        def specialized(key):
+            entry = self._get_specialized(key)
+            if entry is None:
+                return None
+            kernels, thread_limit = entry[1], entry[2]
+            return (kernels[1:3] if is_2d else [kernels[0]]*2), thread_limit
+        return DllKernel(kernel, self.info, q_input, batch_kernel=batch,
+                         specialized=specialized,
+                         thread_limit=self._thread_limit)
 
     def release(self):
         # type: () -> None
         """
         Release any resources associated with the model.
         """
-        dll_handle = self._dll._handle
-        if os.name == 'nt':
-            ct.windll.kernel32.FreeLibrary(dll_handle)
-        else:
-            _ct.dlclose(dll_handle)
-        del self._dll
-        self._dll = None
+        # Dlls compiled in the background after this are not loaded.
+        with self._specialize_lock:
+            dlls = [entry[0] for entry in self._specialized.values()
+                    if entry is not None]
+            self._specialized = {}
+        if self._dll is not None:
+            dlls.append(self._dll)
+            self._dll = None
+        for dll in dlls:
+            dll_handle = dll._handle
+            if os.name == 'nt':
+                ct.windll.kernel32.FreeLibrary(dll_handle)
+            else:
+                _ct.dlclose(dll_handle)
 
 class DllKernel(Kernel):
     """
@@ -357,6 +845,18 @@ class DllKernel(Kernel):
     *q_input* is the DllInput q vectors at which the kernel should be
     evaluated.
 
+    *batch_kernel* is the c function which evaluates a batch of parameter
+    sets in one call, or None if the dll does not provide it.
+
+    *specialized* returns the [plain, magnetic] kernels specialized for
+    the loop key of the call details (see :attr:`CallDetails.loop_key`)
+    and their thread limit function, or None if *kernel* should be used.
+
+    *thread_limit* limits the number of OpenMP threads used by *kernel* for
+    calls from the current thread, so that each slice of q evaluated in the
+    thread pool uses a single OpenMP thread.  It is None if the dll cannot
+    limit its threads.
+
     The resulting call method takes the *pars*, a list of values for
     the fixed parameters to the kernel, and *pd_pars*, a list of (value, weight)
     vectors for the polydisperse parameters.  *cutoff* determines the
@@ -365,46 +865,143 @@ class DllKernel(Kernel):
 
     Call :meth:`release` when done with the kernel instance.
     """
-    def __init__(self, kernel, model_info, q_input):
-        # type: (Callable[[], np.ndarray], ModelInfo, PyInput) -> None
+    sparse = True
+    #: number of polydispersity points evaluated in each call to the dll
+    pd_chunk = 100
+    def __init__(self, kernel, model_info, q_input, batch_kernel=None,
+                 specialized=None, thread_limit=None):
+        # type: (Callable[[], np.ndarray], ModelInfo, PyInput, Callable[[], np.ndarray], Callable[[Tuple[int, int]], Tuple[List[Callable], Callable[[int], int]]], Callable[[int], int]) -> None
         self.kernel = kernel
+        self.batch_kernel = batch_kernel
+        self.specialized = specialized
+        self.thread_limit = thread_limit
         self.info = model_info
         self.q_input = q_input
         self.dtype = q_input.dtype
         self.dim = '2d' if q_input.is_2d else '1d'
-        self.result = np.empty(q_input.nq+1, q_input.dtype)
+        self.thread_pool_size = THREAD_POOL_SIZE
         self.real = (np.float32 if self.q_input.dtype == generate.F32
                      else np.float64 if self.q_input.dtype == generate.F64
                      else np.float128)
 
     def __call__(self, call_details, values, cutoff, magnetic):
         # type: (CallDetails, np.ndarray, np.ndarray, float, bool) -> np.ndarray
+        total, pd_norm = self.call_parts(call_details, values, cutoff, magnetic)
+        scale = values[0]/(pd_norm if pd_norm != 0.0 else 1.0)
+        background = values[1]
+        #print("scale",scale,background)
+        return scale*total + background
+
+    def call_parts(self, call_details, values, cutoff, magnetic):
+        # type: (CallDetails, np.ndarray, float, bool) -> Tuple[np.ndarray, float]
+        stats = get_stats()
+        if stats is not None:
+            start_time = clock()
+        kernel, thread_limit = self._select_kernel(call_details, magnetic)
+        nq = self.q_input.nq
+        num_slices = min(self.thread_pool_size, nq//MIN_THREAD_BLOCK)
+        threaded = num_slices > 1 and ThreadPoolExecutor is not None
+        if threaded:
+            # Each slice walks the entire polydispersity loop, so each slice
+            # returns the complete pd_norm; use the value from the first.
+            bounds = [int(k) for k in np.linspace(0, nq, num_slices+1)]
+            pool = _thread_pool(self.thread_pool_size)
+            jobs = [pool.submit(self._call_slice, kernel, call_details,
+                                values, cutoff, start, stop, thread_limit)
+                    for start, stop in zip(bounds[:-1], bounds[1:])]
+            parts = [job.result() for job in jobs]
+            pd_norm = parts[0][-1]
+            total = np.hstack([part[:-1] for part in parts])
+        else:
+            # Result buffer is allocated for each call so that the kernel can
+            # be called from multiple threads at the same time.
+            result = self._call_slice(kernel, call_details, values, cutoff,
+                                      0, nq)
+            pd_norm = result[nq]
+            total = result[:nq]
+
+        #print("returned",self.q_input.q, result)
+        if stats is not None:
+            num_chunks = -(-call_details.num_eval//self.pd_chunk)
+            self._record_call(stats, nq, call_details, values, cutoff,
+                              chunks=num_chunks*(num_slices if threaded else 1),
+                              time_compute=clock()-start_time)
+        return total, pd_norm
+
+    def _select_kernel(self, call_details, magnetic):
+        # type: (CallDetails, bool) -> Tuple[Callable, Callable[[int], int]]
+        """
+        Return the kernel for *call_details* and its thread limit function,
+        preferring the kernel specialized for its polydispersity loops.
+        """
+        entry = (None if self.specialized is None
+                 else self.specialized(call_details.loop_key))
+        kernels, thread_limit = (entry if entry is not None
+                                 else (self.kernel, self.thread_limit))
+        return kernels[1 if magnetic else 0], thread_limit
+
+    def _call_slice(self, kernel, call_details, values, cutoff, start, stop,
+                    thread_limit=None):
+        # type: (Callable[[], np.ndarray], CallDetails, np.ndarray, float, int, int, Callable[[int], int]) -> np.ndarray
+        """
+        Evaluate *kernel* for q[start:stop] over the entire polydispersity
+        loop, returning the unnormalized sums followed by pd_norm.
 
-        kernel = self.kernel[1 if magnetic else 0]
+        If *thread_limit* is given, the kernel is limited to one OpenMP
+        thread for the duration of the call from the current thread.
+        """
+        result = np.empty(stop-start+1, self.q_input.dtype)
+        q = self.q_input.q
         args = [
-            self.q_input.nq, # nq
+            stop-start, # nq
             None, # pd_start
             None, # pd_stop pd_stride[MAX_PD]
             call_details.buffer.ctypes.data, # problem
             values.ctypes.data,  #pars
-            self.q_input.q.ctypes.data, #q
-            self.result.ctypes.data,   # results
+            q.ctypes.data + start*q.strides[0], #q
+            result.ctypes.data,   # results
             self.real(cutoff), # cutoff
         ]
         #print("Calling DLL")
         #call_details.show(values)
-        step = 100
-        for start in range(0, call_details.num_eval, step):
-            stop = min(start + step, call_details.num_eval)
-            args[1:3] = [start, stop]
-            kernel(*args) # type: ignore
-
-        #print("returned",self.q_input.q, self.result)
-        pd_norm = self.result[self.q_input.nq]
-        scale = values[0]/(pd_norm if pd_norm != 0.0 else 1.0)
-        background = values[1]
-        #print("scale",scale,background)
-        return scale*self.result[:self.q_input.nq] + background
+        step = self.pd_chunk
+        previous = thread_limit(1) if thread_limit is not None else None
+        try:
+            for pd_start in range(0, call_details.num_eval, step):
+                pd_stop = min(pd_start + step, call_details.num_eval)
+                args[1:3] = [pd_start, pd_stop]
+                kernel(*args) # type: ignore
+        finally:
+            if thread_limit is not None:
+                thread_limit(previous)
+        return result
+
+    def call_batch(self, call_details, values, cutoff, magnetic):
+        # type: (List[CallDetails], List[np.ndarray], float, bool) -> np.ndarray
+        if self.batch_kernel is None or any(d.sparse for d in call_details):
+            return Kernel.call_batch(self, call_details, values, cutoff, magnetic)
+        stats = get_stats()
+        if stats is not None:
+            start_time = clock()
+        kernel = self.batch_kernel[1 if magnetic else 0]
+        nq, num_sets = self.q_input.nq, len(values)
+        details = np.vstack([d.buffer for d in call_details])
+        stride = max(len(v) for v in values)
+        blocks = np.zeros((num_sets, stride), self.dtype)
+        for k, v in enumerate(values):
+            blocks[k, :len(v)] = v
+        result = np.empty((num_sets, nq+1), self.dtype)
+        kernel(nq, num_sets, details.ctypes.data, blocks.ctypes.data, stride,
+               self.q_input.q.ctypes.data, result.ctypes.data,
+               self.real(cutoff))
+        if stats is not None:
+            self._record_batch(stats, nq, call_details, values, cutoff,
+                               chunks=1, time_compute=clock()-start_time)
+        pd_norm = result[:, nq]
+        pd_norm[pd_norm == 0.0] = 1.0
+        scale = blocks[:, 0:1]/pd_norm[:, None]
+        background = blocks[:, 1:2]
+        return scale*result[:, :nq] + background
 
     def release(self):
         # type: () -> None
@@ -412,3 +1009,252 @@ class DllKernel(Kernel):
         Release any resources associated with the kernel.
         """
         self.q_input.release()
+
+
+def test_dll_cache():
+    # type: () -> None
+    """
+    Check the dll tag, the precompiled dll lookup and the cache pruning.
+    """
+    import shutil
+    from .core import load_model_info
+
+    global CC
+    model_info = load_model_info('cylinder')
+    source = generate.convert_type(generate.make_source(model_info)['dll'], F64)
+    tag = dll_tag(source)
+
+    # The tag depends on the compiler flags but not the compiler location.
+    saved_cc = CC
+    try:
+        CC = ["/elsewhere/cc"] + saved_cc[1:]
+        assert dll_tag(source) == tag
+        CC = saved_cc[:1] + saved_cc[1:] + ["-DEXTRA"]
+        assert dll_tag(source)[:_SOURCE_TAG_LENGTH] == tag[:_SOURCE_TAG_LENGTH]
+        assert dll_tag(source) != tag
+    finally:
+        CC = saved_cc
+
+    root = tempfile.mkdtemp()
+    saved_data_path = generate.DATA_PATH
+    try:
+        # Without a compiler, a precompiled dll from a different compiler is
+        # used for the same source, but not for a different source.
+        generate.DATA_PATH = joinpath(root, 'sasmodels')
+        compiled_models = joinpath(root, 'compiled_models')
+        os.makedirs(generate.DATA_PATH)
+        os.makedirs(compiled_models)
+        other_compiler = "0"*(16-_SOURCE_TAG_LENGTH)
+        if tag.endswith(other_compiler):
+            other_compiler = "1"*(16-_SOURCE_TAG_LENGTH)
+        other = "sas64_cylinder_%s%s%s.so"%(
+            tag[:_SOURCE_TAG_LENGTH], other_compiler, ARCH)
+        open(joinpath(compiled_models, other), 'w').close()
+        # A dll with different flags is only used without a compiler.
+        global _HAVE_COMPILER
+        saved_have_compiler = _HAVE_COMPILER
+        try:
+            _HAVE_COMPILER = True
+            path = dll_path(model_info, F64, source)
+            assert os.path.dirname(path) == DLL_PATH
+            _HAVE_COMPILER = False
+            path = dll_path(model_info, F64, source)
+            assert os.path.samefile(path, joinpath(compiled_models, other))
+            path = dll_path(model_info, F64, source + "\n")
+            assert os.path.dirname(path) == DLL_PATH
+        finally:
+            _HAVE_COMPILER = saved_have_compiler
+
+        # Lock files go with their dlls.
+        cache = joinpath(root, 'cache')
+        os.makedirs(cache)
+        names = [dll_name(model_info, F64, source + "\n"*k) for k in range(3)]
+        for k, name in enumerate(names):
+            with open(joinpath(cache, name), 'wb') as fid:
+                fid.write(b"x"*1024*1024)
+            open(joinpath(cache, name + ".lock"), 'w').close()
+            os.utime(joinpath(cache, name), (k, k))
+        os.remove(joinpath(cache, names[2]))
+        removed = prune_dll_cache(cache, max_size=1.5)
+        assert removed == [joinpath(cache, names[0])]
+        assert sorted(os.listdir(cache)) == [names[1], names[1] + ".lock"]
+    finally:
+        generate.DATA_PATH = saved_data_path
+        shutil.rmtree(root)
+
+def test_make_dll():
+    # type: () -> None
+    """
+    Check that a failed compile leaves no partial dll behind, and that
+    concurrent builds of the same dll compile it only once.
+    """
+    import shutil
+    import time
+    from .core import load_model_info
+
+    global DLL_PATH, compile
+    model_info = load_model_info('cylinder')
+    # Unique source so that no precompiled or cached dll is found.
+    source = generate.make_source(model_info)['dll'] + "\n// %r\n"%time.time()
+    saved_path, saved_compile = DLL_PATH, compile
+    DLL_PATH = tempfile.mkdtemp()
+    calls = []
+    def failing_compile(source, output):
+        with open(output, 'wb') as fid:
+            fid.write(b"partial")
+        raise RuntimeError("compile failed")
+    def slow_compile(source, output):
+        calls.append(output)
+        time.sleep(0.5)
+        with open(output, 'wb') as fid:
+            fid.write(b"complete")
+    try:
+        compile = failing_compile
+        try:
+            make_dll(source, model_info)
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("compile error was not raised")
+        assert not [name for name in os.listdir(DLL_PATH)
+                    if not name.endswith(".lock")]
+
+        compile = slow_compile
+        threads = ThreadPoolExecutor(max_workers=3)
+        try:
+            paths = list(threads.map(
+                lambda _: make_dll(source, model_info), range(3)))
+        finally:
+            threads.shutdown()
+        assert len(calls) == 1, "compiled %d times"%len(calls)
+        assert paths == [paths[0]]*3
+        with open(paths[0], 'rb') as fid:
+            assert fid.read() == b"complete"
+        assert sorted(os.listdir(DLL_PATH)) == sorted(
+            [os.path.basename(paths[0]), os.path.basename(paths[0]) + ".lock"])
+    finally:
+        shutil.rmtree(DLL_PATH)
+        DLL_PATH, compile = saved_path, saved_compile
+        # The source is kept for debugging when the compile fails.
+        name = dll_name(model_info, F64, generate.convert_type(source, F64))
+        prefix = joinpath(tempfile.gettempdir(), splitext(name)[0] + "_")
+        for path in glob.glob(prefix + "*.c"):
+            os.unlink(path)
+
+def test_thread_pool():
+    # type: () -> None
+    """
+    Check that slicing q across the thread pool matches the direct call,
+    including concurrent calls with different numbers of slices.
+    """
+    from .direct_model import _test_kernel, _kernel_args
+
+    model, kernel = _test_kernel(nq=200)
+    pars = dict(radius=30, radius_pd=0.1, radius_pd_n=35, background=0.5)
+    call_details, values, magnetic = _kernel_args(kernel, pars, False)
+    target = kernel(call_details, values, 1e-5, magnetic)
+    kernels = [model.make_kernel([kernel.q_input.q[:nq]])
+               for nq in (200, 150, 100, 64)]
+    for k, sliced in enumerate(kernels):
+        sliced.thread_pool_size = k + 2
+    def call(sliced):
+        return sliced(call_details, values, 1e-5, magnetic)
+    global _THREAD_POOL
+    threads = ThreadPoolExecutor(max_workers=len(kernels))
+    try:
+        for _ in range(5):
+            # Start from an empty pool so that it grows during the calls.
+            _THREAD_POOL = (0, None)
+            results = list(threads.map(call, kernels))
+            for sliced, actual in zip(kernels, results):
+                nq = sliced.q_input.nq
+                assert np.allclose(actual, target[:nq], rtol=1e-12), \
+                    "sliced: expected %s but got %s"%(target[:nq], actual)
+        # The OpenMP thread limit belongs to the calling thread, so limiting
+        # the slices does not limit other calls, and it is removed from the
+        # pool threads after each slice.
+        limit = model._thread_limit
+        if limit is not None:
+            previous = limit(3)
+            try:
+                assert threads.submit(limit, 0).result() == 0
+                assert all(job.result() == 0 for job in
+                           [_THREAD_POOL[1].submit(limit, 0) for _ in range(5)])
+            finally:
+                limit(previous)
+    finally:
+        threads.shutdown()
+
+    # A pool held by one thread remains usable after another grows it.
+    pool = _thread_pool(2)
+    assert _thread_pool(_THREAD_POOL[0] + 1) is not pool
+    assert pool.submit(abs, -1).result() == 1
+
+def test_num_threads():
+    # type: () -> None
+    """
+    Check that the results are the same for one and several OpenMP threads.
+    """
+    from .direct_model import _test_kernel, _kernel_args
+
+    model, kernel = _test_kernel(nq=200)
+    pars = dict(radius=30, radius_pd=0.1, radius_pd_n=35,
+                length=100, length_pd=0.1, length_pd_n=15)
+    call_details, values, magnetic = _kernel_args(kernel, pars, False)
+    saved = model.num_threads
+    try:
+        assert model.set_num_threads(1) == 1
+        target = kernel(call_details, values, 1e-5, magnetic)
+        for num_threads in (2, 4, 0):
+            model.set_num_threads(num_threads)
+            actual = kernel(call_details, values, 1e-5, magnetic)
+            assert np.allclose(actual, target, rtol=1e-12), \
+                "%d threads: expected %s but got %s"%(num_threads, target, actual)
+    finally:
+        model.set_num_threads(saved)
+
+def test_specialized_kernel():
+    # type: () -> None
+    """
+    Check that the kernels specialized for the active polydispersity loops
+    match the full kernel, including for a copy of the model.
+    """
+    import copy
+    from .direct_model import _test_kernel, _kernel_args
+
+    global SPECIALIZE
+    model, kernel = _test_kernel(is_2d=True)
+    q = kernel.q_input.q
+    clone_model = copy.deepcopy(model)
+    clone = clone_model.make_kernel([q[:, 0], q[:, 1]])
+    pars_list = [
+        dict(radius=30, theta=20, phi=30),
+        dict(radius=30, radius_pd=0.2, radius_pd_n=15),
+        dict(theta=20, theta_pd=10, theta_pd_n=15),
+        dict(radius=30, radius_pd=0.2, radius_pd_n=15,
+             theta=20, theta_pd=10, theta_pd_n=5),
+        ]
+    saved = SPECIALIZE
+    for pars in pars_list:
+        call_details, values, magnetic = _kernel_args(kernel, pars, False)
+        key = call_details.loop_key
+        assert key[0] < model.info.parameters.max_pd
+        try:
+            SPECIALIZE = True
+            # The first call uses the model dll while the specialized dll
+            # is compiled in the background.
+            first = kernel(call_details, values, 1e-5, magnetic)
+            clone(call_details, values, 1e-5, magnetic)
+            model._wait_specialized()
+            clone_model._wait_specialized()
+            assert model._specialized[key] is not None
+            actual = kernel(call_details, values, 1e-5, magnetic)
+            copied = clone(call_details, values, 1e-5, magnetic)
+            SPECIALIZE = False
+            target = kernel(call_details, values, 1e-5, magnetic)
+        finally:
+            SPECIALIZE = saved
+        assert (copied == actual).all()
+        assert (first == target).all()
+        assert np.allclose(actual, target, rtol=1e-12), \
+            "%s: expected %s but got %s"%(key, target, actual)
@@ -5,25 +5,63 @@ Calls the kernel with a vector of $q$ values for a single parameter set.
 Polydispersity is supported by looping over different parameter sets and
 summing the results.  The interface to :class:`PyModel` matches those for
 :class:`kernelcl.GpuModel` and :class:`kerneldll.DllModel`.
+
+If the model marks *Iq.pd_vectorized = True* then *Iq* and *form_volume*
+accept a column of values for each parameter and return one row for each
+parameter set.  The polydispersity points are then evaluated in blocks
+rather than one at a time.  Set the global attribute *PD_BLOCK_SIZE* (or
+the environment variable *SAS_PY_BLOCK_SIZE*) to the maximum number of
+(pd point, q) values in a block, or set the *block_size* attribute of an
+individual kernel.  Use a block size of 0 to walk the points one at a time.
+
+If `numba <http://numba.pydata.org>`_ is installed, models whose *Iq*,
+*Iqxy* and *form_volume* take one *q* value at a time can be compiled along
+with the loops over *q* and over the polydispersity mesh, similar to
+*kernel_iq.c*.  Compilation is off by default.  Set *SAS_NUMBA=1* in the
+environment (or the global attribute *USE_NUMBA* to True) to turn it on.
+If compilation fails, the model is evaluated in python as before.
 """
 from __future__ import division, print_function
 
+import os
+import math
+import types
 import logging
+import threading
 
 import numpy as np  # type: ignore
 from numpy import pi, sin, cos  #type: ignore
 
 from . import details
 from .generate import F64
-from .kernel import KernelModel, Kernel
+from .kernel import KernelModel, Kernel, get_stats, clock
+
+try:
+    import numba  # type: ignore
+    try:
+        from numba.core.errors import NumbaError  # type: ignore
+    except ImportError:
+        # CRUFT: numba before 0.49
+        from numba.errors import NumbaError  # type: ignore
+except ImportError:
+    numba = None
 
 try:
-    from typing import Union, Callable
+    from typing import Union, Callable, Tuple, Dict, Optional
 except ImportError:
     pass
 else:
     DType = Union[None, str, np.dtype]
 
+#: Maximum number of (pd point, q) values evaluated at once by models which
+#: are marked as *pd_vectorized*, or 0 to evaluate one point at a time.
+PD_BLOCK_SIZE = int(os.environ.get("SAS_PY_BLOCK_SIZE", "1000000"))
+
+#: True if models which take one q value at a time should be compiled
+#: with numba.  This is off unless *SAS_NUMBA* is set in the environment.
+USE_NUMBA = (numba is not None
+             and os.environ.get("SAS_NUMBA", "").lower() not in ("", "0", "none"))
+
 class PyModel(KernelModel):
     """
     Wrapper for pure python models.
@@ -33,12 +71,33 @@ class PyModel(KernelModel):
         _create_default_functions(model_info)
         self.info = model_info
         self.dtype = np.dtype('d')
+        self._jit = {}  # type: Dict[bool, Optional[JitLoops]]
+
+    def __getstate__(self):
+        # Compiled functions are not copied; they are recompiled on demand.
+        state = self.__dict__.copy()
+        state['_jit'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__ = state
 
     def make_kernel(self, q_vectors):
         logging.info("creating python kernel " + self.info.name)
         q_input = PyInput(q_vectors, dtype=F64)
         kernel = self.info.Iqxy if q_input.is_2d else self.info.Iq
-        return PyKernel(kernel, self.info, q_input)
+        jit = self._get_jit(q_input.is_2d) if USE_NUMBA else None
+        return PyKernel(kernel, self.info, q_input, jit=jit)
+
+    def _get_jit(self, is_2d):
+        # type: (bool) -> Optional[JitLoops]
+        """
+        Return the compiled loops for 1D or 2D, or None if the model
+        cannot be compiled.
+        """
+        if is_2d not in self._jit:
+            self._jit[is_2d] = JitLoops.create(self.info, is_2d)
+        return self._jit[is_2d]
 
     def release(self):
         """
@@ -102,14 +161,17 @@ class PyKernel(Kernel):
 
     Call :meth:`release` when done with the kernel instance.
     """
-    def __init__(self, kernel, model_info, q_input):
-        # type: (callable, ModelInfo, List[np.ndarray]) -> None
+    sparse = True
+    def __init__(self, kernel, model_info, q_input, jit=None):
+        # type: (callable, ModelInfo, List[np.ndarray], JitLoops) -> None
         self.dtype = np.dtype('d')
+        self._jit = jit
         self.info = model_info
         self.q_input = q_input
         self.res = np.empty(q_input.nq, q_input.dtype)
         self.kernel = kernel
         self.dim = '2d' if q_input.is_2d else '1d'
+        self.block_size = PD_BLOCK_SIZE
 
         partable = model_info.parameters
         kernel_parameters = (partable.iqxy_parameters if q_input.is_2d
@@ -126,7 +188,12 @@ class PyKernel(Kernel):
         # Create views into the array to hold the arguments
         offset = 0
         kernel_args, volume_args = [], []
+        kernel_index, volume_index = [], []
         for p in partable.kernel_parameters:
+            if p in kernel_parameters:
+                kernel_index.append(offset)
+            if p in volume_parameters:
+                volume_index.append(offset)
             if p.length == 1:
                 # Scalar values are length 1 vectors with no dimensions.
                 v = parameter_vector[offset:offset+1].reshape(())
@@ -142,6 +209,8 @@ class PyKernel(Kernel):
         # Hold on to the parameter vector so we can use it to call kernel later.
         # This may also be required to preserve the views into the vector.
         self._parameter_vector = parameter_vector
+        # Calls share the parameter vector so only one can run at a time.
+        self._lock = threading.Lock()
 
         # Generate a closure which calls the kernel with the views into the
         # parameter array.
@@ -159,14 +228,56 @@ class PyKernel(Kernel):
         self._volume = ((lambda: form_volume(*volume_args)) if form_volume
                         else (lambda: 1.0))
 
+        # Generate closures which call the kernel and form_volume with a
+        # matrix of parameter values, one row for each pd point, passing
+        # each parameter as a column.  Vector parameters are not supported.
+        self._form_block = self._volume_block = None
+        if (getattr(form, 'pd_vectorized', False)
+                and all(p.length == 1 for p in partable.kernel_parameters)):
+            column = lambda P, k: P[:, k:k+1]
+            if q_input.is_2d:
+                self._form_block = lambda P: form(
+                    qx, qy, *[column(P, k) for k in kernel_index])
+            else:
+                self._form_block = lambda P: form(
+                    q, *[column(P, k) for k in kernel_index])
+            self._volume_block = ((lambda P: form_volume(
+                *[column(P, k) for k in volume_index]))
+                                  if form_volume else (lambda P: 1.0))
+
     def __call__(self, call_details, values, cutoff, magnetic):
         # type: (CallDetails, np.ndarray, np.ndarray, float, bool) -> np.ndarray
+        total, pd_norm = self.call_parts(call_details, values, cutoff, magnetic)
+        scale = values[0]/(pd_norm if pd_norm != 0.0 else 1.0)
+        background = values[1]
+        return scale*total + background
+
+    def call_parts(self, call_details, values, cutoff, magnetic):
+        # type: (CallDetails, np.ndarray, float, bool) -> Tuple[np.ndarray, float]
         if magnetic:
             raise NotImplementedError("Magnetism not implemented for pure python models")
         #print("Calling python kernel")
         #call_details.show(values)
-        res = _loops(self._parameter_vector, self._form, self._volume,
-                     self.q_input.nq, call_details, values, cutoff)
+        stats = get_stats()
+        if stats is not None:
+            start_time = clock()
+        res = None
+        if self._jit is not None and self._jit.loops is not None:
+            res = self._jit(self.q_input.q, call_details, values, cutoff)
+        if res is None:
+            if (self._form_block is not None and self.block_size > 0
+                    and call_details.num_active > 0):
+                res = _vector_loops(self._form_block, self._volume_block,
+                                    self.q_input.nq, call_details, values,
+                                    cutoff, self.block_size)
+            else:
+                with self._lock:
+                    res = _loops(self._parameter_vector, self._form,
+                                 self._volume, self.q_input.nq, call_details,
+                                 values, cutoff)
+        if stats is not None:
+            self._record_call(stats, self.q_input.nq, call_details, values,
+                              cutoff, chunks=1, time_compute=clock()-start_time)
         return res
 
     def release(self):
@@ -178,7 +289,7 @@ class PyKernel(Kernel):
         self.q_input = None
 
 def _loops(parameters, form, form_volume, nq, call_details, values, cutoff):
-    # type: (np.ndarray, Callable[[], np.ndarray], Callable[[], float], int, details.CallDetails, np.ndarray, np.ndarray, float) -> None
+    # type: (np.ndarray, Callable[[], np.ndarray], Callable[[], float], int, details.CallDetails, np.ndarray, np.ndarray, float) -> Tuple[np.ndarray, float]
     ################################################################
     #                                                              #
     #   !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!   #
@@ -191,10 +302,7 @@ def _loops(parameters, form, form_volume, nq, call_details, values, cutoff):
     n_pars = len(parameters)
     parameters[:] = values[2:n_pars+2]
     if call_details.num_active == 0:
-        pd_norm = float(form_volume())
-        scale = values[0]/(pd_norm if pd_norm != 0.0 else 1.0)
-        background = values[1]
-        return scale*form() + background
+        return np.asarray(form(), 'd'), float(form_volume())
 
     pd_value = values[2+n_pars:2+n_pars + call_details.num_weights]
     pd_weight = values[2+n_pars + call_details.num_weights:]
@@ -215,10 +323,18 @@ def _loops(parameters, form, form_volume, nq, call_details, values, cutoff):
     pd_stride = call_details.pd_stride[:call_details.num_active]
     pd_length = call_details.pd_length[:call_details.num_active]
 
+    # If sparse, visit only the listed points, recomputing all the indices
+    # whenever the next point is not the next step in the inner loop.
+    if call_details.sparse:
+        mesh_points = call_details.points[:call_details.num_eval]
+    else:
+        mesh_points = range(call_details.num_eval)
+    next_index = -1
+
     total = np.zeros(nq, 'd')
-    for loop_index in range(call_details.num_eval):
+    for loop_index in mesh_points:
         # update polydispersity parameter values
-        if p0_index == p0_length:
+        if p0_index == p0_length or loop_index != next_index:
             pd_index = (loop_index//pd_stride)%pd_length
             parameters[pd_par] = pd_value[pd_offset+pd_index]
             partial_weight = np.prod(pd_weight[pd_offset+pd_index][1:])
@@ -233,6 +349,7 @@ def _loops(parameters, form, form_volume, nq, call_details, values, cutoff):
             cor = cos(pi/180 * parameters[p0_par])
             spherical_correction = max(abs(cor), 1e-6)
         p0_index += 1
+        next_index = loop_index + 1
         if weight > cutoff:
             # Call the scattering function
             # Assume that NaNs are only generated if the parameters are bad;
@@ -247,9 +364,277 @@ def _loops(parameters, form, form_volume, nq, call_details, values, cutoff):
             total += weight * Iq
             pd_norm += weight * form_volume()
 
-    scale = values[0]/(pd_norm if pd_norm != 0.0 else 1.0)
-    background = values[1]
-    return scale*total + background
+    return total, pd_norm
+
+
+def _vector_loops(form, form_volume, nq, call_details, values, cutoff,
+                  block_size):
+    # type: (Callable[[np.ndarray], np.ndarray], Callable[[np.ndarray], np.ndarray], int, details.CallDetails, np.ndarray, float, int) -> Tuple[np.ndarray, float]
+    """
+    Evaluate the polydispersity loop in blocks of points.
+
+    *form* and *form_volume* take a matrix of parameter values with one row
+    for each point, returning a matrix of I(q) with one row for each point
+    and a column of volumes.  Blocks contain at most *block_size* values of
+    I(q).  Returns the unnormalized total and the normalization, the same
+    as :func:`_loops`.
+    """
+    n_pars = call_details.info.parameters.nvalues - 2
+    num_active = call_details.num_active
+    num_weights = call_details.num_weights
+    parameters = values[2:n_pars+2]
+    pd_value = values[2+n_pars:2+n_pars + num_weights]
+    pd_weight = values[2+n_pars + num_weights:2+n_pars + 2*num_weights]
+    pd_par = call_details.pd_par[:num_active]
+    pd_offset = call_details.pd_offset[:num_active]
+    pd_stride = call_details.pd_stride[:num_active]
+    pd_length = call_details.pd_length[:num_active]
+    theta_par = call_details.theta_par
+    num_eval = call_details.num_eval
+
+    total = np.zeros(nq, 'd')
+    pd_norm = 0.0
+    step = max(block_size//max(nq, 1), 1)
+    for start in range(0, num_eval, step):
+        stop = min(start + step, num_eval)
+        if call_details.sparse:
+            index = call_details.points[start:stop]
+        else:
+            index = np.arange(start, stop)
+        pd_index = pd_offset + (index[:, None]//pd_stride)%pd_length
+        weight = np.prod(pd_weight[pd_index], axis=1)
+        keep = weight > cutoff
+        if not keep.any():
+            continue
+        weight, pd_index = weight[keep], pd_index[keep]
+
+        # Fill in the parameter values for each point in the block
+        block = np.empty((len(weight), len(parameters)), 'd')
+        block[:] = parameters
+        block[:, pd_par] = pd_value[pd_index]
+        if theta_par >= 0:
+            cor = cos(pi/180 * block[:, theta_par])
+            weight = weight * np.maximum(abs(cor), 1e-6)
+
+        # Exclude any points which produce NaN, as in _loops.
+        Iq = np.asarray(form(block), 'd') * np.ones((len(weight), 1))
+        volume = np.asarray(form_volume(block), 'd').reshape(-1)
+        valid = ~np.isnan(Iq).any(axis=1)
+        weight = weight[valid]
+        total += np.dot(weight, Iq[valid])
+        pd_norm += np.sum(weight * (volume if volume.size == 1
+                                    else volume[valid]))
+
+    return total, pd_norm
+
+
+class JitLoops(object):
+    """
+    Polydispersity loops compiled with numba.
+
+    Models which define *Iq* or *Iqxy*, and *form_volume*, as functions of
+    one *q* value and scalar parameters are compiled along with the loops
+    over *q* and over the polydispersity mesh.  The generated loop calls
+    the functions with the parameters in the table order, much as the
+    macros in *kernel_iq.c* do.  Use :meth:`create` to build the loops for
+    a model, which returns None if the model cannot be compiled.
+
+    Numba compiles the functions when they are first called.  If this
+    fails, the error is logged, *loops* is set to None and the call
+    returns None so that the caller can fall back to the python loop.
+    Errors raised by the model while it is evaluated are not caught, so
+    they reach the caller as they would from the python loop.
+    """
+    def __init__(self, name, loops):
+        # type: (str, Callable) -> None
+        self.name = name
+        self.loops = loops
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create(cls, model_info, is_2d):
+        # type: (ModelInfo, bool) -> Optional[JitLoops]
+        """
+        Generate and compile the loops for *model_info*, or return None
+        if the model is vectorized or has vector parameters.
+        """
+        if numba is None:
+            return None
+        partable = model_info.parameters
+        if any(p.length > 1 for p in partable.kernel_parameters):
+            return None
+
+        # Find the scalar versions of the model functions.  These are
+        # remembered when the vectorized versions are created.
+        Iq = getattr(model_info.Iq, 'scalar', None)
+        Iqxy = getattr(model_info.Iqxy, 'scalar', None)
+        form_volume = model_info.form_volume
+        if is_2d and Iqxy is None and not getattr(model_info.Iqxy, 'from_Iq', False):
+            return None
+        if Iq is None and (not is_2d or Iqxy is None):
+            return None
+        if getattr(form_volume, 'vectorized', False):
+            return None
+
+        # Parameter offsets in the parameter vector.
+        offset, index = 0, {}
+        for p in partable.kernel_parameters:
+            index[p.id] = offset
+            offset += p.length
+        def args(pars):
+            return "".join(", parameters[%d]"%index[p.id] for p in pars)
+        if not is_2d:
+            form_call = "Iq(q[j]%s)"%args(partable.iq_parameters)
+        elif Iqxy is not None:
+            form_call = "Iqxy(q[j, 0], q[j, 1]%s)"%args(partable.iqxy_parameters)
+        else:
+            form_call = ("Iq(sqrt(q[j, 0]**2 + q[j, 1]**2)%s)"
+                         % args(partable.iq_parameters))
+        volume_call = ("form_volume(%s)"%args(partable.form_volume_parameters)[2:]
+                       if form_volume is not None else "1.0")
+
+        source = _JIT_LOOPS%dict(form_call=form_call, volume_call=volume_call)
+        try:
+            compiled = {}  # type: Dict[int, Callable]
+            namespace = {
+                'Iq': _jit_function(Iq, compiled),
+                'Iqxy': _jit_function(Iqxy, compiled),
+                'form_volume': _jit_function(form_volume, compiled),
+                'sqrt': math.sqrt, 'cos': math.cos, 'pi': math.pi,
+                }
+            exec(source, namespace)
+            loops = _njit(namespace['loops'])
+        except Exception as exc:
+            logging.warning("numba failed for %s: %s", model_info.name,
+                            str(exc).split('\n')[0])
+            return None
+        return cls(model_info.name, loops)
+
+    def __call__(self, q, call_details, values, cutoff):
+        # type: (np.ndarray, details.CallDetails, np.ndarray, float) -> Optional[Tuple[np.ndarray, float]]
+        """
+        Return the unnormalized total and the normalization, or None if
+        the loops could not be compiled.
+        """
+        n_pars = call_details.info.parameters.nvalues - 2
+        num_active = call_details.num_active
+        num_weights = call_details.num_weights
+        num_eval = call_details.num_eval
+        if call_details.sparse:
+            points = np.ascontiguousarray(call_details.points[:num_eval])
+        else:
+            points = np.arange(num_eval, dtype='i4')
+        parameters = np.array(values[2:2+n_pars], 'd')
+        total = np.zeros(len(q), 'd')
+        args = (
+            np.ascontiguousarray(q, 'd'), parameters,
+            np.ascontiguousarray(values[2+n_pars:2+n_pars+num_weights], 'd'),
+            np.ascontiguousarray(values[2+n_pars+num_weights:2+n_pars+2*num_weights], 'd'),
+            np.ascontiguousarray(call_details.pd_par[:num_active]),
+            np.ascontiguousarray(call_details.pd_length[:num_active]),
+            np.ascontiguousarray(call_details.pd_offset[:num_active]),
+            np.ascontiguousarray(call_details.pd_stride[:num_active]),
+            int(call_details.theta_par), points, float(cutoff),
+            total, np.empty(len(q), 'd'),
+            )
+        loops = self.loops
+        if loops is None:
+            return None
+        try:
+            pd_norm = loops(*args)
+        except NumbaError as exc:
+            # Compilation errors are raised on the first call.  Errors
+            # raised by the model while it is evaluated are passed on.
+            with self._lock:
+                if self.loops is not None:
+                    logging.warning("numba failed for %s: %s", self.name,
+                                    str(exc).split('\n')[0])
+                    self.loops = None
+            return None
+        return total, pd_norm
+
+def _njit(function):
+    # type: (Callable) -> Callable
+    """
+    Compile *function* with numba, following numpy rather than python for
+    floating point errors, so that division by zero gives inf or nan as it
+    does in the python loops rather than raising ZeroDivisionError.
+    """
+    return numba.njit(function, error_model='numpy')
+
+def _jit_function(function, compiled):
+    # type: (Callable, Dict[int, Callable]) -> Callable
+    """
+    Compile *function* with numba, along with any python functions that it
+    calls through its globals or closure, such as *form_volume* called from
+    *Iq*.  The function is compiled in a copy of its namespace, so the model
+    module is not changed.  *compiled* maps already compiled functions.
+    """
+    if function is None:
+        return None
+    if id(function) in compiled:
+        return compiled[id(function)]
+    # Compile the function before its dependencies to stop recursion.
+    code = function.__code__
+    namespace = dict(function.__globals__)
+    closure = function.__closure__
+    clone = types.FunctionType(code, namespace, function.__name__,
+                               function.__defaults__, closure)
+    compiled[id(function)] = _njit(clone)
+    for name in code.co_names:
+        value = namespace.get(name, None)
+        if isinstance(value, types.FunctionType):
+            namespace[name] = _jit_function(value, compiled)
+    if closure:
+        cells = []
+        for cell in closure:
+            value = cell.cell_contents
+            if isinstance(value, types.FunctionType):
+                value = _jit_function(value, compiled)
+            cells.append(_make_cell(value))
+        clone = types.FunctionType(code, namespace, function.__name__,
+                                   function.__defaults__, tuple(cells))
+        compiled[id(function)] = _njit(clone)
+    return compiled[id(function)]
+
+def _make_cell(value):
+    # CRUFT: python 2 does not have types.CellType
+    return (lambda: value).__closure__[0]
+
+# Polydispersity loops for JitLoops, with the calls to the model functions
+# filled in for each model.  The spherical correction and the treatment of
+# the cutoff follow kernel_iq.c.  As in _loops, points where I(q) is NaN
+# for any q are excluded.
+_JIT_LOOPS = """
+def loops(q, parameters, pd_value, pd_weight, pd_par, pd_length, pd_offset,
+          pd_stride, theta_par, points, cutoff, total, scratch):
+    pd_norm = 0.0
+    nq = scratch.shape[0]
+    for step in range(points.shape[0]):
+        point = points[step]
+        weight = 1.0
+        for k in range(pd_par.shape[0]):
+            i = pd_offset[k] + (point//pd_stride[k])%%pd_length[k]
+            parameters[pd_par[k]] = pd_value[i]
+            weight *= pd_weight[i]
+        if not weight > cutoff:
+            continue
+        if theta_par >= 0:
+            weight *= max(abs(cos(pi/180.*parameters[theta_par])), 1e-6)
+        valid = True
+        for j in range(nq):
+            value = %(form_call)s
+            if value != value:
+                valid = False
+                break
+            scratch[j] = value
+        if not valid:
+            continue
+        for j in range(nq):
+            total[j] += weight*scratch[j]
+        pd_norm += weight*%(volume_call)s
+    return pd_norm
+"""
 
 
 def _create_default_functions(model_info):
@@ -277,6 +662,7 @@ def _create_vector_Iq(model_info):
             """
             return np.array([Iq(qi, *args) for qi in q])
         vector_Iq.vectorized = True
+        vector_Iq.scalar = Iq
         model_info.Iq = vector_Iq
 
 def _create_vector_Iqxy(model_info):
@@ -293,6 +679,7 @@ def _create_vector_Iqxy(model_info):
                 """
                 return np.array([Iqxy(qxi, qyi, *args) for qxi, qyi in zip(qx, qy)])
             vector_Iqxy.vectorized = True
+            vector_Iqxy.scalar = Iqxy
             model_info.Iqxy = vector_Iqxy
     elif callable(Iq):
         #print("defaulting Iqxy")
@@ -303,4 +690,111 @@ def _create_vector_Iqxy(model_info):
             """
             return Iq(np.sqrt(qx**2 + qy**2), *args)
         default_Iqxy.vectorized = True
+        default_Iqxy.pd_vectorized = getattr(Iq, 'pd_vectorized', False)
+        default_Iqxy.from_Iq = True
         model_info.Iqxy = default_Iqxy
+
+
+def test_vector_loops():
+    # type: () -> None
+    """
+    Check that the blocked pd loop matches the loop over single points.
+    """
+    from .core import load_model_info, build_model
+    from .direct_model import call_kernel
+
+    model = build_model(load_model_info('_spherepy'))
+    kernel = model.make_kernel([np.linspace(0.001, 0.5, 20)])
+    pars = dict(radius=60, radius_pd=0.2, radius_pd_n=35)
+    kernel.block_size = 0
+    target = call_kernel(kernel, pars)
+    kernel.block_size = 100
+    actual = call_kernel(kernel, pars)
+    assert np.allclose(actual, target, rtol=1e-12), \
+        "blocked: expected %s but got %s"%(target, actual)
+
+def test_jit_loops():
+    # type: () -> None
+    """
+    Check that the compiled loops match the python loops.
+    """
+    from .modelinfo import make_model_info
+    from .direct_model import call_kernel
+
+    if numba is None:
+        return
+    module = types.ModuleType('_scalar_sphere')
+    module.__file__ = '_scalar_sphere.py'
+    module.name = '_scalar_sphere'
+    module.parameters = [
+        ["sld", "1e-6/Ang^2", 4, [-np.inf, np.inf], "sld", ""],
+        ["sld_solvent", "1e-6/Ang^2", 1, [-np.inf, np.inf], "sld", ""],
+        ["radius", "Ang", 50, [0, np.inf], "volume", ""],
+        ]
+    def form_volume(radius):
+        return 4.*pi/3.*radius**3
+    def Iq(q, sld, sld_solvent, radius):
+        qr = q*radius
+        bes = 1.0 if qr == 0. else 3.*(sin(qr) - qr*cos(qr))/qr**3
+        fq = bes*(sld - sld_solvent)*form_volume(radius)
+        return 1e-4*fq*fq
+    module.form_volume, module.Iq = form_volume, Iq
+
+    global USE_NUMBA
+    model = PyModel(make_model_info(module))
+    q = np.linspace(0.001, 0.5, 20)
+    pars = dict(radius=60, radius_pd=0.2, radius_pd_n=35)
+    for q_vectors in ([q], [q, 0.5*q]):
+        # Compilation is off by default.
+        saved, USE_NUMBA = USE_NUMBA, False
+        try:
+            assert model.make_kernel(q_vectors)._jit is None
+            USE_NUMBA = True
+            kernel = model.make_kernel(q_vectors)
+        finally:
+            USE_NUMBA = saved
+        assert kernel._jit is not None
+        actual = call_kernel(kernel, pars)
+        assert kernel._jit.loops is not None
+        kernel._jit = None
+        target = call_kernel(kernel, pars)
+        assert np.allclose(actual, target, rtol=1e-12), \
+            "jit: expected %s but got %s"%(target, actual)
+
+def test_jit_divide():
+    # type: () -> None
+    """
+    Check that division by zero in compiled models gives inf as in python,
+    and does not turn off compilation.
+    """
+    from .modelinfo import make_model_info
+    from .direct_model import call_kernel
+
+    if numba is None:
+        return
+    module = types.ModuleType('_scalar_pole')
+    module.__file__ = '_scalar_pole.py'
+    module.name = '_scalar_pole'
+    module.parameters = [
+        ["pole", "1/Ang", 0.25, [-np.inf, np.inf], "", ""],
+        ]
+    def Iq(q, pole):
+        return 1.0/(q - pole)
+    module.Iq = Iq
+
+    global USE_NUMBA
+    model = PyModel(make_model_info(module))
+    saved, USE_NUMBA = USE_NUMBA, True
+    try:
+        kernel = model.make_kernel([np.array([0.1, 0.25, 0.5])])
+    finally:
+        USE_NUMBA = saved
+    assert kernel._jit is not None
+    with np.errstate(divide='ignore'):
+        actual = call_kernel(kernel, dict(background=0.))
+        assert kernel._jit.loops is not None
+        kernel._jit = None
+        target = call_kernel(kernel, dict(background=0.))
+    assert np.isinf(actual[1]) and np.isinf(target[1])
+    assert np.allclose(actual, target, rtol=1e-12), \
+        "jit: expected %s but got %s"%(target, actual)
@@ -16,7 +16,7 @@ from copy import copy
 import numpy as np  # type: ignore
 
 from .modelinfo import Parameter, ParameterTable, ModelInfo
-from .kernel import KernelModel, Kernel
+from .kernel import KernelModel, Kernel, get_stats, clock
 from .details import make_details
 
 try:
@@ -186,6 +186,9 @@ class MixtureKernel(Kernel):
 
     def __call__(self, call_details, values, cutoff, magnetic):
         # type: (CallDetails, np.ndarray, np.ndarry, float, bool) -> np.ndarray
+        stats = get_stats()
+        if stats is not None:
+            start_time = clock()
         scale, background = values[0:2]
         total = 0.0
         # remember the parts for plotting later
@@ -205,7 +208,11 @@ class MixtureKernel(Kernel):
                     total *= result
             self.results.append(result)
 
-        return scale*total + background
+        result = scale*total + background
+        if stats is not None:
+            self._record_call(stats, len(result), call_details, values,
+                              cutoff, time_compute=clock()-start_time)
+        return result
 
     def release(self):
         # type: () -> None
@@ -231,7 +238,7 @@ class MixtureParts(object):
         self.mag_index = self.spin_index + 3
         return self
 
-    def next(self):
+    def __next__(self):
         # type: () -> Tuple[List[Callable], CallDetails, np.ndarray]
         if self.part_num >= len(self.parts):
             raise StopIteration()
@@ -250,6 +257,9 @@ class MixtureParts(object):
 
         return kernel, call_details, values
 
+    # CRUFT: python 2 iterators use next() rather than __next__()
+    next = __next__
+
     def _part_details(self, info, par_index):
         # type: (ModelInfo, int) -> CallDetails
         full = self.call_details
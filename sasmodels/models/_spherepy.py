@@ -86,10 +86,12 @@ def Iq(q, sld, sld_solvent, radius):
     fq = bes * (sld - sld_solvent) * form_volume(radius)
     return 1.0e-4 * fq ** 2
 Iq.vectorized = True  # Iq accepts an array of q values
+Iq.pd_vectorized = True  # Iq accepts columns of parameter values
 
 def Iqxy(qx, qy, sld, sld_solvent, radius):
     return Iq(sqrt(qx ** 2 + qy ** 2), sld, sld_solvent, radius)
 Iqxy.vectorized = True  # Iqxy accepts arrays of qx, qy values
+Iqxy.pd_vectorized = True  # Iqxy accepts columns of parameter values
 
 def sesans(z, sld, sld_solvent, radius):
     """
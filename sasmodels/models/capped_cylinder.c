@@ -1,7 +1,7 @@
 double form_volume(double radius, double radius_cap, double length);
 double Iq(double q, double sld, double solvent_sld,
     double radius, double radius_cap, double length);
-double Iqxy(double qx, double qy, double sld, double solvent_sld,
+double Iqxy(double qx, double qy, const QACRotation *rotation, double sld, double solvent_sld,
     double radius, double radius_cap, double length, double theta, double phi);
 
 #define INVALID(v) (v.radius_cap < v.radius)
@@ -117,13 +117,13 @@ double Iq(double q, double sld, double solvent_sld,
 }
 
 
-double Iqxy(double qx, double qy,
+double Iqxy(double qx, double qy, const QACRotation *rotation,
     double sld, double solvent_sld, double radius,
     double radius_cap, double length,
     double theta, double phi)
 {
     double q, sin_alpha, cos_alpha;
-    ORIENT_SYMMETRIC(qx, qy, theta, phi, q, sin_alpha, cos_alpha);
+    QAC_SYMMETRIC(rotation, qx, qy, q, sin_alpha, cos_alpha);
 
     const double h = sqrt(radius_cap*radius_cap - radius*radius);
     const double Aq = _fq(q, h, radius_cap, radius, 0.5*length, sin_alpha, cos_alpha);
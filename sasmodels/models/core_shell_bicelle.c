@@ -10,7 +10,7 @@ double Iq(double q,
           double solvent_sld);
 
 
-double Iqxy(double qx, double qy,
+double Iqxy(double qx, double qy, const QACRotation *rotation,
           double radius,
           double thick_rim,
           double thick_face,
@@ -95,7 +95,7 @@ bicelle_integration(double q,
 }
 
 static double
-bicelle_kernel_2d(double qx, double qy,
+bicelle_kernel_2d(double qx, double qy, const QACRotation *rotation,
           double radius,
           double thick_rim,
           double thick_face,
@@ -103,12 +103,10 @@ bicelle_kernel_2d(double qx, double qy,
           double core_sld,
           double face_sld,
           double rim_sld,
-          double solvent_sld,
-          double theta,
-          double phi)
+          double solvent_sld)
 {
     double q, sin_alpha, cos_alpha;
-    ORIENT_SYMMETRIC(qx, qy, theta, phi, q, sin_alpha, cos_alpha);
+    QAC_SYMMETRIC(rotation, qx, qy, q, sin_alpha, cos_alpha);
 
     double answer = bicelle_kernel(q, radius, thick_rim, thick_face,
                            0.5*length, core_sld, face_sld, rim_sld,
@@ -132,7 +130,7 @@ double Iq(double q,
 }
 
 
-double Iqxy(double qx, double qy,
+double Iqxy(double qx, double qy, const QACRotation *rotation,
           double radius,
           double thick_rim,
           double thick_face,
@@ -144,7 +142,7 @@ double Iqxy(double qx, double qy,
           double theta,
           double phi)
 {
-    double intensity = bicelle_kernel_2d(qx, qy,
+    double intensity = bicelle_kernel_2d(qx, qy, rotation,
                       radius,
                       thick_rim,
                       thick_face,
@@ -152,9 +150,7 @@ double Iqxy(double qx, double qy,
                       core_sld,
                       face_sld,
                       rim_sld,
-                      solvent_sld,
-                      theta,
-                      phi);
+                      solvent_sld);
 
     return intensity;
 }
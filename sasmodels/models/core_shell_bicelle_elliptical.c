@@ -76,7 +76,7 @@ Iq(double q,
 }
 
 static double
-Iqxy(double qx, double qy,
+Iqxy(double qx, double qy, const QACRotation *rotation,
           double r_minor,
           double x_core,
           double thick_rim,
@@ -92,7 +92,7 @@ Iqxy(double qx, double qy,
 {
        // THIS NEEDS TESTING
     double q, xhat, yhat, zhat;
-    ORIENT_ASYMMETRIC(qx, qy, theta, phi, psi, q, xhat, yhat, zhat);
+    QAC_ASYMMETRIC(rotation, qx, qy, q, xhat, yhat, zhat);
     const double dr1 = rhoc-rhoh;
     const double dr2 = rhor-rhosolv;
     const double dr3 = rhoh-rhor;
@@ -1,7 +1,7 @@
 double form_volume(double radius, double thickness, double length);
 double Iq(double q, double core_sld, double shell_sld, double solvent_sld,
     double radius, double thickness, double length);
-double Iqxy(double qx, double qy, double core_sld, double shell_sld, double solvent_sld,
+double Iqxy(double qx, double qy, const QACRotation *rotation, double core_sld, double shell_sld, double solvent_sld,
     double radius, double thickness, double length, double theta, double phi);
 
 // vd = volume * delta_rho
@@ -51,7 +51,7 @@ double Iq(double q,
 }
 
 
-double Iqxy(double qx, double qy,
+double Iqxy(double qx, double qy, const QACRotation *rotation,
     double core_sld,
     double shell_sld,
     double solvent_sld,
@@ -62,7 +62,7 @@ double Iqxy(double qx, double qy,
     double phi)
 {
     double q, sin_alpha, cos_alpha;
-    ORIENT_SYMMETRIC(qx, qy, theta, phi, q, sin_alpha, cos_alpha);
+    QAC_SYMMETRIC(rotation, qx, qy, q, sin_alpha, cos_alpha);
 
     const double core_qr = q*radius;
     const double core_qh = q*0.5*length;
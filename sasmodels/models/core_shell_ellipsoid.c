@@ -12,7 +12,7 @@ double Iq(double q,
           double solvent_sld);
 
 
-double Iqxy(double qx, double qy,
+double Iqxy(double qx, double qy, const QACRotation *rotation,
           double radius_equat_core,
           double x_core,
           double thick_shell,
@@ -71,19 +71,17 @@ core_shell_ellipsoid_xt_kernel(double q,
 }
 
 static double
-core_shell_ellipsoid_xt_kernel_2d(double qx, double qy,
+core_shell_ellipsoid_xt_kernel_2d(double qx, double qy, const QACRotation *rotation,
           double radius_equat_core,
           double x_core,
           double thick_shell,
           double x_polar_shell,
           double core_sld,
           double shell_sld,
-          double solvent_sld,
-          double theta,
-          double phi)
+          double solvent_sld)
 {
     double q, sin_alpha, cos_alpha;
-    ORIENT_SYMMETRIC(qx, qy, theta, phi, q, sin_alpha, cos_alpha);
+    QAC_SYMMETRIC(rotation, qx, qy, q, sin_alpha, cos_alpha);
 
     const double sldcs = core_sld - shell_sld;
     const double sldss = shell_sld- solvent_sld;
@@ -131,7 +129,7 @@ double Iq(double q,
 }
 
 
-double Iqxy(double qx, double qy,
+double Iqxy(double qx, double qy, const QACRotation *rotation,
           double radius_equat_core,
           double x_core,
           double thick_shell,
@@ -142,16 +140,14 @@ double Iqxy(double qx, double qy,
           double theta,
           double phi)
 {
-    double intensity = core_shell_ellipsoid_xt_kernel_2d(qx, qy,
+    double intensity = core_shell_ellipsoid_xt_kernel_2d(qx, qy, rotation,
                        radius_equat_core,
                        x_core,
                        thick_shell,
                        x_polar_shell,
                        core_sld,
                        shell_sld,
-                       solvent_sld,
-                       theta,
-                       phi);
+                       solvent_sld);
 
     return intensity;
 }
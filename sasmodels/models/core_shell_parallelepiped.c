@@ -3,7 +3,7 @@ double form_volume(double length_a, double length_b, double length_c,
 double Iq(double q, double core_sld, double arim_sld, double brim_sld, double crim_sld,
           double solvent_sld, double length_a, double length_b, double length_c,
           double thick_rim_a, double thick_rim_b, double thick_rim_c);
-double Iqxy(double qx, double qy, double core_sld, double arim_sld, double brim_sld,
+double Iqxy(double qx, double qy, const QACRotation *rotation, double core_sld, double arim_sld, double brim_sld,
             double crim_sld, double solvent_sld, double length_a, double length_b,
             double length_c, double thick_rim_a, double thick_rim_b,
             double thick_rim_c, double theta, double phi, double psi);
@@ -117,7 +117,7 @@ double Iq(double q,
     return 1.0e-4 * outer_total;
 }
 
-double Iqxy(double qx, double qy,
+double Iqxy(double qx, double qy, const QACRotation *rotation,
     double core_sld,
     double arim_sld,
     double brim_sld,
@@ -134,7 +134,7 @@ double Iqxy(double qx, double qy,
     double psi)
 {
     double q, zhat, yhat, xhat;
-    ORIENT_ASYMMETRIC(qx, qy, theta, phi, psi, q, xhat, yhat, zhat);
+    QAC_ASYMMETRIC(rotation, qx, qy, q, xhat, yhat, zhat);
 
     // cspkernel in csparallelepiped recoded here
     const double dr0 = core_sld-solvent_sld;
@@ -2,7 +2,7 @@ double form_volume(double radius, double length);
 double fq(double q, double sn, double cn,double radius, double length);
 double orient_avg_1D(double q, double radius, double length);
 double Iq(double q, double sld, double solvent_sld, double radius, double length);
-double Iqxy(double qx, double qy, double sld, double solvent_sld,
+double Iqxy(double qx, double qy, const QACRotation *rotation, double sld, double solvent_sld,
     double radius, double length, double theta, double phi);
 
 #define INVALID(v) (v.radius<0 || v.length<0)
@@ -49,7 +49,7 @@ double Iq(double q,
 }
 
 
-double Iqxy(double qx, double qy,
+double Iqxy(double qx, double qy, const QACRotation *rotation,
     double sld,
     double solvent_sld,
     double radius,
@@ -58,7 +58,7 @@ double Iqxy(double qx, double qy,
     double phi)
 {
     double q, sin_alpha, cos_alpha;
-    ORIENT_SYMMETRIC(qx, qy, theta, phi, q, sin_alpha, cos_alpha);
+    QAC_SYMMETRIC(rotation, qx, qy, q, sin_alpha, cos_alpha);
     //printf("sn: %g cn: %g\n", sin_alpha, cos_alpha);
     const double s = (sld-solvent_sld) * form_volume(radius, length);
     const double form = fq(q, sin_alpha, cos_alpha, radius, length);
@@ -1,6 +1,6 @@
 double form_volume(double radius_polar, double radius_equatorial);
 double Iq(double q, double sld, double sld_solvent, double radius_polar, double radius_equatorial);
-double Iqxy(double qx, double qy, double sld, double sld_solvent,
+double Iqxy(double qx, double qy, const QACRotation *rotation, double sld, double sld_solvent,
     double radius_polar, double radius_equatorial, double theta, double phi);
 
 double form_volume(double radius_polar, double radius_equatorial)
@@ -40,7 +40,7 @@ double Iq(double q,
     return 1.0e-4 * s * s * form;
 }
 
-double Iqxy(double qx, double qy,
+double Iqxy(double qx, double qy, const QACRotation *rotation,
     double sld,
     double sld_solvent,
     double radius_polar,
@@ -49,7 +49,7 @@ double Iqxy(double qx, double qy,
     double phi)
 {
     double q, sin_alpha, cos_alpha;
-    ORIENT_SYMMETRIC(qx, qy, theta, phi, q, sin_alpha, cos_alpha);
+    QAC_SYMMETRIC(rotation, qx, qy, q, sin_alpha, cos_alpha);
     const double r = sqrt(square(radius_equatorial*sin_alpha)
                           + square(radius_polar*cos_alpha));
     const double f = sas_3j1x_x(q*r);
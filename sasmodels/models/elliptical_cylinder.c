@@ -1,7 +1,7 @@
 double form_volume(double radius_minor, double r_ratio, double length);
 double Iq(double q, double radius_minor, double r_ratio, double length,
           double sld, double solvent_sld);
-double Iqxy(double qx, double qy, double radius_minor, double r_ratio, double length,
+double Iqxy(double qx, double qy, const QACRotation *rotation, double radius_minor, double r_ratio, double length,
             double sld, double solvent_sld, double theta, double phi, double psi);
 
 
@@ -61,13 +61,13 @@ Iq(double q, double radius_minor, double r_ratio, double length,
 
 
 double
-Iqxy(double qx, double qy,
+Iqxy(double qx, double qy, const QACRotation *rotation,
      double radius_minor, double r_ratio, double length,
      double sld, double solvent_sld,
      double theta, double phi, double psi)
 {
     double q, xhat, yhat, zhat;
-    ORIENT_ASYMMETRIC(qx, qy, theta, phi, psi, q, xhat, yhat, zhat);
+    QAC_ASYMMETRIC(rotation, qx, qy, q, xhat, yhat, zhat);
 
     // Compute:  r = sqrt((radius_major*cos_nu)^2 + (radius_minor*cos_mu)^2)
     // Given:    radius_major = r_ratio * radius_minor
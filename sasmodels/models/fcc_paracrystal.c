@@ -1,6 +1,6 @@
 double form_volume(double radius);
 double Iq(double q,double dnn,double d_factor, double radius,double sld, double solvent_sld);
-double Iqxy(double qx, double qy, double dnn,
+double Iqxy(double qx, double qy, const QACRotation *rotation, double dnn,
     double d_factor, double radius,double sld, double solvent_sld,
     double theta, double phi, double psi);
 
@@ -84,13 +84,13 @@ double Iq(double q, double dnn,
 
 }
 
-double Iqxy(double qx, double qy,
+double Iqxy(double qx, double qy, const QACRotation *rotation,
     double dnn, double d_factor, double radius,
     double sld, double solvent_sld,
     double theta, double phi, double psi)
 {
     double q, zhat, yhat, xhat;
-    ORIENT_ASYMMETRIC(qx, qy, theta, phi, psi, q, xhat, yhat, zhat);
+    QAC_ASYMMETRIC(rotation, qx, qy, q, xhat, yhat, zhat);
 
     const double a1 = yhat + xhat;
     const double a2 = xhat + zhat;
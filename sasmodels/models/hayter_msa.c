@@ -1,8 +1,10 @@
 // Hayter-Penfold (rescaled) MSA structure factor for screened Coulomb interactions 
 //
 // C99 needs declarations of routines here
-double Iq(double QQ,
-      double radius_effective, double zz, double VolFrac, double Temp, double csalt, double dialec);
+void setup(double gMSAWave[],
+      double radius_effective, double VolFrac, double zz, double Temp, double csalt, double dialec);
+double Iq(double QQ, double gMSAWave[],
+      double radius_effective, double VolFrac, double zz, double Temp, double csalt, double dialec);
 int
 sqcoef(int ir, double gMSAWave[]);
 
@@ -12,19 +14,22 @@ sqfun(int ix, int ir, double gMSAWave[]);
 double
 sqhcal(double qq, double gMSAWave[]);
   
-double Iq(double QQ,
+// The MSA coefficients depend only on the parameters, so solve for them once
+// for each parameter set and store them in gMSAWave for Iq.  gMSAWave[17]
+// holds the error code from sqcoef, which is negative if the solve failed.
+void setup(double gMSAWave[],
       double radius_effective, double VolFrac, double zz, double Temp, double csalt, double dialec)
 {
-    double gMSAWave[17]={1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17};
 	double Elcharge=1.602189e-19;		// electron charge in Coulombs (C)
 	double kB=1.380662e-23;				// Boltzman constant in J/K
 	double FrSpPerm=8.85418782E-12;	//Permittivity of free space in C^2/(N m^2)
-	double SofQ, Qdiam, Vp, ss;
+	double Vp, ss;
 	double SIdiam, diam, Kappa, cs, IonSt;
 	double  Perm, Beta;
 	double charge;
 	int ierr;
 	
+	for (int i=0; i < 17; i++) gMSAWave[i] = i+1;
 	diam=2*radius_effective;		//in A
 
 						////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////
@@ -50,7 +55,6 @@ double Iq(double QQ,
 	gMSAWave[5]=Beta*charge*charge/(M_PI*Perm*SIdiam*square(2.0+Kappa*SIdiam));
 	
 	//         Finally set up dimensionless parameters 
-	Qdiam=QQ*diam;
 	gMSAWave[6] = Kappa*SIdiam;
 	gMSAWave[4] = VolFrac;
 	
@@ -66,8 +70,15 @@ double Iq(double QQ,
 	
 	ierr=0;
 	ierr=sqcoef(ierr, gMSAWave);
-	if (ierr>=0) {
-		SofQ=sqhcal(Qdiam, gMSAWave);
+	gMSAWave[17]=ierr;
+}
+
+double Iq(double QQ, double gMSAWave[],
+      double radius_effective, double VolFrac, double zz, double Temp, double csalt, double dialec)
+{
+	double SofQ;
+	if (gMSAWave[17]>=0) {
+		SofQ=sqhcal(QQ*2*radius_effective, gMSAWave);
 	}else{
        	SofQ=NAN;
 		//	print "Error Level = ",ierr
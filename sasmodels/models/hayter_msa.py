@@ -40,7 +40,7 @@ J B Hayter and J Penfold, *Molecular Physics*, 42 (1981) 109-118
 
 J P Hansen and J B Hayter, *Molecular Physics*, 46 (1982) 651-656
 """
-from numpy import inf
+from numpy import inf, nan
 
 category = "structure-factor"
 structure_factor = True
@@ -144,6 +144,17 @@ tests = [
       'dielectconst': 78.0,
       'radius_effective_pd': 0.1,
       'radius_effective_pd_n': 40},
-     [0.00001, 0.0010, 0.01, 0.075], [0.450272, 0.450420, 0.465116, 1.039625]]
+     [0.00001, 0.0010, 0.01, 0.075], [0.450272, 0.450420, 0.465116, 1.039625]],
+    # Values from before the MSA solve moved into setup().
+    [{'charge': 40.0, 'volfraction': 0.3, 'concentration_salt': 0.1},
+     [0.001, 0.01, 0.05, 0.1, 0.3],
+     [0.0233545, 0.0237778, 0.0374146, 0.204572, 1.02907]],
+    [{'charge': 5.0, 'volfraction': 0.1, 'temperature': 350.0,
+      'dielectconst': 40.0},
+     [0.001, 0.01, 0.05, 0.1, 0.3],
+     [0.145346, 0.153931, 0.396048, 1.02714, 1.00728]],
+    # The MSA solve fails, so S(q) is undefined.
+    [{'charge': 1000.0, 'volfraction': 0.0001},
+     [0.001, 0.01, 0.1], [nan, nan, nan]],
     ]
 # ADDED by:  RKH  ON: 16Mar2016 converted from sasview, new Taylor expansion at smallest rescaled Q
@@ -1,7 +1,7 @@
 double form_volume(double radius, double thickness, double length);
 double Iq(double q, double radius, double thickness, double length, double sld,
 	double solvent_sld);
-double Iqxy(double qx, double qy, double radius, double thickness, double length, double sld,
+double Iqxy(double qx, double qy, const QACRotation *rotation, double radius, double thickness, double length, double sld,
 	double solvent_sld, double theta, double phi);
 
 //#define INVALID(v) (v.radius_core >= v.radius)
@@ -59,12 +59,12 @@ Iq(double q, double radius, double thickness, double length,
 }
 
 double
-Iqxy(double qx, double qy,
+Iqxy(double qx, double qy, const QACRotation *rotation,
     double radius, double thickness, double length,
     double sld, double solvent_sld, double theta, double phi)
 {
     double q, sin_alpha, cos_alpha;
-    ORIENT_SYMMETRIC(qx, qy, theta, phi, q, sin_alpha, cos_alpha);
+    QAC_SYMMETRIC(rotation, qx, qy, q, sin_alpha, cos_alpha);
     const double Aq = _hollow_cylinder_kernel(q, radius, thickness, length,
         sin_alpha, cos_alpha);
 
@@ -1,7 +1,7 @@
 double form_volume(double length_a, double length_b, double length_c);
 double Iq(double q, double sld, double solvent_sld,
     double length_a, double length_b, double length_c);
-double Iqxy(double qx, double qy, double sld, double solvent_sld,
+double Iqxy(double qx, double qy, const QACRotation *rotation, double sld, double solvent_sld,
     double length_a, double length_b, double length_c,
     double theta, double phi, double psi);
 
@@ -56,7 +56,7 @@ double Iq(double q,
 }
 
 
-double Iqxy(double qx, double qy,
+double Iqxy(double qx, double qy, const QACRotation *rotation,
     double sld,
     double solvent_sld,
     double length_a,
@@ -67,7 +67,7 @@ double Iqxy(double qx, double qy,
     double psi)
 {
     double q, xhat, yhat, zhat;
-    ORIENT_ASYMMETRIC(qx, qy, theta, phi, psi, q, xhat, yhat, zhat);
+    QAC_ASYMMETRIC(rotation, qx, qy, q, xhat, yhat, zhat);
 
     const double siA = sas_sinx_x(0.5*length_a*q*xhat);
     const double siB = sas_sinx_x(0.5*length_b*q*yhat);
@@ -7,7 +7,7 @@ double Iq(double q,
           double sphere_sld,
           double solvent_sld);
 
-double Iqxy(double qx, double qy,
+double Iqxy(double qx, double qy, const QACRotation *rotation,
             double dnn,
             double d_factor,
             double radius,
@@ -100,7 +100,7 @@ double Iq(double q,
 	return answer;
 }
 
-double Iqxy(double qx, double qy,
+double Iqxy(double qx, double qy, const QACRotation *rotation,
           double dnn,
           double d_factor,
           double radius,
@@ -111,7 +111,7 @@ double Iqxy(double qx, double qy,
           double psi)
 {
     double q, zhat, yhat, xhat;
-    ORIENT_ASYMMETRIC(qx, qy, theta, phi, psi, q, xhat, yhat, zhat);
+    QAC_ASYMMETRIC(rotation, qx, qy, q, xhat, yhat, zhat);
 
     const double qd = q*dnn;
     const double arg = 0.5*square(qd*d_factor);
@@ -139,7 +139,7 @@ static double Iq(
 }
 
 
-static double Iqxy(double qx, double qy,
+static double Iqxy(double qx, double qy, const QACRotation *rotation,
     double thick_core,
     double thick_layer,
     double radius,
@@ -153,7 +153,7 @@ static double Iqxy(double qx, double qy,
 {
     int n_stacking = (int)(fp_n_stacking + 0.5);
     double q, sin_alpha, cos_alpha;
-    ORIENT_SYMMETRIC(qx, qy, theta, phi, q, sin_alpha, cos_alpha);
+    QAC_SYMMETRIC(rotation, qx, qy, q, sin_alpha, cos_alpha);
 
     double d = 2.0 * thick_layer + thick_core;
     double halfheight = 0.5*thick_core;
@@ -1,7 +1,7 @@
 double form_volume(double radius_equat_minor, double radius_equat_major, double radius_polar);
 double Iq(double q, double sld, double sld_solvent,
     double radius_equat_minor, double radius_equat_major, double radius_polar);
-double Iqxy(double qx, double qy, double sld, double sld_solvent,
+double Iqxy(double qx, double qy, const QACRotation *rotation, double sld, double sld_solvent,
     double radius_equat_minor, double radius_equat_major, double radius_polar, double theta, double phi, double psi);
 
 //#define INVALID(v) (v.radius_equat_minor > v.radius_equat_major || v.radius_equat_major > v.radius_polar)
@@ -48,7 +48,7 @@ double Iq(double q,
     return 1.0e-4 * s * s * fqsq;
 }
 
-double Iqxy(double qx, double qy,
+double Iqxy(double qx, double qy, const QACRotation *rotation,
     double sld,
     double sld_solvent,
     double radius_equat_minor,
@@ -59,7 +59,7 @@ double Iqxy(double qx, double qy,
     double psi)
 {
     double q, xhat, yhat, zhat;
-    ORIENT_ASYMMETRIC(qx, qy, theta, phi, psi, q, xhat, yhat, zhat);
+    QAC_ASYMMETRIC(rotation, qx, qy, q, xhat, yhat, zhat);
 
     const double r = sqrt(square(radius_equat_minor*xhat)
                           + square(radius_equat_major*yhat)
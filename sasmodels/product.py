@@ -16,7 +16,7 @@ from copy import copy
 import numpy as np  # type: ignore
 
 from .modelinfo import Parameter, ParameterTable, ModelInfo
-from .kernel import KernelModel, Kernel
+from .kernel import KernelModel, Kernel, get_stats, clock
 from .details import make_details, dispersion_mesh
 
 try:
@@ -163,6 +163,9 @@ class ProductKernel(Kernel):
 
     def __call__(self, call_details, values, cutoff, magnetic):
         # type: (CallDetails, np.ndarray, float, bool) -> np.ndarray
+        stats = get_stats()
+        if stats is not None:
+            start_time = clock()
         p_info, s_info = self.info.composition[1]
 
         # if there are magnetic parameters, they will only be on the
@@ -245,7 +248,11 @@ class ProductKernel(Kernel):
         #plt.subplot(212); plt.loglog(self.s_kernel.q_input.q, s_result, '-')
         #plt.figure()
 
-        return values[0]*(p_result*s_result) + values[1]
+        result = values[0]*(p_result*s_result) + values[1]
+        if stats is not None:
+            self._record_call(stats, len(result), call_details, values,
+                              cutoff, time_compute=clock()-start_time)
+        return result
 
     def release(self):
         # type: () -> None
@@ -14,8 +14,9 @@ from copy import deepcopy
 import collections
 import traceback
 import logging
+import hashlib
 from os.path import basename, splitext, abspath, getmtime
-import thread
+import threading
 
 import numpy as np  # type: ignore
 
@@ -30,7 +31,7 @@ from .details import make_kernel_args, dispersion_mesh
 try:
     from typing import Dict, Mapping, Any, Sequence, Tuple, NamedTuple, List, Optional, Union, Callable
     from .modelinfo import ModelInfo, Parameter
-    from .kernel import KernelModel
+    from .kernel import KernelModel, Kernel
     MultiplicityInfoType = NamedTuple(
         'MuliplicityInfo',
         [("number", int), ("control", str), ("choices", List[str]),
@@ -41,7 +42,8 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
-calculation_lock = thread.allocate_lock()
+# Protects the lazy creation of the kernel cache on each model instance.
+_CACHE_LOCK = threading.Lock()
 
 #: True if pre-existing plugins, with the old names and parameters, should
 #: continue to be supported.
@@ -53,6 +55,12 @@ MultiplicityInfo = collections.namedtuple(
     ["number", "control", "choices", "x_axis_label"],
 )
 
+#: Results from :meth:`SasviewModel.calculate_Iq_segments`.  *Iq* is the list
+#: of I(q) for each segment.  *parts* is None if the model is not a
+#: composition, otherwise it is a list with the intermediate results for each
+#: segment, such as [P, S] for a product model.
+SegmentResults = collections.namedtuple('SegmentResults', ["Iq", "parts"])
+
 #: set of defined models (standard and custom)
 MODELS = {}  # type: Dict[str, SasviewModelType]
 #: custom model {path: model} mapping so we can check timestamps
@@ -273,9 +281,89 @@ def _generate_model_attributes(model_info):
 
     return attrs
 
+class _KernelCache(collections.OrderedDict):
+    """
+    Kernels for a model, indexed by q vectors, in order of most recent use.
+
+    *lock* protects the cache and the creation of the model.  It is held
+    only while looking up or adding a kernel, so that calculations for
+    different q vectors on the same model instance run at the same time.
+    Calculations with the same kernel take turns using the lock returned
+    from :meth:`acquire`, since they share the kernel argument buffers and
+    intermediate results.  Kernels dropped from the cache while in use are
+    released by :meth:`done` when the last calculation completes.
+
+    The kernels hold process resources such as loaded dlls and OpenCL
+    buffers, so copies of the cache start out empty.
+    """
+    def __init__(self):
+        collections.OrderedDict.__init__(self)
+        self.lock = threading.Condition()
+        # kernel: [call lock, number of calculations using it, dropped]
+        self._usage = {}  # type: Dict[Kernel, List[Any]]
+
+    def acquire(self, key, make_kernel, size):
+        # type: (str, Callable[[], Kernel], int) -> Tuple[Kernel, threading.Lock]
+        """
+        Return the kernel for *key*, creating it with *make_kernel* if it is
+        not in the cache, along with the lock to hold while calling it.
+        Keeps at most *size* kernels, dropping the least recently used.
+
+        The kernel is in use until :meth:`done` is called.
+        """
+        with self.lock:
+            kernel = self.pop(key, None)
+            if kernel is None:
+                kernel = make_kernel()
+                while self and len(self) >= size:
+                    _, old_kernel = self.popitem(last=False)
+                    if old_kernel in self._usage:
+                        self._usage[old_kernel][2] = True
+                    else:
+                        old_kernel.release()
+            # Put the kernel at the end of the list so it is the last to go.
+            self[key] = kernel
+            usage = self._usage.setdefault(kernel, [threading.Lock(), 0, False])
+            usage[1] += 1
+            return kernel, usage[0]
+
+    def done(self, kernel):
+        # type: (Kernel) -> None
+        """
+        Mark the end of a calculation using *kernel* from :meth:`acquire`.
+        """
+        with self.lock:
+            usage = self._usage[kernel]
+            usage[1] -= 1
+            if usage[1] == 0:
+                del self._usage[kernel]
+                if usage[2]:
+                    kernel.release()
+                self.lock.notify_all()
+
+    def wait(self):
+        # type: () -> None
+        """
+        Wait until no calculations are using the kernels.  The caller must
+        hold *lock*.
+        """
+        while self._usage:
+            self.lock.wait()
+
+    def __deepcopy__(self, memo):
+        return _KernelCache()
+
+    def __reduce__(self):
+        return (_KernelCache, ())
+
+
 class SasviewModel(object):
     """
     Sasview wrapper for opencl/ctypes model.
+
+    Each model instance can be used from multiple threads.  Calculations
+    for the same instance are run one at a time, but different instances,
+    including clones of the same model, can calculate at the same time.
     """
     # Model parameters for the specific model are set in the class constructor
     # via the _generate_model_attributes function, which subclasses
@@ -309,6 +397,9 @@ class SasviewModel(object):
     #: default cutoff for polydispersity
     cutoff = 1e-5
 
+    #: number of kernels to keep for reuse with the same q vectors
+    kernel_cache_size = 4
+
     # Note: Use non-mutable values for class attributes to avoid errors
     #: parameters that are not fitted
     non_fittable = ()        # type: Sequence[str]
@@ -334,6 +425,8 @@ class SasviewModel(object):
     multiplicity = None     # type: Optional[int]
     #: memory for polydispersity array if using ArrayDispersion (used by sasview).
     _persistency_dict = None # type: Dict[str, Tuple[np.ndarray, np.ndarray]]
+    #: kernels for recently used q vectors
+    _kernel_cache = None # type: Dict[str, Kernel]
 
     def __init__(self, multiplicity=None):
         # type: (Optional[int]) -> None
@@ -364,6 +457,7 @@ class SasviewModel(object):
             self._model_info.parameters.defaults['background'] = 0.
 
         self._persistency_dict = {}
+        self._kernel_cache = _KernelCache()
         self.params = collections.OrderedDict()
         self.dispersion = collections.OrderedDict()
         self.details = {}
@@ -601,13 +695,14 @@ class SasviewModel(object):
         returns parts of the composition model or None if not a composition
         model.
         """
-        # TODO: have calculate_Iq return the intermediates.
+        # Callers which use calculate_Iq() for I(q) and then this method for
+        # the parts evaluate the model twice.  Use calculate_Iq_segments()
+        # instead, which returns I(q) and the parts for the data q values
+        # and the extra q values needed for resolution from one evaluation.
+        # This method evaluates the parts the same way, as a single segment.
         #
-        # The current interface causes calculate_Iq() to be called twice,
-        # once to get the combined result and again to get the intermediate
-        # results.  This is necessary for now.
-        # Long term, the solution is to change the interface to calculate_Iq
-        # so that it returns a results object containing all the bits:
+        # Long term, the solution is to have the model calculator return a
+        # results object containing all the bits:
         #     the A, B, C, ... of the composition model (and any subcomponents?)
         #     the P and S of the product model,
         #     the combined model before resolution smearing,
@@ -619,19 +714,9 @@ class SasviewModel(object):
         # Have the model calculator add all of these blindly to the data
         # tree, and update the graphs which contain them.  The fitter
         # needs to be updated to use the I(q) value only, ignoring the rest.
-        #
-        # The simple fix of returning the existing intermediate results
-        # will not work for a couple of reasons: (1) another thread may
-        # sneak in to compute its own results before calc_composition_models
-        # is called, and (2) calculate_Iq is currently called three times:
-        # once with q, once with q values before qmin and once with q values
-        # after q max.  Both of these should be addressed before
-        # replacing this code.
         composition = self._model_info.composition
         if composition and composition[0] == 'product': # only P*S for now
-            with calculation_lock:
-                self._calculate_Iq(qx)
-                return self._intermediate_results
+            return self.calculate_Iq_segments([qx]).parts[0]
         else:
             return None
 
@@ -642,42 +727,123 @@ class SasviewModel(object):
 
         If the model is 1D, use *q*.  If 2D, use *qx*, *qy*.
 
-        This should NOT be used for fitting since it copies the *q* vectors
-        to the card for each evaluation.
+        The kernels for the most recent *kernel_cache_size* sets of *q*
+        are kept, so repeated calls with the same *q* do not need to copy
+        the *q* vectors to the card or reload the model.  Use
+        :meth:`clear_kernel_cache` to release them.
+
+        Calls from several threads with different *q* run at the same time,
+        while calls with the same *q* share a kernel and take turns.
+        """
+        return self._calculate_Iq(qx, qy)[0]
+
+    def calculate_Iq_segments(self, qx, qy=None):
+        # type: (Sequence[Sequence[float]], Optional[Sequence[Sequence[float]]]) -> SegmentResults
         """
-        ## uncomment the following when trying to debug the uncoordinated calls
-        ## to calculate_Iq
-        #if calculation_lock.locked():
-        #    logger.info("calculation waiting for another thread to complete")
-        #    logger.info("\n".join(traceback.format_stack()))
+        Calculate Iq for several sets of q with the current parameters.
 
-        with calculation_lock:
-            return self._calculate_Iq(qx, qy)
+        *qx* is a list of q vectors, one for each segment, such as the q
+        values of the data and the extra q values below *qmin* and above
+        *qmax* needed for resolution smearing.  If the model is 2D, use
+        matching lists of *qx* and *qy* vectors.
+
+        The segments are evaluated together in one kernel call, so the
+        polydispersity loop is only run once.  Returns
+        :class:`SegmentResults` with I(q) for each segment, and for
+        composition models, the intermediate results for each segment.
+        """
+        qx = [np.asarray(q) for q in qx]
+        bounds = np.cumsum([0] + [len(q) for q in qx])
+        def split(v):
+            return [v[lo:hi] for lo, hi in zip(bounds[:-1], bounds[1:])]
+        if qy is not None:
+            qy = np.hstack([np.asarray(q) for q in qy])
+        Iq, parts = self._calculate_Iq(np.hstack(qx), qy)
+        if parts:
+            parts = [list(segment) for segment in zip(*[split(p) for p in parts])]
+        else:
+            parts = None
+        return SegmentResults(split(Iq), parts)
 
     def _calculate_Iq(self, qx, qy=None):
+        # type: (Sequence[float], Optional[Sequence[float]]) -> Tuple[np.ndarray, Optional[List[np.ndarray]]]
+        """
+        Return I(q) and, for composition models, the intermediate results.
+        """
         #core.HAVE_OPENCL = False
-        if self._model is None:
-            self._model = core.build_model(self._model_info)
         if qy is not None:
             q_vectors = [np.asarray(qx), np.asarray(qy)]
         else:
             q_vectors = [np.asarray(qx)]
-        calculator = self._model.make_kernel(q_vectors)
-        parameters = self._model_info.parameters
-        pairs = [self._get_weights(p) for p in parameters.call_parameters]
-        #weights.plot_weights(self._model_info, pairs)
-        call_details, values, is_magnetic = make_kernel_args(calculator, pairs)
-        #call_details.show()
-        #print("pairs", pairs)
-        #print("params", self.params)
-        #print("values", values)
-        #print("is_mag", is_magnetic)
-        result = calculator(call_details, values, cutoff=self.cutoff,
-                            magnetic=is_magnetic)
-        self._intermediate_results = getattr(calculator, 'results', None)
-        calculator.release()
-        self._model.release()
-        return result
+        cache = self._get_kernel_cache()
+        calculator, call_lock = self._get_kernel(q_vectors)
+        try:
+            with call_lock:
+                parameters = self._model_info.parameters
+                pairs = [self._get_weights(p) for p in parameters.call_parameters]
+                #weights.plot_weights(self._model_info, pairs)
+                call_details, values, is_magnetic = make_kernel_args(
+                    calculator, pairs, cutoff=self.cutoff, reuse=True)
+                #call_details.show()
+                #print("pairs", pairs)
+                #print("params", self.params)
+                #print("values", values)
+                #print("is_mag", is_magnetic)
+                result = calculator(call_details, values, cutoff=self.cutoff,
+                                    magnetic=is_magnetic)
+                parts = getattr(calculator, 'results', None)
+        finally:
+            cache.done(calculator)
+        return result, parts
+
+    def _get_kernel(self, q_vectors):
+        # type: (List[np.ndarray]) -> Tuple[Kernel, threading.Lock]
+        """
+        Return a kernel for *q_vectors* and the lock to hold while calling
+        it, reusing the kernel from a previous call with the same q values
+        if it is still in the cache.  Call :meth:`_KernelCache.done` when
+        the calculation is complete.
+        """
+        cache = self._get_kernel_cache()
+        with cache.lock:
+            if self._model is None:
+                self._model = core.build_model(self._model_info)
+            digest = hashlib.sha1(str(getattr(self._model, 'dtype', '')).encode())
+            for q in q_vectors:
+                q = np.ascontiguousarray(q)
+                digest.update(str((q.dtype.str, q.shape)).encode())
+                digest.update(q.data if q.size else b'')
+            key = digest.hexdigest()
+            return cache.acquire(key, lambda: self._model.make_kernel(q_vectors),
+                                 self.kernel_cache_size)
+
+    def _get_kernel_cache(self):
+        # type: () -> _KernelCache
+        """
+        Return the kernel cache for the model, creating it if necessary.
+        """
+        if self._kernel_cache is None:
+            with _CACHE_LOCK:
+                if self._kernel_cache is None:
+                    self._kernel_cache = _KernelCache()
+        return self._kernel_cache
+
+    def clear_kernel_cache(self):
+        # type: () -> None
+        """
+        Release the kernels held by the model and unload the model.
+
+        The kernels are rebuilt on the next call to :meth:`calculate_Iq`.
+        Use this to free resources for models which are no longer needed.
+        """
+        cache = self._get_kernel_cache()
+        with cache.lock:
+            cache.wait()
+            for kernel in cache.values():
+                kernel.release()
+            cache.clear()
+            if self._model is not None:
+                self._model.release()
 
     def calculate_ER(self):
         # type: () -> float
@@ -813,6 +979,105 @@ def test_empty_distribution():
     Iq = cylinder.evalDistribution(np.asarray([0.1]))
     assert np.isnan(Iq[0]), "empty distribution fails"
 
+def test_kernel_cache():
+    # type: () -> None
+    """
+    Make sure that kernels are reused for the same q and released on demand.
+    """
+    Cylinder = _make_standard_model('cylinder')
+    cylinder = Cylinder()
+    q = np.linspace(0.001, 0.5, 20)
+    first = cylinder.evalDistribution(q)
+    kernel = list(cylinder._kernel_cache.values())[0]
+    cylinder.setParam('radius', 30.)
+    second = cylinder.evalDistribution(q.copy())
+    assert list(cylinder._kernel_cache.values()) == [kernel]
+    assert (first != second).any()
+    for k in range(cylinder.kernel_cache_size + 1):
+        cylinder.evalDistribution(q[k:])
+    assert len(cylinder._kernel_cache) == cylinder.kernel_cache_size
+    assert kernel not in cylinder._kernel_cache.values()
+    clone = cylinder.clone()
+    assert not clone._kernel_cache
+    assert (clone.evalDistribution(q) == second).all()
+    cylinder.clear_kernel_cache()
+    assert not cylinder._kernel_cache
+    assert (cylinder.evalDistribution(q) == second).all()
+
+def test_concurrent_calls():
+    # type: () -> None
+    """
+    Make sure that calls to one model from several threads match the
+    serial results, including while kernels are evicted from the cache,
+    and that calls with different q run at the same time.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    Cylinder = _make_standard_model('cylinder')
+    cylinder = Cylinder()
+    cylinder.dispersion['radius']['width'] = 0.1
+    cylinder.dispersion['radius']['npts'] = 15
+    qs = [np.linspace(0.001, 0.5, 20 + k)
+          for k in range(cylinder.kernel_cache_size + 2)]
+    qs.append([np.linspace(-0.1, 0.1, 20), np.linspace(0.1, -0.1, 20)])
+    def call(q):
+        if isinstance(q, list):
+            return cylinder.evalDistribution(q)
+        return cylinder.calculate_Iq(q)
+    # The results may change in the last digits once the dlls specialized
+    # for the polydispersity loops have been compiled in the background.
+    targets = [call(q) for q in qs]
+    threads = ThreadPoolExecutor(max_workers=8)
+    try:
+        results = list(threads.map(call, qs*8))
+    finally:
+        threads.shutdown()
+    for target, actual in zip(targets*8, results):
+        assert np.allclose(actual, target, rtol=1e-12), \
+            "concurrent: expected %s but got %s"%(target, actual)
+
+    # Each kernel call waits inside the kernel for the other to arrive, so
+    # the barrier is broken if the calls are serialized.
+    barrier = threading.Barrier(2, timeout=10)
+    class Overlap(object):
+        """Model or kernel wrapper which waits at the barrier in each call."""
+        def __init__(self, obj):
+            self.obj = obj
+        def __getattr__(self, name):
+            return getattr(self.obj, name)
+        def make_kernel(self, q_vectors):
+            return Overlap(self.obj.make_kernel(q_vectors))
+        def __call__(self, *args, **kwargs):
+            barrier.wait()
+            return self.obj(*args, **kwargs)
+    cylinder = Cylinder()
+    cylinder.dispersion['radius']['width'] = 0.1
+    cylinder.dispersion['radius']['npts'] = 15
+    cylinder._model = Overlap(core.build_model(cylinder._model_info))
+    threads = ThreadPoolExecutor(max_workers=2)
+    try:
+        results = list(threads.map(cylinder.calculate_Iq, qs[:2]))
+    finally:
+        threads.shutdown()
+    for target, actual in zip(targets, results):
+        assert np.allclose(actual, target, rtol=1e-12), \
+            "overlap: expected %s but got %s"%(target, actual)
+
+def test_segments():
+    # type: () -> None
+    """
+    Make sure that segments are evaluated the same as separate calls.
+    """
+    P = _make_standard_model('sphere')()
+    S = _make_standard_model('hardsphere')()
+    model = MultiplicationModel(P, S)
+    segments = [np.linspace(0.01, 0.3, 20), np.linspace(0.001, 0.009, 5)]
+    results = model.calculate_Iq_segments(segments)
+    for q, Iq, parts in zip(segments, results.Iq, results.parts):
+        assert np.allclose(Iq, model.calculate_Iq(q))
+        for part, expected in zip(parts, model.calc_composition_models(q)):
+            assert np.allclose(part, expected)
+
 def test_model_list():
     # type: () -> None
     """